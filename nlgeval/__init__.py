@@ -8,15 +8,97 @@ from six.moves import map
 from nlgeval.pycocoevalcap.bleu.bleu import Bleu
 from nlgeval.pycocoevalcap.cider.cider import Cider
 from nlgeval.pycocoevalcap.meteor.meteor import Meteor
+from nlgeval.pycocoevalcap.ngrams import cook_corpus
 from nlgeval.pycocoevalcap.rouge.rouge import Rouge
 from nlgeval.pycocoevalcap.spice.spice import Spice
+from nlgeval.references import CompiledReferences
 
 # str/unicode stripping in Python 2 and 3 instead of `str.strip`.
 def _strip(s):
     return s.strip()
 
 
-def compute_metrics(hypothesis, references, no_overlap=False, no_skipthoughts=False, no_glove=False):
+def _load_scorers(metrics_to_omit=(), extra_metrics=(), cider_document_frequency=None, processes=1,
+                  meteor_cache=None, spice_cache_dir=None, spice_result_cache=None, spice_persistent=False,
+                  meteor_processes=1, spice_processes=1, spice_mem='8G'):
+    """
+    :param metrics_to_omit: set of str : overlap metrics not to compute, see `NLGEval.valid_metrics`
+    :param extra_metrics: set of str : overlap metrics to compute which are not computed by default,
+        see `NLGEval.optional_metrics`
+    :param processes: int : number of worker processes to compute ROUGE and CIDEr with
+    :param spice_persistent: bool : keep a SPICE JVM running between calls
+    :param meteor_processes: int : number of METEOR JVMs
+    :param spice_processes: int : number of SPICE JVMs
+    :param spice_mem: str : maximum heap size of each SPICE JVM
+    :return: list of (scorer, method) : method is the name of the metric, or the list of names of a scorer of several
+    """
+    scorers = []
+
+    omit_bleu_i = False
+    for i in range(1, 4 + 1):
+        if 'Bleu_{}'.format(i) in metrics_to_omit:
+            omit_bleu_i = True
+            if i > 1:
+                scorers.append((Bleu(i - 1), ['Bleu_{}'.format(j) for j in range(1, i)]))
+            break
+    if not omit_bleu_i:
+        scorers.append((Bleu(4), ["Bleu_1", "Bleu_2", "Bleu_3", "Bleu_4"]))
+
+    if 'METEOR' not in metrics_to_omit:
+        scorers.append((Meteor(processes=meteor_processes, cache=meteor_cache), "METEOR"))
+    rouge_metrics = [m for m in Rouge.all_metrics
+                     if m not in metrics_to_omit and (m not in NLGEval.optional_metrics or m in extra_metrics)]
+    if rouge_metrics:
+        scorers.append((Rouge(rouge_metrics, processes=processes), rouge_metrics))
+    if 'CIDEr' not in metrics_to_omit:
+        scorers.append((Cider(document_frequency=cider_document_frequency, processes=processes), "CIDEr"))
+    if 'SPICE' not in metrics_to_omit:
+        # Only the corpus score is reported.
+        scorers.append((Spice(persistent=spice_persistent, processes=spice_processes, mem=spice_mem,
+                              cache_dir=spice_cache_dir, result_cache=spice_result_cache, categories=['All']),
+                        "SPICE"))
+    return scorers
+
+
+def _overlap_scores(scorers, refs, hyps, index=None, document_frequency=None, close=False):
+    """
+    :param scorers: list : see `_load_scorers`
+    :param index: NgramIndex : the index to cook hyps with, e.g. an overlay of `CompiledReferences.index`
+    :param document_frequency: array : optional, CIDEr document frequencies of refs, by n-gram id
+    :param close: bool : close each scorer once it is done, e.g. to stop its JVMs
+    :return: list of (str, float) : the corpus score of each metric
+    """
+    ret_scores = []
+    try:
+        # Tokenize and count n-grams once for BLEU, CIDEr and ROUGE-L.
+        cooked_refs, cooked_hyps = cook_corpus(refs, hyps, index=index)
+        for scorer, method in scorers:
+            if isinstance(scorer, Bleu):
+                # Only the corpus score is reported, so no per segment statistics are kept.
+                score, _ = scorer.compute_score(cooked_refs, cooked_hyps, sentence_scores=False)
+            elif document_frequency is not None and isinstance(scorer, Cider):
+                score, _ = scorer.compute_score(cooked_refs, cooked_hyps, document_frequency=document_frequency)
+            else:
+                score, _ = scorer.compute_score(cooked_refs, cooked_hyps)
+            if isinstance(method, list):
+                ret_scores.extend(zip(method, score))
+            else:
+                ret_scores.append((method, score))
+            if close and hasattr(scorer, 'close'):
+                scorer.close()
+    finally:
+        # Also stop the JVMs of the scorers which did not get to run when one failed.
+        if close:
+            for scorer, _ in scorers:
+                if hasattr(scorer, 'close'):
+                    scorer.close()
+    return ret_scores
+
+
+def compute_metrics(hypothesis, references, no_overlap=False, no_skipthoughts=False, no_glove=False,
+                    cider_document_frequency=None, processes=1, meteor_cache=None, spice_cache_dir=None,
+                    spice_result_cache=None, extra_metrics=None, meteor_processes=1, spice_processes=1,
+                    spice_mem='8G'):
     with open(hypothesis, 'r') as f:
         hyp_list = f.readlines()
     ref_list = []
@@ -30,24 +112,14 @@ def compute_metrics(hypothesis, references, no_overlap=False, no_skipthoughts=Fa
 
     ret_scores = {}
     if not no_overlap:
-        scorers = [
-            (Bleu(4), ["Bleu_1", "Bleu_2", "Bleu_3", "Bleu_4"]),
-            (Meteor(), "METEOR"),
-            (Rouge(), "ROUGE_L"),
-            (Cider(), "CIDEr"),
-            (Spice(), "SPICE")
-        ]
-        for scorer, method in scorers:
-            score, scores = scorer.compute_score(refs, hyps)
-            if isinstance(method, list):
-                for sc, scs, m in zip(score, scores, method):
-                    print("%s: %0.6f" % (m, sc))
-                    ret_scores[m] = sc
-            else:
-                print("%s: %0.6f" % (method, score))
-                ret_scores[method] = score
-            if isinstance(scorer, Meteor):
-                scorer.close()
+        scorers = _load_scorers(extra_metrics=extra_metrics or (),
+                                cider_document_frequency=cider_document_frequency, processes=processes,
+                                meteor_cache=meteor_cache, spice_cache_dir=spice_cache_dir,
+                                spice_result_cache=spice_result_cache, meteor_processes=meteor_processes,
+                                spice_processes=spice_processes, spice_mem=spice_mem)
+        for m, sc in _overlap_scores(scorers, refs, hyps, close=True):
+            print("%s: %0.6f" % (m, sc))
+            ret_scores[m] = sc
         del scorers
 
     if not no_skipthoughts:
@@ -84,7 +156,10 @@ def compute_metrics(hypothesis, references, no_overlap=False, no_skipthoughts=Fa
     return ret_scores
 
 
-def compute_individual_metrics(ref, hyp, no_overlap=False, no_skipthoughts=False, no_glove=False):
+def compute_individual_metrics(ref, hyp, no_overlap=False, no_skipthoughts=False, no_glove=False,
+                               cider_document_frequency=None, processes=1, meteor_cache=None,
+                               spice_cache_dir=None, spice_result_cache=None, extra_metrics=None,
+                               meteor_processes=1, spice_processes=1, spice_mem='8G'):
     assert isinstance(hyp, six.string_types)
 
     if isinstance(ref, six.string_types):
@@ -98,22 +173,12 @@ def compute_individual_metrics(ref, hyp, no_overlap=False, no_skipthoughts=False
 
     ret_scores = {}
     if not no_overlap:
-        scorers = [
-            (Bleu(4), ["Bleu_1", "Bleu_2", "Bleu_3", "Bleu_4"]),
-            (Meteor(), "METEOR"),
-            (Rouge(), "ROUGE_L"),
-            (Cider(), "CIDEr"),
-            (Spice(), "SPICE")            
-        ]
-        for scorer, method in scorers:
-            score, scores = scorer.compute_score(refs, hyps)
-            if isinstance(method, list):
-                for sc, scs, m in zip(score, scores, method):
-                    ret_scores[m] = sc
-            else:
-                ret_scores[method] = score
-            if isinstance(scorer, Meteor):
-                scorer.close()
+        scorers = _load_scorers(extra_metrics=extra_metrics or (),
+                                cider_document_frequency=cider_document_frequency, processes=processes,
+                                meteor_cache=meteor_cache, spice_cache_dir=spice_cache_dir,
+                                spice_result_cache=spice_result_cache, meteor_processes=meteor_processes,
+                                spice_processes=spice_processes, spice_mem=spice_mem)
+        ret_scores.update(_overlap_scores(scorers, refs, hyps, close=True))
         del scorers
 
     if not no_skipthoughts:
@@ -158,7 +223,7 @@ class NLGEval(object):
                         # Overlap
                         'Bleu_1', 'Bleu_2', 'Bleu_3', 'Bleu_4',
                         'METEOR',
-                        'ROUGE_L',
+                        'ROUGE_1', 'ROUGE_2', 'ROUGE_L', 'ROUGE_W', 'ROUGE_SU4',
                         'CIDEr',
                         'SPICE',
 
@@ -166,8 +231,15 @@ class NLGEval(object):
                         'SkipThoughtCS',
                     } | glove_metrics
 
+    # Not computed unless asked for with `extra_metrics`.
+    optional_metrics = {
+        'ROUGE_1', 'ROUGE_2', 'ROUGE_W', 'ROUGE_SU4',
+    }
+
     def __init__(self, no_overlap=False, no_skipthoughts=False, no_glove=False,
-                 metrics_to_omit=None):
+                 metrics_to_omit=None, cider_document_frequency=None, processes=1, meteor_cache=None,
+                 spice_cache_dir=None, spice_result_cache=None, extra_metrics=None, meteor_processes=1,
+                 spice_processes=1, spice_mem='8G', spice_persistent=False):
         """
         :param no_overlap: Default: Use overlap metrics.
             `True` if these metrics should not be used.
@@ -182,6 +254,41 @@ class NLGEval(object):
             The previous parameters will override metrics in this one if they are set.
             Metrics to omit. Omitting Bleu_{i} will omit Bleu_{j} for j>=i.
         :type metrics_to_omit: Optional[Collection[str]]
+        :param cider_document_frequency: Default: CIDEr computes document frequencies from the references it is given.
+            Frozen document frequencies of a reference corpus, or the path they were saved to,
+            see `nlgeval.pycocoevalcap.cider.document_frequency.DocumentFrequency`.
+            Use them to get meaningful CIDEr scores for single examples.
+        :type cider_document_frequency: Optional[Union[str, DocumentFrequency]]
+        :param processes: Default: Score in this process.
+            Number of worker processes to compute ROUGE and CIDEr with.
+        :type processes: int
+        :param meteor_cache: Default: METEOR scores every segment.
+            Path of a file to cache METEOR segment statistics in, so that segments scored before are not scored again,
+            see `nlgeval.pycocoevalcap.meteor.cache.MeteorStatsCache`.
+        :type meteor_cache: Optional[Union[str, MeteorStatsCache]]
+        :param spice_cache_dir: Default: the NLGEVAL_SPICE_CACHE environment variable or a directory in the package.
+            Directory where SPICE caches the parses of captions, see `nlg-eval spice-warm`.
+        :type spice_cache_dir: Optional[str]
+        :param spice_result_cache: Default: SPICE scores every segment.
+            Path of a file to cache the SPICE scores of each segment in, so that segments scored before are not
+            scored again.
+        :type spice_result_cache: Optional[Union[str, SegmentCache]]
+        :param extra_metrics: Default: Compute none of `NLGEval.optional_metrics`.
+            Metrics to compute in addition to the default ones, from `NLGEval.optional_metrics`.
+        :type extra_metrics: Optional[Collection[str]]
+        :param meteor_processes: Default: One METEOR JVM.
+            Number of METEOR JVMs to score with, each one needs up to 2GB of memory.
+        :type meteor_processes: int
+        :param spice_processes: Default: One SPICE JVM.
+            Number of SPICE JVMs to parse and score with.
+        :type spice_processes: int
+        :param spice_mem: Default: '8G'.
+            Maximum heap size of each SPICE JVM.
+        :type spice_mem: str
+        :param spice_persistent: Default: SPICE JVMs are started for every call of `compute_metrics`.
+            `True` to keep the SPICE JVMs running between calls, so its parser models are only loaded once.
+            They are stopped by `close`.
+        :type spice_persistent: bool
         """
 
         if metrics_to_omit is None:
@@ -196,6 +303,20 @@ class NLGEval(object):
         assert len(self.metrics_to_omit - self.valid_metrics) == 0, \
             "Invalid metrics to omit: {}".format(self.metrics_to_omit - self.valid_metrics)
 
+        self.extra_metrics = set() if extra_metrics is None else set(extra_metrics)
+        assert len(self.extra_metrics - self.optional_metrics) == 0, \
+            "Invalid extra metrics: {}".format(self.extra_metrics - self.optional_metrics)
+
+        self.cider_document_frequency = cider_document_frequency
+        self.processes = processes
+        self.meteor_cache = meteor_cache
+        self.spice_cache_dir = spice_cache_dir
+        self.spice_result_cache = spice_result_cache
+        self.meteor_processes = meteor_processes
+        self.spice_processes = spice_processes
+        self.spice_mem = spice_mem
+        self.spice_persistent = spice_persistent
+
         self.no_overlap = no_overlap
         if not no_overlap:
             self.load_scorers()
@@ -209,26 +330,19 @@ class NLGEval(object):
             self.load_glove()
 
     def load_scorers(self):
-        self.scorers = []
-
-        omit_bleu_i = False
-        for i in range(1, 4 + 1):
-            if 'Bleu_{}'.format(i) in self.metrics_to_omit:
-                omit_bleu_i = True
-                if i > 1:
-                    self.scorers.append((Bleu(i - 1), ['Bleu_{}'.format(j) for j in range(1, i)]))
-                break
-        if not omit_bleu_i:
-            self.scorers.append((Bleu(4), ["Bleu_1", "Bleu_2", "Bleu_3", "Bleu_4"]))
-
-        if 'METEOR' not in self.metrics_to_omit:
-            self.scorers.append((Meteor(), "METEOR"))
-        if 'ROUGE_L' not in self.metrics_to_omit:
-            self.scorers.append((Rouge(), "ROUGE_L"))
-        if 'CIDEr' not in self.metrics_to_omit:
-            self.scorers.append((Cider(), "CIDEr"))
-        if 'SPICE' not in self.metrics_to_omit:
-            self.scorers.append((Spice(), "SPICE"))
+        self.scorers = _load_scorers(self.metrics_to_omit, self.extra_metrics, self.cider_document_frequency,
+                                     self.processes, self.meteor_cache, self.spice_cache_dir,
+                                     self.spice_result_cache, spice_persistent=self.spice_persistent,
+                                     meteor_processes=self.meteor_processes, spice_processes=self.spice_processes,
+                                     spice_mem=self.spice_mem)
+
+    def close(self):
+        """
+        Stop the JVMs of METEOR and SPICE, which are otherwise stopped when the interpreter exits.
+        """
+        for scorer, _ in getattr(self, 'scorers', ()):
+            if hasattr(scorer, 'close'):
+                scorer.close()
 
     def load_skipthought_model(self):
         from nlgeval.skipthoughts import skipthoughts
@@ -259,13 +373,7 @@ class NLGEval(object):
 
         ret_scores = {}
         if not self.no_overlap:
-            for scorer, method in self.scorers:
-                score, scores = scorer.compute_score(refs, hyps)
-                if isinstance(method, list):
-                    for sc, scs, m in zip(score, scores, method):
-                        ret_scores[m] = sc
-                else:
-                    ret_scores[method] = score
+            ret_scores.update(_overlap_scores(self.scorers, refs, hyps))
 
         if not self.no_skipthoughts:
             vector_hyps = self.skipthought_encoder.encode([h.strip() for h in hyp_list], verbose=False)
@@ -289,35 +397,71 @@ class NLGEval(object):
 
         return ret_scores
 
+    def compile_references(self, ref_list, path=None):
+        """
+        Compute everything the enabled metrics need from the references alone.
+
+        :param ref_list: list of list of str : as for `compute_metrics`
+        :param path: Optional, directory to save the compiled references to, see `CompiledReferences.load`
+        :return: CompiledReferences : can be given to `compute_metrics` instead of `ref_list`
+        """
+        references = CompiledReferences(ref_list)
+        if not self.no_overlap:
+            references.document_frequency()
+        if not self.no_skipthoughts:
+            references.skipthoughts(self.skipthought_encoder)
+        if not self.no_glove:
+            references.glove(self.glove_emb)
+        if path is not None:
+            references.save(path)
+        return references
+
     def compute_metrics(self, ref_list, hyp_list):
-        ref_list = [list(map(_strip, refs)) for refs in zip(*ref_list)]
-        refs = {idx: strippedlines for (idx, strippedlines) in enumerate(ref_list)}
+        """
+        :param ref_list: list of list of str : one list per reference source, or `CompiledReferences`
+        :param hyp_list: list of str : hypotheses
+        """
+        references = ref_list if isinstance(ref_list, CompiledReferences) else None
+        if references is not None:
+            ref_list = references.segments
+            refs = references.cooked()
+        else:
+            ref_list = [list(map(_strip, refs)) for refs in zip(*ref_list)]
+            refs = {idx: strippedlines for (idx, strippedlines) in enumerate(ref_list)}
         hyps = {idx: [lines.strip()] for (idx, lines) in enumerate(hyp_list)}
         assert len(refs) == len(hyps)
 
         ret_scores = {}
         if not self.no_overlap:
-            for scorer, method in self.scorers:
-                score, scores = scorer.compute_score(refs, hyps)
-                if isinstance(method, list):
-                    for sc, scs, m in zip(score, scores, method):
-                        ret_scores[m] = sc
-                else:
-                    ret_scores[method] = score
+            if references is not None:
+                # The CIDEr document frequencies of the references are only used if no frozen ones were given.
+                document_frequency = references.document_frequency() if self.cider_document_frequency is None else None
+                # The n-grams of the hypotheses are interned in a throwaway overlay of the index of the references.
+                ret_scores.update(_overlap_scores(self.scorers, refs, hyps, index=references.index.overlay(),
+                                                  document_frequency=document_frequency))
+            else:
+                ret_scores.update(_overlap_scores(self.scorers, refs, hyps))
 
         if not self.no_skipthoughts:
             vector_hyps = self.skipthought_encoder.encode([h.strip() for h in hyp_list], verbose=False)
-            ref_list_T = self.np.array(ref_list).T.tolist()
-            vector_refs = map(lambda refl: self.skipthought_encoder.encode([r.strip() for r in refl], verbose=False), ref_list_T)
+            if references is not None:
+                vector_refs = references.skipthoughts(self.skipthought_encoder)
+            else:
+                ref_list_T = self.np.array(ref_list).T.tolist()
+                vector_refs = map(lambda refl: self.skipthought_encoder.encode([r.strip() for r in refl], verbose=False), ref_list_T)
             cosine_similarity = list(map(lambda refv: self.cosine_similarity(refv, vector_hyps).diagonal(), vector_refs))
             cosine_similarity = self.np.max(cosine_similarity, axis=0).mean()
             ret_scores['SkipThoughtCS'] = cosine_similarity
 
         if not self.no_glove:
             glove_hyps = [h.strip() for h in hyp_list]
-            ref_list_T = self.np.array(ref_list).T.tolist()
-            glove_refs = map(lambda refl: [r.strip() for r in refl], ref_list_T)
-            scores = self.eval_emb_metrics(glove_hyps, glove_refs, emb=self.glove_emb)
+            if references is not None:
+                scores = self.eval_emb_metrics(glove_hyps, None, emb=self.glove_emb,
+                                               embedded_references=references.glove(self.glove_emb))
+            else:
+                ref_list_T = self.np.array(ref_list).T.tolist()
+                glove_refs = map(lambda refl: [r.strip() for r in refl], ref_list_T)
+                scores = self.eval_emb_metrics(glove_hyps, glove_refs, emb=self.glove_emb)
             scores = scores.split('\n')
             for score in scores:
                 name, value = score.split(':')
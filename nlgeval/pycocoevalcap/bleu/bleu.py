@@ -8,7 +8,7 @@
 # Last Modified : Thu 19 Mar 2015 09:13:28 PM PDT
 # Authors : Hao Fang <hfang@uw.edu> and Tsung-Yi Lin <tl483@cornell.edu>
 
-from .bleu_scorer import BleuScorer
+from .bleu_scorer import BleuAccumulator
 
 
 class Bleu:
@@ -18,12 +18,18 @@ class Bleu:
         self._hypo_for_image = {}
         self.ref_for_image = {}
 
-    def compute_score(self, gts, res):
+    def compute_score(self, gts, res, sentence_scores=True):
+        """
+        :param sentence_scores: bool : also return the BLEU of every segment.
+            Without them, memory use does not grow with the number of segments.
+        :return: (score, scores) : scores is None if sentence_scores is False
+        """
 
         assert(gts.keys() == res.keys())
         imgIds = gts.keys()
 
-        bleu_scorer = BleuScorer(n=self._n)
+        # option='shortest' and option='average' are also supported
+        bleu_scorer = BleuAccumulator(n=self._n, option='closest', keep_segments=sentence_scores)
         for id in imgIds:
             hypo = res[id]
             ref = gts[id]
@@ -36,9 +42,7 @@ class Bleu:
 
             bleu_scorer += (hypo[0], ref)
 
-        #score, scores = bleu_scorer.compute_score(option='shortest')
-        score, scores = bleu_scorer.compute_score(option='closest', verbose=0)
-        #score, scores = bleu_scorer.compute_score(option='average', verbose=1)
+        score, scores = bleu_scorer.compute_score(verbose=0)
 
         # return (bleu, bleu_info)
         return score, scores
@@ -14,40 +14,50 @@
 '''Provides:
 cook_refs(refs, n=4): Transform a list of reference sentences as strings into a form usable by cook_test().
 cook_test(test, refs, n=4): Transform a test sentence as a string (together with the cooked reference sentences) into a form usable by score_cooked().
+SegmentStats: Per segment statistics of cooked test sentences as arrays.
+BleuAccumulator: Streaming BLEU which only keeps summed statistics.
+bleu_from_stats(correct, guess, testlen, reflen): Compute BLEU from (summed or per segment) statistics.
 '''
 
+import array
 import copy
 import sys, math, re
-from collections import defaultdict
 
+import numpy as np
 import six
 from six.moves import xrange as range
 
+from .. import ngrams
 
-def precook(s, n=4, out=False):
+
+def precook(s, n=4, out=False, index=None):
     """Takes a string as input and returns an object that can be given to
     either cook_refs or cook_test. This is optional: cook_refs and cook_test
-    can take string arguments as well."""
-    words = s.split()
-    counts = defaultdict(int)
-    for k in range(1,n+1):
-        for i in range(len(words)-k+1):
-            ngram = tuple(words[i:i+k])
-            counts[ngram] += 1
+    can take string arguments as well.
+    Sentences already cooked by `ngrams.cook_corpus` are not counted again.
+    N-grams are counted by their id in `index`, see `ngrams.NgramCounts`, or by tuples of words if it is None."""
+    words, counts = ngrams.precook(s, n, index)
     return (len(words), counts)
 
-def cook_refs(refs, eff=None, n=4): ## lhuang: oracle will call with "average"
+def cook_refs(refs, eff=None, n=4, index=None): ## lhuang: oracle will call with "average"
     '''Takes a list of reference sentences for a single segment
     and returns an object that encapsulates everything that BLEU
-    needs to know about them.'''
+    needs to know about them.
+    index is the `ngrams.NgramIndex` to count n-grams with, n-gram tuples are counted if None.'''
 
     reflen = []
-    maxcounts = {}
+    counts = []
     for ref in refs:
-        rl, counts = precook(ref, n)
+        rl, ref_counts = precook(ref, n, index=index)
         reflen.append(rl)
-        for (ngram,count) in six.iteritems(counts):
-            maxcounts[ngram] = max(maxcounts.get(ngram,0), count)
+        counts.append(ref_counts)
+    if index is None:
+        maxcounts = {}
+        for ref_counts in counts:
+            for (ngram,count) in six.iteritems(ref_counts):
+                maxcounts[ngram] = max(maxcounts.get(ngram,0), count)
+    else:
+        maxcounts = ngrams.max_counts(counts)
 
     # Calculate effective reference sentence length.
     if eff == "shortest":
@@ -61,12 +71,13 @@ def cook_refs(refs, eff=None, n=4): ## lhuang: oracle will call with "average"
 
     return (reflen, maxcounts)
 
-def cook_test(test, reflen_refmaxcounts, eff=None, n=4):
+def cook_test(test, reflen_refmaxcounts, eff=None, n=4, index=None):
     '''Takes a test sentence and returns an object that
-    encapsulates everything that BLEU needs to know about it.'''
+    encapsulates everything that BLEU needs to know about it.
+    index has to be the one the references were cooked with.'''
 
     reflen, refmaxcounts = reflen_refmaxcounts
-    testlen, counts = precook(test, n, True)
+    testlen, counts = precook(test, n, True, index)
 
     result = {}
 
@@ -82,45 +93,244 @@ def cook_test(test, reflen_refmaxcounts, eff=None, n=4):
     result["guess"] = [max(0,testlen-k+1) for k in range(1,n+1)]
 
     result['correct'] = [0]*n
-    for (ngram, count) in six.iteritems(counts):
-        result["correct"][len(ngram)-1] += min(refmaxcounts.get(ngram,0), count)
+    if index is None:
+        for (ngram, count) in six.iteritems(counts):
+            result["correct"][len(ngram)-1] += min(refmaxcounts.get(ngram,0), count)
+    else:
+        orders = index.orders
+        for ngram, count in zip(*(a.tolist() for a in ngrams.clipped_counts(counts, refmaxcounts))):
+            result["correct"][orders[ngram]-1] += count
 
     return result
 
+class SegmentStats(object):
+    """Per segment BLEU statistics kept in flat integer arrays instead of one dict per segment.
+    """
+
+    __slots__ = "n", "testlen", "guess", "correct", "reflens", "numrefs"
+
+    def __init__(self, n=4):
+        self.n = n
+        self.testlen = array.array('l')
+        self.guess = array.array('l')
+        self.correct = array.array('l')
+        # reference lengths of all segments, flattened (float for "average" effective lengths)
+        self.reflens = array.array('d')
+        self.numrefs = array.array('l')
+
+    def append(self, comps):
+        '''adds a test sentence cooked by cook_test().'''
+        reflen = comps['reflen']
+        if not isinstance(reflen, list):
+            reflen = [reflen]
+        self.testlen.append(comps['testlen'])
+        self.guess.extend(comps['guess'][:self.n])
+        self.correct.extend(comps['correct'][:self.n])
+        self.reflens.extend(reflen)
+        self.numrefs.append(len(reflen))
+
+    def extend(self, other):
+        for name in SegmentStats.__slots__[1:]:
+            getattr(self, name).extend(getattr(other, name))
+
+    def copy(self):
+        new = SegmentStats(self.n)
+        new.extend(self)
+        return new
+
+    def __len__(self):
+        return len(self.testlen)
+
+    def comps(self):
+        '''Returns the statistics of every segment as the dicts cook_test() makes without eff,
+        i.e. with the list of reference lengths.'''
+        n = self.n
+        result = []
+        start = 0
+        for i, numrefs in enumerate(self.numrefs):
+            reflen = [int(l) if l == int(l) else l for l in self.reflens[start:start + numrefs]]
+            start += numrefs
+            result.append({'reflen': reflen,
+                           'testlen': self.testlen[i],
+                           'guess': list(self.guess[i * n:(i + 1) * n]),
+                           'correct': list(self.correct[i * n:(i + 1) * n])})
+        return result
+
+    def arrays(self):
+        '''Returns testlen (segments,), flattened reference lengths, number of references (segments,),
+        guess (segments, n) and correct (segments, n) as NumPy arrays.'''
+        return (np.array(self.testlen, dtype=np.int64),
+                np.array(self.reflens, dtype=float),
+                np.array(self.numrefs, dtype=np.int64),
+                np.array(self.guess, dtype=np.int64).reshape(-1, self.n),
+                np.array(self.correct, dtype=np.int64).reshape(-1, self.n))
+
+def effective_reflen(reflens, numrefs, testlen, option="closest"):
+    '''Chooses the effective reference length of every segment.
+    reflens holds the reference lengths of all segments flattened, numrefs how many belong to each segment.'''
+
+    if len(numrefs) == 0:
+        return np.zeros(0, dtype=np.int64)
+    starts = np.cumsum(numrefs) - numrefs
+
+    if option == "shortest":
+        return np.minimum.reduceat(reflens, starts)
+    elif option == "average":
+        return np.add.reduceat(reflens, starts) / numrefs.astype(float)
+    elif option == "closest":
+        # Closest length, preferring the shorter reference on ties:
+        # the key is odd for references longer than the test sentence.
+        diff = reflens - np.repeat(testlen, numrefs)
+        key = 2 * np.abs(diff) + (diff > 0)
+        best = np.minimum.reduceat(key, starts)
+        return testlen + np.where(best % 2 == 1, best // 2, -(best // 2))
+    else:
+        assert False, "unsupported reflen option %s" % option
+
+def bleu_from_stats(correct, guess, testlen, reflen, small=1e-9, tiny=1e-15):
+    '''Computes BLEU-1 to BLEU-n from clipped n-gram matches and n-gram counts.
+    Works on summed corpus statistics (n,) as well as per segment arrays (segments, n).
+    Returns the scores and the length ratio(s).'''
+
+    correct = np.asarray(correct, dtype=float)
+    guess = np.asarray(guess, dtype=float)
+    n = correct.shape[-1]
+    # tiny: so that if guess is 0 still return 0
+    bleus = np.cumprod((correct + tiny) / (guess + small), axis=-1) ** (1. / np.arange(1, n + 1))
+    ratio = (np.asarray(testlen, dtype=float) + tiny) / (np.asarray(reflen, dtype=float) + small) ## N.B.: avoid zero division
+    brevity_penalty = np.where(ratio < 1, np.exp(1 - 1 / ratio), 1.)
+    return bleus * brevity_penalty[..., None], ratio
+
+class BleuAccumulator(object):
+    """Streaming BLEU.
+    Folds every (test, refs) pair into summed sufficient statistics as soon as it is added,
+    so memory does not grow with the corpus.  Per segment statistics are only kept, in a compact
+    SegmentStats, if keep_segments is set.  Accumulators of different shards can be merged with +=.
+    """
+
+    __slots__ = "n", "option", "testlen", "reflen", "guess", "correct", "size", "segments"
+
+    def __init__(self, n=4, option="closest", keep_segments=False):
+        self.n = n
+        # effective reference length, see BleuScorer._single_reflen
+        assert option in ("closest", "shortest", "average"), "unsupported reflen option %s" % option
+        self.option = option
+        self.testlen = 0
+        self.reflen = 0
+        self.guess = [0] * n
+        self.correct = [0] * n
+        self.size = 0
+        self.segments = SegmentStats(n) if keep_segments else None
+
+    def add(self, test, refs):
+        '''folds one test sentence and its references into the statistics.'''
+
+        # Counts are only needed until the segment is folded, so nothing is interned for plain strings.
+        index = refs[0].index if isinstance(refs[0], ngrams.CookedSentence) else None
+        eff = None if self.option == "closest" else self.option
+        comps = cook_test(test, cook_refs(refs, eff=eff, n=self.n, index=index),
+                          eff=self.option, n=self.n, index=index)
+
+        self.testlen += comps['testlen']
+        self.reflen += comps['reflen']
+        for k in range(self.n):
+            self.guess[k] += comps['guess'][k]
+            self.correct[k] += comps['correct'][k]
+        self.size += 1
+        if self.segments is not None:
+            self.segments.append(comps)
+
+    def __iadd__(self, other):
+        '''add a (test, refs) pair or merge another accumulator.'''
+
+        if type(other) is tuple:
+            self.add(other[0], other[1])
+        else:
+            assert isinstance(other, BleuAccumulator) and self.n == other.n and self.option == other.option, \
+                "incompatible BLEUs."
+            self.testlen += other.testlen
+            self.reflen += other.reflen
+            for k in range(self.n):
+                self.guess[k] += other.guess[k]
+                self.correct[k] += other.correct[k]
+            self.size += other.size
+            if self.segments is not None:
+                assert other.segments is not None, "cannot merge per segment statistics which were not kept."
+                self.segments.extend(other.segments)
+
+        return self
+
+    def __len__(self):
+        return self.size
+
+    def compute_score(self, verbose=0, sentence_scores=None):
+        '''Returns (bleus, bleu_list) like BleuScorer.compute_score.
+        Per sentence scores are computed if segments are kept, unless sentence_scores is False.'''
+
+        bleus, ratio = bleu_from_stats(self.correct, self.guess, self.testlen, self.reflen)
+
+        bleu_list = None
+        if sentence_scores is None:
+            sentence_scores = self.segments is not None
+        if sentence_scores:
+            assert self.segments is not None, "per segment statistics were not kept."
+            testlen, reflen, numrefs, guess, correct = self.segments.arrays()
+            bleu_list = bleu_from_stats(correct, guess, testlen, reflen)[0].T.tolist()
+
+        if verbose > 0:
+            print({'testlen': self.testlen, 'reflen': self.reflen, 'guess': self.guess, 'correct': self.correct})
+            print("ratio:", ratio.item())
+
+        return bleus.tolist(), bleu_list
+
 class BleuScorer(object):
     """Bleu scorer.
     """
 
-    __slots__ = "n", "crefs", "ctest", "_score", "_ratio", "_testlen", "_reflen", "special_reflen"
+    __slots__ = "n", "crefs", "stats", "untested", "index", "_score", "_ratio", "_testlen", "_reflen", "special_reflen"
     # special_reflen is used in oracle (proportional effective ref len for a node).
+    # stats holds the cooked test sentences as arrays, ctest rebuilds them from it when asked for.
+    # untested holds the positions in crefs of the segments added without a test sentence.
+    # index interns the n-grams of crefs, it is shared with the sentences cooked by `ngrams.cook_corpus`.
 
     def copy(self):
         ''' copy the refs.'''
-        new = BleuScorer(n=self.n)
-        new.ctest = copy.copy(self.ctest)
+        new = BleuScorer(n=self.n, index=self.index)
         new.crefs = copy.copy(self.crefs)
+        new.stats = self.stats.copy()
+        new.untested = copy.copy(self.untested)
         new._score = None
         return new
 
-    def __init__(self, test=None, refs=None, n=4, special_reflen=None):
+    def __init__(self, test=None, refs=None, n=4, special_reflen=None, index=None):
         ''' singular instance '''
 
         self.n = n
+        self.index = index
         self.crefs = []
-        self.ctest = []
+        self.stats = SegmentStats(n)
+        self.untested = []
         self.cook_append(test, refs)
         self.special_reflen = special_reflen
 
+    @property
+    def ctest(self):
+        '''The cooked test sentences, None for segments added without one.'''
+        comps = iter(self.stats.comps())
+        untested = set(self.untested)
+        return [None if i in untested else next(comps) for i in range(len(self.crefs))]
+
     def cook_append(self, test, refs):
         '''called by constructor and __iadd__ to avoid creating new instances.'''
 
         if refs is not None:
-            self.crefs.append(cook_refs(refs))
+            if self.index is None:
+                self.index = ngrams.index_of(refs[0])
+            self.crefs.append(cook_refs(refs, n=self.n, index=self.index))
             if test is not None:
-                cooked_test = cook_test(test, self.crefs[-1])
-                self.ctest.append(cooked_test) ## N.B.: -1
+                self.stats.append(cook_test(test, self.crefs[-1], n=self.n, index=self.index))
             else:
-                self.ctest.append(None) # lens of crefs and ctest have to match
+                self.untested.append(len(self.crefs) - 1) # lens of crefs and ctest have to match
 
         self._score = None ## need to recompute
 
@@ -147,9 +357,10 @@ class BleuScorer(object):
         if type(new_test) is str:
             new_test = [new_test]
         assert len(new_test) == len(self.crefs), new_test
-        self.ctest = []
+        self.stats = SegmentStats(self.n)
+        self.untested = []
         for t, rs in zip(new_test, self.crefs):
-            self.ctest.append(cook_test(t, rs))
+            self.stats.append(cook_test(t, rs, n=self.n, index=self.index))
         self._score = None
 
         return self
@@ -160,7 +371,8 @@ class BleuScorer(object):
         return self.retest(new_test).compute_score()
 
     def size(self):
-        assert len(self.crefs) == len(self.ctest), "refs/test mismatch! %d<>%d" % (len(self.crefs), len(self.ctest))
+        ntest = len(self.stats) + len(self.untested)
+        assert len(self.crefs) == ntest, "refs/test mismatch! %d<>%d" % (len(self.crefs), ntest)
         return len(self.crefs)
 
     def __iadd__(self, other):
@@ -171,8 +383,12 @@ class BleuScorer(object):
             self.cook_append(other[0], other[1])
         else:
             assert self.compatible(other), "incompatible BLEUs."
-            self.ctest.extend(other.ctest)
-            self.crefs.extend(other.crefs)
+            self.untested.extend(len(self.crefs) + i for i in other.untested)
+            if self.index is None:
+                self.index = other.index
+            self.crefs.extend((reflen, self.index.translate(maxcounts, other.index))
+                              for reflen, maxcounts in other.crefs)
+            self.stats.extend(other.stats)
             self._score = None ## need to recompute
 
         return self
@@ -196,15 +412,14 @@ class BleuScorer(object):
 
         return reflen
 
-    def recompute_score(self, option=None, verbose=0):
+    def recompute_score(self, option=None, verbose=0, sentence_scores=True):
         self._score = None
-        return self.compute_score(option, verbose)
+        return self.compute_score(option, verbose, sentence_scores)
 
-    def compute_score(self, option=None, verbose=0):
+    def compute_score(self, option=None, verbose=0, sentence_scores=True):
+        '''Computes corpus BLEU and, if `sentence_scores` is set, the BLEU of every segment.
+        Returns (bleus, bleu_list) where bleu_list is None when `sentence_scores` is False.'''
         n = self.n
-        small = 1e-9
-        tiny = 1e-15 ## so that if guess is 0 still return 0
-        bleu_list = [[] for _ in range(n)]
 
         if self._score is not None:
             return self._score
@@ -212,57 +427,33 @@ class BleuScorer(object):
         if option is None:
             option = "average" if len(self.crefs) == 1 else "closest"
 
-        self._testlen = 0
-        self._reflen = 0
-        totalcomps = {'testlen':0, 'reflen':0, 'guess':[0]*n, 'correct':[0]*n}
+        testlen, reflens, numrefs, guess, correct = self.stats.arrays()
+        if self.special_reflen is None: ## need computation
+            reflen = effective_reflen(reflens, numrefs, testlen, option)
+        else:
+            reflen = np.full(len(testlen), self.special_reflen)
 
-        # for each sentence
-        for comps in self.ctest:
-            testlen = comps['testlen']
-            self._testlen += testlen
+        if verbose > 1:
+            for comps, l in zip(self.ctest, reflen):
+                print(comps, l)
 
-            if self.special_reflen is None: ## need computation
-                reflen = self._single_reflen(comps['reflen'], option, testlen)
-            else:
-                reflen = self.special_reflen
-
-            self._reflen += reflen
-
-            for key in ['guess','correct']:
-                for k in range(n):
-                    totalcomps[key][k] += comps[key][k]
-
-            # append per image bleu score
-            bleu = 1.
-            for k in range(n):
-                bleu *= (float(comps['correct'][k]) + tiny) \
-                        /(float(comps['guess'][k]) + small)
-                bleu_list[k].append(bleu ** (1./(k+1)))
-            ratio = (testlen + tiny) / (reflen + small) ## N.B.: avoid zero division
-            if ratio < 1:
-                for k in range(n):
-                    bleu_list[k][-1] *= math.exp(1 - 1/ratio)
-
-            if verbose > 1:
-                print(comps, reflen)
-
-        totalcomps['reflen'] = self._reflen
-        totalcomps['testlen'] = self._testlen
-
-        bleus = []
-        bleu = 1.
-        for k in range(n):
-            bleu *= float(totalcomps['correct'][k] + tiny) \
-                    / (totalcomps['guess'][k] + small)
-            bleus.append(bleu ** (1./(k+1)))
-        ratio = (self._testlen + tiny) / (self._reflen + small) ## N.B.: avoid zero division
-        if ratio < 1:
-            for k in range(n):
-                bleus[k] *= math.exp(1 - 1/ratio)
+        self._testlen = testlen.sum().item()
+        self._reflen = reflen.sum().item()
+        totalcomps = {'testlen': self._testlen, 'reflen': self._reflen,
+                      'guess': guess.sum(axis=0).tolist(), 'correct': correct.sum(axis=0).tolist()}
+
+        bleus, ratio = bleu_from_stats(totalcomps['correct'], totalcomps['guess'], self._testlen, self._reflen)
+        bleus = bleus.tolist()
+        self._ratio = ratio.item()
+
+        bleu_list = None
+        if sentence_scores:
+            # per image bleu score, one list per n-gram order
+            bleu_list = bleu_from_stats(correct, guess, testlen, reflen)[0].T.tolist()
 
         if verbose > 0:
             print(totalcomps)
-            print("ratio:", ratio)
+            print("ratio:", self._ratio)
 
         self._score = bleus
         return self._score, bleu_list
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import unittest
+
+import numpy as np
+
+from nlgeval.pycocoevalcap.bleu.bleu import Bleu
+from nlgeval.pycocoevalcap.bleu.bleu_scorer import BleuAccumulator, BleuScorer, effective_reflen
+
+
+class TestBleu(unittest.TestCase):
+    def test_compute_score(self):
+        score, scores = Bleu(4).compute_score({0: ["this is a test", "this is also a test"]},
+                                              {0: ["this is a good test"]})
+        np.testing.assert_allclose([0.8, 0.632455, 0.5108729, 0.0000903602], score, rtol=1e-5)
+        np.testing.assert_allclose(score, np.asarray(scores)[:, 0])
+
+        corpus_score, no_scores = Bleu(4).compute_score({0: ["this is a test", "this is also a test"]},
+                                                        {0: ["this is a good test"]}, sentence_scores=False)
+        self.assertEqual(score, corpus_score)
+        self.assertIsNone(no_scores)
+
+    def test_effective_reflen(self):
+        reflens = np.array([3, 5, 4, 2, 6])
+        numrefs = np.array([2, 3])
+        testlen = np.array([4, 4])
+        np.testing.assert_array_equal([3, 2], effective_reflen(reflens, numrefs, testlen, "shortest"))
+        np.testing.assert_array_equal([4., 4.], effective_reflen(reflens, numrefs, testlen, "average"))
+        # Ties go to the shorter reference.
+        np.testing.assert_array_equal([3, 4], effective_reflen(reflens, numrefs, testlen, "closest"))
+
+    def test_sentence_scores(self):
+        bleu_scorer = BleuScorer(n=2)
+        bleu_scorer += ("a b c", ["a b c d"])
+        bleu_scorer += ("a c", ["a b", "a c d"])
+        score, scores = bleu_scorer.compute_score(option='closest')
+        self.assertEqual(2, len(scores))
+        self.assertEqual(2, len(scores[0]))
+        self.assertIsNone(bleu_scorer.recompute_score(option='closest', sentence_scores=False)[1])
+
+    def test_ctest(self):
+        bleu_scorer = BleuScorer(n=2)
+        bleu_scorer += ("a b c", ["a b c d"])
+        bleu_scorer.cook_append(None, ["a b"])
+        bleu_scorer += ("a c", ["a b", "a c d"])
+        self.assertEqual([{'reflen': [4], 'testlen': 3, 'guess': [3, 2], 'correct': [3, 2]},
+                          None,
+                          {'reflen': [2, 3], 'testlen': 2, 'guess': [2, 1], 'correct': [2, 1]}],
+                         bleu_scorer.ctest)
+        self.assertEqual(3, bleu_scorer.size())
+        merged = bleu_scorer.copy()
+        merged += bleu_scorer
+        self.assertEqual(bleu_scorer.ctest * 2, merged.ctest)
+
+    def test_accumulator(self):
+        pairs = [("a b c", ["a b c d"]),
+                 ("a c", ["a b", "a c d"]),
+                 ("b c a b", ["c a b", "a b c a b c"])]
+        for option in ["closest", "shortest", "average"]:
+            bleu_scorer = BleuScorer(n=4)
+            first = BleuAccumulator(n=4, option=option, keep_segments=True)
+            second = BleuAccumulator(n=4, option=option, keep_segments=True)
+            for i, pair in enumerate(pairs):
+                bleu_scorer += pair
+                if i < 2:
+                    first += pair
+                else:
+                    second += pair
+            first += second
+            self.assertEqual(3, len(first))
+            expected_score, expected_scores = bleu_scorer.compute_score(option=option)
+            score, scores = first.compute_score()
+            np.testing.assert_allclose(expected_score, score)
+            np.testing.assert_allclose(expected_scores, scores)
+
+        stats_only = BleuAccumulator(n=4)
+        for pair in pairs:
+            stats_only += pair
+        self.assertIsNone(stats_only.segments)
+        self.assertIsNone(stats_only.compute_score()[1])
+        np.testing.assert_allclose(bleu_scorer.recompute_score(option="closest")[0], stats_only.compute_score()[0])
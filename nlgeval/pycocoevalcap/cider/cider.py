@@ -7,7 +7,11 @@
 #
 # Authors: Ramakrishna Vedantam <vrama91@vt.edu> and Tsung-Yi Lin <tl483@cornell.edu>
 
+import six
+
+from ..ngrams import cook_corpus
 from .cider_scorer import CiderScorer
+from .document_frequency import DocumentFrequency
 import pdb
 
 class Cider:
@@ -15,24 +19,38 @@ class Cider:
     Main Class to compute the CIDEr metric 
 
     """
-    def __init__(self, test=None, refs=None, n=4, sigma=6.0):
+    def __init__(self, test=None, refs=None, n=4, sigma=6.0, document_frequency=None, processes=1):
         # set cider to sum over 1 to 4-grams
         self._n = n
         # set the standard deviation parameter for gaussian penalty
         self._sigma = sigma
+        # frozen document frequencies of a reference corpus (`DocumentFrequency` or the path it was saved to),
+        # by default they are computed from the references given to `compute_score`
+        if isinstance(document_frequency, six.string_types):
+            document_frequency = DocumentFrequency.load(document_frequency)
+        self._document_frequency = document_frequency
+        # number of worker processes to score with, see `CiderScorer.compute_cider`
+        self._processes = processes
 
-    def compute_score(self, gts, res):
+    def compute_score(self, gts, res, document_frequency=None):
         """
         Main function to compute CIDEr score
         :param  hypo_for_image (dict) : dictionary with key <image> and value <tokenized hypothesis / candidate sentence>
                 ref_for_image (dict)  : dictionary with key <image> and value <tokenized reference sentence>
+                document_frequency (dict or array) : optional, document frequencies already computed for these references,
+                    keyed by n-gram id in the index the references were cooked with, overrides the frozen ones
         :return: cider (float) : computed CIDEr score for the corpus 
         """
 
         assert(gts.keys() == res.keys())
         imgIds = gts.keys()
 
-        cider_scorer = CiderScorer(n=self._n, sigma=self._sigma)
+        # count the n-grams of all sentences at once, sentences already cooked by `ngrams.cook_corpus` are kept
+        gts, res = cook_corpus(gts, res, self._n)
+
+        if document_frequency is None:
+            document_frequency = self._document_frequency
+        cider_scorer = CiderScorer(n=self._n, sigma=self._sigma, document_frequency=document_frequency)
 
         for id in imgIds:
             hypo = res[id]
@@ -46,7 +64,7 @@ class Cider:
 
             cider_scorer += (hypo[0], ref)
 
-        (score, scores) = cider_scorer.compute_score()
+        (score, scores) = cider_scorer.compute_score(processes=self._processes)
 
         return score, scores
 
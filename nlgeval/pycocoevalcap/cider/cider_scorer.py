@@ -3,48 +3,54 @@
 # Ramakrishna Vedantam <vrama91@vt.edu>
 
 import copy
-import math
 from collections import defaultdict
+from multiprocessing import Pool
 
 import numpy as np
+import scipy.sparse as sp
 from six.moves import xrange as range
 import six
 
-def precook(s, n=4, out=False):
+from .. import ngrams
+from .document_frequency import DocumentFrequency
+
+# Number of images `cider_scores` computes the similarities of at once
+BLOCK_SIZE = 1024
+
+def precook(s, n=4, out=False, index=None):
     """
     Takes a string as input and returns an object that can be given to
     either cook_refs or cook_test. This is optional: cook_refs and cook_test
     can take string arguments as well.
+    Sentences already cooked by `ngrams.cook_corpus` are not counted again.
     :param s: string : sentence to be converted into ngrams
     :param n: int    : number of ngrams for which representation is calculated
-    :return: term frequency vector for occuring ngrams
+    :param index: NgramIndex : n-grams are counted by their id in index
+    :return: term frequency vector for occuring ngrams, see `ngrams.NgramCounts`
     """
-    words = s.split()
-    counts = defaultdict(int)
-    for k in range(1,n+1):
-        for i in range(len(words)-k+1):
-            ngram = tuple(words[i:i+k])
-            counts[ngram] += 1
+    words, counts = ngrams.precook(s, n, index)
     return counts
 
-def cook_refs(refs, n=4): ## lhuang: oracle will call with "average"
+def cook_refs(refs, n=4, index=None): ## lhuang: oracle will call with "average"
     '''Takes a list of reference sentences for a single segment
     and returns an object that encapsulates everything that BLEU
     needs to know about them.
     :param refs: list of string : reference sentences for some image
     :param n: int : number of ngrams for which (ngram) representation is calculated
-    :return: result (list of dict)
+    :param index: NgramIndex : index to key n-grams with
+    :return: result (list of NgramCounts)
     '''
-    return [precook(ref, n) for ref in refs]
+    return [precook(ref, n, index=index) for ref in refs]
 
-def cook_test(test, n=4):
+def cook_test(test, n=4, index=None):
     '''Takes a test sentence and returns an object that
     encapsulates everything that BLEU needs to know about it.
     :param test: list of string : hypothesis sentence for some image
     :param n: int : number of ngrams for which (ngram) representation is calculated
-    :return: result (dict)
+    :param index: NgramIndex : index to key n-grams with
+    :return: result (NgramCounts)
     '''
-    return precook(test, n, True)
+    return precook(test, n, True, index)
 
 class CiderScorer(object):
     """CIDEr scorer.
@@ -52,18 +58,28 @@ class CiderScorer(object):
 
     def copy(self):
         ''' copy the refs.'''
-        new = CiderScorer(n=self.n)
+        new = CiderScorer(n=self.n, sigma=self.sigma, index=self.index,
+                          document_frequency=self.document_frequency if self.precomputed_doc_freq else None)
         new.ctest = copy.copy(self.ctest)
         new.crefs = copy.copy(self.crefs)
+        if not self.precomputed_doc_freq:
+            new.document_frequency = copy.copy(self.document_frequency)
         return new
 
-    def __init__(self, test=None, refs=None, n=4, sigma=6.0):
-        ''' singular instance '''
+    def __init__(self, test=None, refs=None, n=4, sigma=6.0, index=None, document_frequency=None):
+        ''' singular instance
+        document_frequency can be given if it was already computed for the same references with `index`,
+        as a dict or an array keyed by n-gram id,
+        or as a `DocumentFrequency` of another reference corpus.
+        '''
         self.n = n
         self.sigma = sigma
+        # interns the n-grams of crefs and ctest, shared with the sentences cooked by `ngrams.cook_corpus`
+        self.index = index
         self.crefs = []
         self.ctest = []
-        self.document_frequency = defaultdict(float)
+        self.precomputed_doc_freq = document_frequency is not None
+        self.document_frequency = document_frequency if self.precomputed_doc_freq else defaultdict(float)
         self.cook_append(test, refs)
         self.ref_len = None
 
@@ -71,9 +87,12 @@ class CiderScorer(object):
         '''called by constructor and __iadd__ to avoid creating new instances.'''
 
         if refs is not None:
-            self.crefs.append(cook_refs(refs))
+            if self.index is None:
+                self.index = ngrams.index_of(refs[0])
+            self.crefs.append(cook_refs(refs, self.n, self.index))
+            self.add_doc_freq(self.crefs[-1])
             if test is not None:
-                self.ctest.append(cook_test(test)) ## N.B.: -1
+                self.ctest.append(cook_test(test, self.n, self.index)) ## N.B.: -1
             else:
                 self.ctest.append(None) # lens of crefs and ctest have to match
 
@@ -88,107 +107,196 @@ class CiderScorer(object):
             ## avoid creating new CiderScorer instances
             self.cook_append(other[0], other[1])
         else:
-            self.ctest.extend(other.ctest)
-            self.crefs.extend(other.crefs)
+            if self.index is None:
+                self.index = other.index
+            self.ctest.extend(test if test is None else self.index.translate(test, other.index)
+                              for test in other.ctest)
+            for refs in other.crefs:
+                self.crefs.append([self.index.translate(ref, other.index) for ref in refs])
+                self.add_doc_freq(self.crefs[-1])
 
         return self
+    def add_doc_freq(self, refs):
+        '''
+        Count the n-grams of the references of one more image in the document frequency,
+        unless it was given to the constructor.
+        :param refs: list of NgramCounts : cooked references of one image
+        :return: None
+        '''
+        if self.precomputed_doc_freq:
+            return
+        # refs, k ref captions of one image
+        for ngram in np.unique(np.concatenate([ref.ngrams for ref in refs])).tolist():
+            self.document_frequency[ngram] += 1
+
     def compute_doc_freq(self):
         '''
         Compute term frequency for reference data.
         This will be used to compute idf (inverse document frequency later)
-        The term frequency is stored in the object
+        The term frequency is stored in the object.
+        It is kept up to date by `cook_append` and `__iadd__`, this recomputes it from scratch.
         :return: None
         '''
+        if self.precomputed_doc_freq:
+            return
+        self.document_frequency = defaultdict(float)
         for refs in self.crefs:
-            # refs, k ref captions of one image
-            for ngram in set([ngram for ref in refs for (ngram,count) in six.iteritems(ref)]):
-                self.document_frequency[ngram] += 1
-            # maxcounts[ngram] = max(maxcounts.get(ngram,0), count)
-
-    def compute_cider(self):
-        def counts2vec(cnts):
-            """
-            Function maps counts of ngram to vector of tfidf weights.
-            The function returns vec, an array of dictionary that store mapping of n-gram and tf-idf weights.
-            The n-th entry of array denotes length of n-grams.
-            :param cnts:
-            :return: vec (array of dict), norm (array of float), length (int)
-            """
-            vec = [defaultdict(float) for _ in range(self.n)]
-            length = 0
-            norm = [0.0 for _ in range(self.n)]
-            for (ngram,term_freq) in six.iteritems(cnts):
-                # give word count 1 if it doesn't appear in reference corpus
-                df = np.log(max(1.0, self.document_frequency[ngram]))
-                # ngram index
-                n = len(ngram)-1
-                # tf (term_freq) * idf (precomputed idf) for n-grams
-                vec[n][ngram] = float(term_freq)*(self.ref_len - df)
-                # compute norm for the vector.  the norm will be used for computing similarity
-                norm[n] += pow(vec[n][ngram], 2)
-
-                if n == 1:
-                    length += term_freq
-            norm = [np.sqrt(n) for n in norm]
-            return vec, norm, length
-
-        def sim(vec_hyp, vec_ref, norm_hyp, norm_ref, length_hyp, length_ref):
-            '''
-            Compute the cosine similarity of two vectors.
-            :param vec_hyp: array of dictionary for vector corresponding to hypothesis
-            :param vec_ref: array of dictionary for vector corresponding to reference
-            :param norm_hyp: array of float for vector corresponding to hypothesis
-            :param norm_ref: array of float for vector corresponding to reference
-            :param length_hyp: int containing length of hypothesis
-            :param length_ref: int containing length of reference
-            :return: array of score for each n-grams cosine similarity
-            '''
-            delta = float(length_hyp - length_ref)
-            # measure consine similarity
-            val = np.array([0.0 for _ in range(self.n)])
-            for n in range(self.n):
-                # ngram
-                for (ngram,count) in six.iteritems(vec_hyp[n]):
-                    # vrama91 : added clipping
-                    val[n] += min(vec_hyp[n][ngram], vec_ref[n][ngram]) * vec_ref[n][ngram]
-
-                if (norm_hyp[n] != 0) and (norm_ref[n] != 0):
-                    val[n] /= (norm_hyp[n]*norm_ref[n])
-
-                assert(not math.isnan(val[n]))
-                # vrama91: added a length based gaussian penalty
-                val[n] *= np.e**(-(delta**2)/(2*self.sigma**2))
-            return val
-
-        # compute log reference length
-        self.ref_len = np.log(float(len(self.crefs)))
-
-        scores = []
-        for test, refs in zip(self.ctest, self.crefs):
-            # compute vector for test captions
-            vec, norm, length = counts2vec(test)
-            # compute vector for ref captions
-            score = np.array([0.0 for _ in range(self.n)])
-            for ref in refs:
-                vec_ref, norm_ref, length_ref = counts2vec(ref)
-                score += sim(vec, vec_ref, norm, norm_ref, length, length_ref)
-            # change by vrama91 - mean of ngram scores, instead of sum
-            score_avg = np.mean(score)
-            # divide by number of references
-            score_avg /= len(refs)
-            # multiply score by 10
-            score_avg *= 10.0
-            # append score of an image to the score list
-            scores.append(score_avg)
-        return scores
-
-    def compute_score(self, option=None, verbose=0):
-        # compute idf
-        self.compute_doc_freq()
+            self.add_doc_freq(refs)
+
+    def idf(self):
+        """
+        Compute `ref_len` and the idf of every n-gram id in `index`.
+        :return: array of float
+        """
+        if isinstance(self.document_frequency, DocumentFrequency):
+            # frozen document frequencies of a larger reference corpus
+            self.ref_len = self.document_frequency.ref_len
+            document_frequency = self.document_frequency.lookup(self.index)
+        else:
+            # compute log reference length
+            self.ref_len = np.log(float(len(self.crefs)))
+            document_frequency = np.zeros(len(self.index), dtype=np.float64)
+            if isinstance(self.document_frequency, np.ndarray):
+                # given for the n-gram ids of the index the references were cooked with, e.g. the base of self.index
+                document_frequency[:len(self.document_frequency)] = self.document_frequency
+            elif len(self.document_frequency) > 0:
+                document_frequency[np.fromiter(self.document_frequency.keys(), dtype=np.int64,
+                                               count=len(self.document_frequency))] = \
+                    np.fromiter(self.document_frequency.values(), dtype=np.float64,
+                                count=len(self.document_frequency))
+        # give word count 1 if it doesn't appear in reference corpus
+        return self.ref_len - np.log(np.maximum(1.0, document_frequency))
+
+    def compute_cider(self, processes=1):
+        """
+        :param processes: int : number of worker processes scoring shards of the images, 1 scores serially
+        :return: array of float : score of each image
+        """
+        orders = np.asarray(self.index.orders, dtype=np.int64)
+        idf = self.idf()
+        if processes <= 1 or len(self.crefs) < 2:
+            return cider_scores(self.ctest, self.crefs, orders, idf, self.n, self.sigma)
+
+        # The cooked images and idf are shared read-only: inherited when workers are forked, otherwise sent once
+        # to each worker.  Every image is scored independently, so the result is the same as the serial one.
+        shared = (self.ctest, self.crefs, orders, idf, self.n, self.sigma)
+        chunk_size = -(-len(self.crefs) // (4 * processes))
+        shards = [(start, min(start + chunk_size, len(self.crefs))) for start in range(0, len(self.crefs), chunk_size)]
+        pool = Pool(processes, initializer=_init_worker, initargs=(shared,))
+        try:
+            scores = pool.map(_score_shard, shards)
+        finally:
+            pool.close()
+            pool.join()
+        return np.concatenate(scores)
+
+    def compute_score(self, option=None, verbose=0, processes=1):
+        # the document frequency (idf) is counted as references are added
         # assert to check document frequency
-        assert(len(self.ctest) >= max(self.document_frequency.values()))
+        if isinstance(self.document_frequency, dict):
+            assert(len(self.ctest) >= max(self.document_frequency.values()))
         # compute cider score
-        score = self.compute_cider()
+        score = self.compute_cider(processes)
         # debug
         # print score
-        return np.mean(np.array(score)), np.array(score)
\ No newline at end of file
+        return np.mean(np.array(score)), np.array(score)
+
+
+def tfidf(counts, idf, orders, n=4):
+    """
+    Maps counts of n-grams to tf-idf weights for many sentences at once.
+    :param counts: list of NgramCounts : n-gram counts of each sentence
+    :param idf: array of float : idf of each n-gram id
+    :param orders: array of int : order of each n-gram id
+    :param n: int : maximum n-gram order
+    :return: vecs (list of csr_matrix), norms (array of float), lengths (array of float)
+        vecs[k] holds the weights of the (k+1)-grams with one row per sentence,
+        norms[i, k] is the norm of row i of vecs[k] and lengths[i] the length of sentence i
+    """
+    num_rows = len(counts)
+    lens = np.fromiter((len(c.ngrams) for c in counts), dtype=np.int64, count=num_rows)
+    rows = np.repeat(np.arange(num_rows), lens)
+    ngrams = np.concatenate([c.ngrams for c in counts]) if num_rows else np.zeros(0, dtype=np.int64)
+    term_freq = np.concatenate([c.counts for c in counts]).astype(np.float64) if num_rows else np.zeros(0)
+    orders = orders[ngrams]
+    # tf (term_freq) * idf (precomputed idf) for n-grams
+    weights = term_freq * idf[ngrams]
+
+    # the norms will be used for computing similarity
+    norms = np.bincount(rows * n + orders - 1, weights=weights ** 2, minlength=num_rows * n)
+    norms = np.sqrt(norms[:num_rows * n].reshape(num_rows, n))
+    # as in the original implementation, the length of a sentence is its number of bigrams
+    bigrams = orders == 2
+    lengths = np.bincount(rows[bigrams], weights=term_freq[bigrams], minlength=num_rows)
+
+    vecs = []
+    for k in range(1, n + 1):
+        mask = orders == k
+        vecs.append(sp.csr_matrix((weights[mask], (rows[mask], ngrams[mask])),
+                                  shape=(num_rows, len(idf))))
+    return vecs, norms, lengths
+
+
+def cider_scores(ctest, crefs, orders, idf, n=4, sigma=6.0, block_size=BLOCK_SIZE):
+    """
+    :param ctest: list of NgramCounts : cooked hypothesis of each image
+    :param crefs: list of list of NgramCounts : cooked references of each image
+    :param orders: array of int : order of each n-gram id
+    :param idf: array of float : idf of each n-gram id
+    :param block_size: int : number of images whose tf-idf matrices are built at once
+    :return: array of float : CIDEr score of each image
+    """
+    # The matrices of a block are freed before the next one is built, so the peak memory does not grow with the
+    # number of images.
+    if len(crefs) <= block_size:
+        return _block_scores(ctest, crefs, orders, idf, n, sigma)
+    return np.concatenate([_block_scores(ctest[start:start + block_size], crefs[start:start + block_size],
+                                         orders, idf, n, sigma)
+                           for start in range(0, len(crefs), block_size)])
+
+
+def _block_scores(ctest, crefs, orders, idf, n, sigma):
+    # compute vectors for test captions and for all ref captions, ref_segments maps each ref to its test
+    vec, norm, length = tfidf(ctest, idf, orders, n)
+    num_refs = np.fromiter(map(len, crefs), dtype=np.int64, count=len(crefs))
+    ref_segments = np.repeat(np.arange(len(crefs)), num_refs)
+    vec_ref, norm_ref, length_ref = tfidf([ref for refs in crefs for ref in refs], idf, orders, n)
+
+    # cosine similarity of each ref with its test, for each n-gram order
+    val = np.zeros((len(ref_segments), n))
+    for k in range(n):
+        vec_hyp = vec[k][ref_segments]
+        # vrama91 : added clipping
+        val[:, k] = np.asarray(vec_hyp.minimum(vec_ref[k]).multiply(vec_ref[k]).sum(axis=1)).ravel()
+    norms = norm[ref_segments] * norm_ref
+    nonzero = norms != 0
+    val[nonzero] /= norms[nonzero]
+    assert(not np.any(np.isnan(val)))
+    # vrama91: added a length based gaussian penalty
+    delta = length[ref_segments] - length_ref
+    val *= (np.e**(-(delta**2)/(2*sigma**2)))[:, None]
+
+    # sum over the refs of each image
+    score = np.add.reduceat(val, np.cumsum(num_refs) - num_refs, axis=0) if len(val) else val
+    # change by vrama91 - mean of ngram scores, instead of sum
+    score_avg = np.mean(score, axis=1)
+    # divide by number of references
+    score_avg /= num_refs
+    # multiply score by 10
+    score_avg *= 10.0
+    return score_avg
+
+
+# (ctest, crefs, orders, idf, n, sigma) in worker processes of `CiderScorer.compute_cider`
+_shared = None
+
+
+def _init_worker(shared):
+    global _shared
+    _shared = shared
+
+
+def _score_shard(shard):
+    start, stop = shard
+    ctest, crefs = _shared[:2]
+    return cider_scores(ctest[start:stop], crefs[start:stop], *_shared[2:])
@@ -0,0 +1,112 @@
+# Filename: document_frequency.py
+#
+# Description: Document frequencies of n-grams computed once from a reference corpus, so that CIDEr
+#               can score a few segments (even a single one) with the idf of the full corpus.
+#               This is the "coco-val-df" mode of vrama91/coco-caption for any corpus.
+
+import itertools
+
+import numpy as np
+
+from .. import ngrams
+
+VERSION = 1
+
+# Number of segments `DocumentFrequency.from_references` counts the n-grams of at once
+CHUNK_SIZE = 1024
+
+
+class DocumentFrequency(object):
+    """
+    Frozen CIDEr document frequencies.
+    """
+
+    def __init__(self, index, frequencies, num_documents, n=4):
+        """
+        :param index: NgramIndex : the n-grams of the reference corpus
+        :param frequencies: array of float : number of segments each n-gram id of index appears in
+        :param num_documents: int : number of segments of the reference corpus
+        :param n: int : maximum n-gram order
+        """
+        self.index = index
+        self.frequencies = np.asarray(frequencies, dtype=np.float64)
+        self.num_documents = num_documents
+        self.n = n
+
+    @property
+    def ref_len(self):
+        """
+        :return: float : log of the number of segments, the idf of an n-gram which appears nowhere
+        """
+        return np.log(float(self.num_documents))
+
+    @classmethod
+    def from_references(cls, references, n=4):
+        """
+        :param references: iterable of list of str : the references of each segment
+        :param n: int : maximum n-gram order
+        """
+        index = ngrams.NgramIndex()
+        frequencies = np.zeros(0, dtype=np.float64)
+        num_documents = 0
+        references = iter(references)
+        while True:
+            # the references of a chunk of segments are counted at once
+            chunk = list(itertools.islice(references, CHUNK_SIZE))
+            if not chunk:
+                break
+            counts = index.count_many([index.intern_tokens(ref.split()) for refs in chunk for ref in refs], n)
+            segments = np.repeat(np.arange(len(chunk), dtype=np.int64), [len(refs) for refs in chunk])
+            segments = np.repeat(segments, [len(c.ngrams) for c in counts])
+            # the distinct n-grams of every segment
+            ngram_ids = np.concatenate([np.zeros(0, dtype=np.int64)] + [c.ngrams for c in counts])
+            ngram_ids = np.unique(segments * len(index) + ngram_ids) % len(index) if len(index) else ngram_ids
+            frequencies = np.concatenate([frequencies, np.zeros(len(index) - len(frequencies))])
+            frequencies += np.bincount(ngram_ids, minlength=len(index))
+            num_documents += len(chunk)
+        return cls(index, frequencies, num_documents, n)
+
+    def save(self, path):
+        """
+        Save to a compressed `.npz` file.
+        """
+        tokens, orders, prefixes, last_tokens = self.index.to_arrays()
+        tokens = np.frombuffer(u'\n'.join(tokens).encode('utf-8'), dtype=np.uint8)
+        with open(path, 'wb') as f:
+            np.savez_compressed(f, version=VERSION, n=self.n, num_documents=self.num_documents,
+                                tokens=tokens, orders=orders, prefixes=prefixes.astype(np.int32),
+                                last_tokens=last_tokens.astype(np.int32),
+                                frequencies=self.frequencies.astype(np.int32))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if int(data['version']) != VERSION:
+                raise ValueError("Unsupported document frequency version {} in {}, expected {}.".format(
+                    int(data['version']), path, VERSION))
+            tokens = data['tokens'].tobytes().decode('utf-8')
+            tokens = tokens.split(u'\n') if tokens else []
+            index = ngrams.NgramIndex.from_arrays(tokens, data['orders'], data['prefixes'], data['last_tokens'])
+            return cls(index, data['frequencies'], int(data['num_documents']), int(data['n']))
+
+    def lookup(self, index):
+        """
+        :param index: NgramIndex : n-grams to look up, e.g. those of the segments being scored
+        :return: array of float : document frequency of each n-gram id of index, 0 for unseen n-grams
+        """
+        orders, prefixes, last_tokens = (np.asarray(a, dtype=np.int64)
+                                         for a in (index.orders, index.prefixes, index.last_tokens))
+        token_ids = self.index.token_ids
+        tokens = np.array([token_ids.get(t, -1) for t in index.tokens], dtype=np.int64)
+        # the id of each n-gram of index in self.index, prefixes always have a lower order
+        ids = np.full(len(index), -1, dtype=np.int64)
+        for k in range(1, (int(orders.max()) if len(orders) else 0) + 1):
+            g = np.flatnonzero(orders == k)
+            prefix = ids[prefixes[g]] if k > 1 else np.full(len(g), -1, dtype=np.int64)
+            token = tokens[last_tokens[g]]
+            known = (token >= 0) & ((prefix >= 0) | (k == 1))
+            keys = ((prefix[known] + 1) << 32) | token[known]
+            ids[g[known]] = self.index.lookup(keys)
+        result = np.zeros(len(index), dtype=np.float64)
+        result[ids >= 0] = self.frequencies[ids[ids >= 0]]
+        return result
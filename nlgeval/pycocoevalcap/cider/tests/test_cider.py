@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from nlgeval.pycocoevalcap.cider.cider import Cider
+from nlgeval.pycocoevalcap.cider.cider_scorer import CiderScorer, cider_scores
+from nlgeval.pycocoevalcap.cider.document_frequency import DocumentFrequency
+
+EXAMPLES = os.path.join(os.path.dirname(__file__), '..', '..', '..', '..', 'examples')
+
+
+def read_lines(name):
+    with open(os.path.join(EXAMPLES, name), 'r') as f:
+        return [line.strip() for line in f]
+
+
+class TestCider(unittest.TestCase):
+    def test_compute_score(self):
+        hyps = read_lines('hyp.txt')
+        refs = list(zip(read_lines('ref1.txt'), read_lines('ref2.txt')))
+        score, scores = Cider().compute_score({i: list(r) for i, r in enumerate(refs)},
+                                              {i: [h] for i, h in enumerate(hyps)})
+        self.assertAlmostEqual(1.242192, score, places=5)
+        self.assertEqual(len(hyps), len(scores))
+        self.assertAlmostEqual(score, np.mean(scores))
+
+    def test_no_overlap(self):
+        score, scores = Cider().compute_score({0: ["a b c"], 1: ["d e f"]}, {0: ["x y z"], 1: [""]})
+        self.assertEqual(0.0, score)
+        np.testing.assert_array_equal([0.0, 0.0], scores)
+
+    def test_document_frequency(self):
+        hyps = read_lines('hyp.txt')
+        refs = [list(r) for r in zip(read_lines('ref1.txt'), read_lines('ref2.txt'))]
+        gts = {i: r for i, r in enumerate(refs)}
+        res = {i: [h] for i, h in enumerate(hyps)}
+        path = tempfile.mkdtemp()
+        try:
+            df_path = os.path.join(path, 'df.npz')
+            DocumentFrequency.from_references(refs).save(df_path)
+            cider = Cider(document_frequency=df_path)
+        finally:
+            shutil.rmtree(path)
+
+        # The same as computing them from the whole corpus.
+        score, scores = cider.compute_score(gts, res)
+        np.testing.assert_allclose(Cider().compute_score(gts, res)[1], scores)
+
+        # A single example is scored with the document frequencies of the whole corpus.
+        self.assertEqual(0.0, Cider().compute_score({0: gts[1]}, {0: res[1]})[0])
+        self.assertAlmostEqual(scores[1], cider.compute_score({0: gts[1]}, {0: res[1]})[0])
+
+    def test_incremental(self):
+        hyps = read_lines('hyp.txt')
+        refs = [list(r) for r in zip(read_lines('ref1.txt'), read_lines('ref2.txt'))]
+        expected = Cider().compute_score({i: r for i, r in enumerate(refs)}, {i: [h] for i, h in enumerate(hyps)})[1]
+
+        cider_scorer = CiderScorer()
+        other = CiderScorer()
+        for i, (hyp, ref) in enumerate(zip(hyps, refs)):
+            if i < 1:
+                cider_scorer += (hyp, ref)
+            else:
+                other += (hyp, ref)
+        score_a = cider_scorer.compute_score()[1]
+        # Scoring again does not count the document frequencies twice.
+        np.testing.assert_array_equal(score_a, cider_scorer.compute_score()[1])
+        cider_scorer += other
+        np.testing.assert_allclose(expected, cider_scorer.compute_score()[1])
+        np.testing.assert_allclose(expected, cider_scorer.copy().compute_score()[1])
+
+    def test_processes(self):
+        gts = {i: ["a b c d %d" % (i % 3), "b c d e"] for i in range(20)}
+        res = {i: ["a b c %d e" % (i % 5)] for i in range(20)}
+        score, scores = Cider().compute_score(gts, res)
+        parallel_score, parallel_scores = Cider(processes=2).compute_score(gts, res)
+        self.assertEqual(score, parallel_score)
+        np.testing.assert_array_equal(scores, parallel_scores)
+
+    def test_blocks(self):
+        cider_scorer = CiderScorer()
+        for i in range(20):
+            cider_scorer += ("a b c %d e" % (i % 5), ["a b c d %d" % (i % 3), "b c d e"][:1 + i % 2])
+        scores = cider_scorer.compute_score()[1]
+        orders = np.asarray(cider_scorer.index.orders, dtype=np.int64)
+        idf = cider_scorer.idf()
+        for block_size in (1, 3, 20):
+            np.testing.assert_allclose(scores, cider_scores(cider_scorer.ctest, cider_scorer.crefs, orders, idf,
+                                                            block_size=block_size))
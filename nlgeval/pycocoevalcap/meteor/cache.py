@@ -0,0 +1,13 @@
+#!/usr/bin/env python
+
+# Persistent cache of METEOR segment statistics.
+#
+# The stats line METEOR returns for a SCORE line depends only on that line (and the METEOR version and options),
+# so re-scoring unchanged segments only needs the EVAL step, which combines the stats of all segments into the scores.
+from ..segment_cache import SegmentCache
+
+
+class MeteorStatsCache(SegmentCache):
+    """
+    SCORE line -> stats line, stored in an SQLite database which can be shared by processes.
+    """
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+# A long-lived METEOR process shared by the `Meteor` scorers of any process on the machine.
+#
+# Starting METEOR loads its paraphrase tables, which takes seconds and about 2GB of memory.
+# `MeteorDaemon` keeps warm JVMs behind a Unix domain socket, started with `nlg-eval meteor-daemon`,
+# and `Meteor(daemon_address=...)` (or the NLGEVAL_METEOR_DAEMON environment variable) scores through it.
+#
+# The protocol is one JSON object per line.  Each request has an id, so a client can send requests
+# from several threads over one connection and receive the responses in any order:
+#   {"id": 1, "method": "stats", "lines": [SCORE lines]}  ->  {"id": 1, "result": [stats lines]}
+#   {"id": 2, "method": "eval", "lines": [stats lines]}   ->  {"id": 2, "result": [score, [scores]]}
+# A failed request is answered with {"id": ..., "error": "..."}.
+from __future__ import division
+
+import itertools
+import json
+import logging
+import os
+import socket
+import threading
+
+from six.moves import socketserver
+
+from .meteor import Meteor, dec, enc
+
+
+class MeteorDaemonException(Exception):
+    pass
+
+
+class MeteorClient(object):
+    """
+    A connection to a `MeteorDaemon`, which can be shared by threads.
+    """
+
+    def __init__(self, address):
+        """
+        :param address: str : path of the Unix domain socket of the daemon
+        """
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(address)
+        except socket.error as e:
+            self.sock.close()
+            raise MeteorDaemonException("Could not connect to the METEOR daemon at {}: {}".format(address, e))
+        self.address = address
+        self.rfile = self.sock.makefile('rb')
+        self.send_lock = threading.Lock()
+        # Requests waiting for their response: id -> [event, response]
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.closed = False
+        self.ids = itertools.count()
+        self.reader = threading.Thread(target=self._read)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def request(self, method, lines):
+        """
+        :param method: str : 'stats' or 'eval'
+        :param lines: list of str : SCORE lines for 'stats', stats lines for 'eval'
+        :return: the result of the method
+        """
+        slot = [threading.Event(), None]
+        with self.pending_lock:
+            if self.closed:
+                raise MeteorDaemonException("The connection to the METEOR daemon at {} is closed.".format(self.address))
+            request_id = next(self.ids)
+            self.pending[request_id] = slot
+        message = json.dumps(dict(id=request_id, method=method, lines=lines))
+        try:
+            with self.send_lock:
+                self.sock.sendall(enc(message + '\n'))
+        except socket.error:
+            with self.pending_lock:
+                self.pending.pop(request_id, None)
+            raise
+        slot[0].wait()
+        response = slot[1]
+        if response is None:
+            raise MeteorDaemonException("The METEOR daemon at {} closed the connection.".format(self.address))
+        if 'error' in response:
+            raise MeteorDaemonException("Error from the METEOR daemon: {}".format(response['error']))
+        return response['result']
+
+    def _read(self):
+        try:
+            for line in self.rfile:
+                response = json.loads(dec(line))
+                with self.pending_lock:
+                    slot = self.pending.pop(response['id'], None)
+                if slot is not None:
+                    slot[1] = response
+                    slot[0].set()
+        except (socket.error, ValueError):
+            logging.exception("Error reading from the METEOR daemon at %s.", self.address)
+        finally:
+            with self.pending_lock:
+                self.closed = True
+                for slot in self.pending.values():
+                    slot[0].set()
+                self.pending.clear()
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+        self.reader.join()
+        self.rfile.close()
+
+
+class _MeteorRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        write_lock = threading.Lock()
+        threads = []
+        for line in self.rfile:
+            # Answer each request in its own thread, so one connection can have several requests in flight.
+            thread = threading.Thread(target=self._respond, args=(line, write_lock))
+            thread.daemon = True
+            thread.start()
+            threads = [t for t in threads if t.is_alive()] + [thread]
+        # The connection is closed once this returns.
+        for thread in threads:
+            thread.join()
+
+    def _respond(self, line, write_lock):
+        meteor = self.server.meteor
+        response = {}
+        try:
+            request = json.loads(dec(line))
+            response['id'] = request.get('id')
+            if request.get('method') == 'stats':
+                response['result'] = meteor.segment_stats(request['lines'])
+            elif request.get('method') == 'eval':
+                response['result'] = meteor.evaluate(request['lines'])
+            else:
+                raise ValueError("Unknown method: {}".format(request.get('method')))
+        except Exception as e:
+            logging.exception("Error handling a METEOR request.")
+            response['error'] = "{}: {}".format(type(e).__name__, e)
+        try:
+            with write_lock:
+                self.wfile.write(enc(json.dumps(response) + '\n'))
+                self.wfile.flush()
+        except socket.error:
+            # The client is gone.
+            pass
+
+
+class MeteorDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serve a warm `Meteor` on a Unix domain socket until `shutdown` is called.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, processes=1):
+        """
+        :param address: str : path of the Unix domain socket to listen on, a stale socket file is replaced
+        :param processes: int : number of METEOR JVMs to score with
+        """
+        if os.path.exists(address):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(address)
+            except socket.error:
+                os.remove(address)
+            else:
+                raise MeteorDaemonException("A METEOR daemon is already listening at {}.".format(address))
+            finally:
+                probe.close()
+        self.meteor = Meteor(processes=processes, daemon_address='')
+        socketserver.UnixStreamServer.__init__(self, address, _MeteorRequestHandler)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        self.meteor.close()
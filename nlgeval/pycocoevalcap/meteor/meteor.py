@@ -9,13 +9,20 @@ import logging
 import os
 import re
 import subprocess
-import sys
 import threading
+from collections import OrderedDict, deque
 
 import psutil
 
+from .cache import MeteorStatsCache
+
 # Assumes meteor-1.5.jar is in the same directory as meteor.py.  Change as needed.
 METEOR_JAR = 'meteor-1.5.jar'
+METEOR_ARGS = ['-', '-', '-stdio', '-l', 'en', '-norm']
+# Unix domain socket of a `nlg-eval meteor-daemon` for `Meteor` to score with by default, see daemon.py
+DAEMON_ENV = 'NLGEVAL_METEOR_DAEMON'
+# Number of lines of METEOR's stderr to keep for error messages
+STDERR_LINES = 100
 
 
 def enc(s):
@@ -26,104 +33,373 @@ def dec(s):
     return s.decode('utf-8')
 
 
+class MeteorException(Exception):
+    """
+    METEOR exited, stopped answering or gave an unexpected answer.
+    """
+
+    def __init__(self, message, stderr=''):
+        if stderr:
+            message = "{}\nLast lines of METEOR's stderr:\n{}".format(message, stderr)
+        super(MeteorException, self).__init__(message)
+        self.stderr = stderr
+
+
+def _drain(stream, lines):
+    # Read stderr continuously, so METEOR never blocks on a full pipe, and keep the last lines.
+    for line in iter(stream.readline, b''):
+        lines.append(line.decode('utf-8', 'replace').rstrip())
+
+
 class Meteor:
 
-    def __init__(self):
+    def __init__(self, processes=1, daemon_address=None, cache=None, timeout=600, restarts=2):
+        """
+        :param processes: int : number of METEOR JVMs to score with, each one needs up to 2GB of memory
+        :param daemon_address: str : Unix domain socket of a METEOR daemon to score with instead of starting JVMs.
+            Default: the NLGEVAL_METEOR_DAEMON environment variable, if it is set. Pass '' to always start JVMs.
+        :param cache: str or MeteorStatsCache : path of a cache of segment statistics, only segments which are not
+            in the cache are sent to METEOR. Default: no cache.
+        :param timeout: float : seconds METEOR may go without answering a line before it is killed, None to wait forever
+        :param restarts: int : number of times a request is replayed on a new METEOR process after METEOR failed
+        """
         # Used to guarantee thread safety
         self.lock = threading.Lock()
+        self.client = None
+        self.meteor_ps = []
+        self.meteor_p = None
+        self.cache = None
+        self.timeout = timeout
+        self.restarts = restarts
+        # process -> (thread draining its stderr, last lines of its stderr)
+        self._stderr = {}
+        # Caches given by path are closed with this scorer.
+        self._owns_cache = cache is not None and not isinstance(cache, MeteorStatsCache)
+        if self._owns_cache:
+            cache = MeteorStatsCache(cache)
+        self.cache = cache
+        # Whether the cache was given by path or not, its stats are only valid for this METEOR version and options.
+        self._cache_namespace = ' '.join([METEOR_JAR] + METEOR_ARGS)
+
+        daemon_required = daemon_address is not None
+        if daemon_address is None:
+            daemon_address = os.environ.get(DAEMON_ENV)
+        if daemon_address:
+            from .daemon import MeteorClient, MeteorDaemonException
+            try:
+                self.client = MeteorClient(daemon_address)
+            except MeteorDaemonException:
+                if daemon_required:
+                    raise
+                logging.warning("Could not connect to the METEOR daemon at %s, starting METEOR instead.",
+                                daemon_address, exc_info=True)
+            else:
+                atexit.register(self.close)
+                return
 
         mem = '2G'
         mem_available_G = psutil.virtual_memory().available / 1E9
-        if mem_available_G < 2:
-            logging.warning("There is less than 2GB of available memory.\n"
+        if mem_available_G < 2 * processes:
+            logging.warning("There is less than 2GB of available memory per Meteor process.\n"
                             "Will try with limiting Meteor to 1GB of memory but this might cause issues.\n"
                             "If you have problems using Meteor, "
-                            "then you can try to lower the `mem` variable in meteor.py")
+                            "then you can try to lower the `mem` variable in meteor.py "
+                            "or to use fewer processes")
             mem = '1G'
 
-        meteor_cmd = ['java', '-jar', '-Xmx{}'.format(mem), METEOR_JAR,
-                      '-', '-', '-stdio', '-l', 'en', '-norm']
+        self.meteor_cmd = ['java', '-jar', '-Xmx{}'.format(mem), METEOR_JAR] + METEOR_ARGS
+        # The JVMs load their paraphrase tables concurrently.
+        self.meteor_ps = [self._start() for _ in range(processes)]
+        # The first process also computes the corpus scores.
+        self.meteor_p = self.meteor_ps[0]
+
+        atexit.register(self.close)
+
+    def _start(self):
         env = os.environ.copy()
         env['LC_ALL'] = "C"
-        self.meteor_p = subprocess.Popen(meteor_cmd,
-                                         cwd=os.path.dirname(os.path.abspath(__file__)),
-                                         env=env,
-                                         stdin=subprocess.PIPE,
-                                         stdout=subprocess.PIPE,
-                                         stderr=subprocess.PIPE)
+        meteor_p = subprocess.Popen(self.meteor_cmd,
+                                    cwd=os.path.dirname(os.path.abspath(__file__)),
+                                    env=env,
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+        lines = deque(maxlen=STDERR_LINES)
+        drain = threading.Thread(target=_drain, args=(meteor_p.stderr, lines))
+        drain.daemon = True
+        drain.start()
+        self._stderr[meteor_p] = (drain, lines)
+        return meteor_p
 
-        atexit.register(self.close)
+    def _stop(self, meteor_p):
+        if meteor_p.poll() is None:
+            meteor_p.kill()
+        meteor_p.wait()
+        drain, _ = self._stderr.pop(meteor_p, (None, None))
+        if drain is not None:
+            drain.join()
+
+    def _restart(self, i):
+        """
+        Replace the i-th METEOR process with a new one.
+        """
+        self._stop(self.meteor_ps[i])
+        meteor_p = self.meteor_ps[i] = self._start()
+        if i == 0:
+            self.meteor_p = meteor_p
+        return meteor_p
+
+    def _stderr_tail(self, meteor_p):
+        drain, lines = self._stderr.get(meteor_p, (None, ()))
+        if drain is not None and meteor_p.poll() is not None:
+            # Let the last lines of a process which exited arrive.
+            drain.join(1)
+        return '\n'.join(lines)
 
     def close(self):
         with self.lock:
+            if self.client:
+                # The daemon keeps running.
+                self.client.close()
+                self.client = None
             if self.meteor_p:
-                self.meteor_p.kill()
-                self.meteor_p.wait()
+                for meteor_p in self.meteor_ps:
+                    self._stop(meteor_p)
+                self.meteor_ps = []
                 self.meteor_p = None
+            if self._owns_cache and self.cache is not None:
+                self.cache.close()
+                self.cache = None
         # if the user calls close() manually, remove the
         # reference from atexit so the object can be garbage-collected.
-        if atexit is not None and atexit.unregister is not None:
+        if atexit is not None and getattr(atexit, "unregister", None) is not None:
             atexit.unregister(self.close)
 
     def compute_score(self, gts, res):
         assert (gts.keys() == res.keys())
         imgIds = gts.keys()
-        scores = []
 
-        eval_line = 'EVAL'
+        score_lines = []
+        for i in imgIds:
+            assert (len(res[i]) == 1)
+            score_lines.append(self._score_line(res[i][0], gts[i]))
+
+        stats = self.segment_stats(score_lines)
+        score, scores = self.evaluate(stats)
+
+        return score, scores
+
+    def segment_stats(self, score_lines):
+        """
+        :param score_lines: list of str : see `_score_line`
+        :return: list of str : the stats line of each segment
+        """
+        if self.cache is None:
+            return self._segment_stats(score_lines)
+
+        stats = self.cache.get_many(score_lines, self._cache_namespace)
+        # Each distinct segment which is not in the cache is scored once.
+        misses = list(OrderedDict.fromkeys(score_line for score_line, stat in zip(score_lines, stats) if stat is None))
+        if misses:
+            fresh = self._segment_stats(misses)
+            self.cache.put_many(misses, fresh, self._cache_namespace)
+            fresh = dict(zip(misses, fresh))
+            stats = [stat if stat is not None else fresh[score_line]
+                     for score_line, stat in zip(score_lines, stats)]
+        return stats
+
+    def _segment_stats(self, score_lines):
+        if self.client is not None:
+            return self.client.request('stats', score_lines)
         with self.lock:
-            for i in imgIds:
-                assert (len(res[i]) == 1)
-                stat = self._stat(res[i][0], gts[i])
-                eval_line += ' ||| {}'.format(stat)
-
-            self.meteor_p.stdin.write(enc('{}\n'.format(eval_line)))
-            self.meteor_p.stdin.flush()
-            for i in range(0, len(imgIds)):
-                v = self.meteor_p.stdout.readline()
-                try:
-                    scores.append(float(dec(v.strip())))
-                except:
-                    sys.stderr.write("Error handling value: {}\n".format(v))
-                    sys.stderr.write("Decoded value: {}\n".format(dec(v.strip())))
-                    sys.stderr.write("eval_line: {}\n".format(eval_line))
-                    # You can try uncommenting the next code line to show stderr from the Meteor JAR.
-                    # If the Meteor JAR is not writing to stderr, then the line will just hang.
-                    # sys.stderr.write("Error from Meteor:\n{}".format(self.meteor_p.stderr.read()))
+            return self._sharded_stats(score_lines)
+
+    def evaluate(self, stats):
+        """
+        :param stats: list of str : the stats line of each segment
+        :return: (float, list of float) : the corpus score and the score of each segment
+        """
+        if self.client is not None:
+            score, scores = self.client.request('eval', stats)
+            return score, scores
+        with self.lock:
+            # The stats of all segments are combined by one process, so the corpus score is the same
+            # as when scoring with a single process.
+            return self._eval(stats)
+
+    def _sharded_stats(self, score_lines):
+        """
+        Split the segments in contiguous shards, one per process, and collect their stats in order.
+        :param score_lines: list of str : see `_score_line`
+        :return: list of str : the stats line of each segment
+        """
+        chunk_size = max(1, -(-len(score_lines) // len(self.meteor_ps)))
+        shards = [score_lines[start:start + chunk_size] for start in range(0, len(score_lines), chunk_size)]
+        if len(shards) <= 1:
+            return self._stats(score_lines)
+
+        results = [None] * len(shards)
+        errors = []
+
+        def score_shard(i):
+            try:
+                results[i] = self._stats(shards[i], i)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=score_shard, args=(i,)) for i in range(1, len(shards))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        score_shard(0)
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return [stat for result in results for stat in result]
+
+    def _stats(self, score_lines, i=0):
+        """
+        :param score_lines: list of str : see `_score_line`
+        :param i: int : index of the process to score with
+        :return: list of str : the stats line of each segment
+        """
+        return self._run(i, lambda meteor_p: self._request(meteor_p, score_lines, len(score_lines)))
+
+    def _eval(self, stats):
+        """
+        :param stats: list of str : the stats line of each segment
+        :return: (float, list of float) : the corpus score and the score of each segment
+        """
+        eval_line = ' ||| '.join(['EVAL'] + stats)
+
+        def request(meteor_p):
+            # The score of each segment and then the corpus score
+            values = self._request(meteor_p, [eval_line], len(stats) + 1)
+            try:
+                values = [float(v) for v in values]
+            except ValueError as e:
+                raise MeteorException("Unexpected answer from METEOR to EVAL: {}".format(e),
+                                      self._stderr_tail(meteor_p))
+            return values[-1], values[:-1]
+
+        return self._run(0, request)
+
+    def _run(self, i, request):
+        """
+        Run a request with the i-th process, and replay it on a new process if METEOR fails.
+        :param i: int : index of the process in `meteor_ps`
+        :param request: function : called with the process, raises MeteorException if METEOR fails
+        :return: the result of the request
+        """
+        for attempt in range(self.restarts + 1):
+            meteor_p = self.meteor_ps[i]
+            if meteor_p.poll() is not None:
+                logging.warning("%s Restarting it.",
+                                MeteorException("METEOR exited with code {}.".format(meteor_p.returncode),
+                                                self._stderr_tail(meteor_p)))
+                meteor_p = self._restart(i)
+            try:
+                return request(meteor_p)
+            except MeteorException as e:
+                if attempt == self.restarts:
                     raise
-            score = float(dec(self.meteor_p.stdout.readline()).strip())
+                logging.warning("Restarting METEOR and replaying the request after: %s", e)
+                self._restart(i)
 
-        return score, scores
+    def _request(self, meteor_p, lines, num_answers):
+        """
+        Send lines to METEOR and read its answers.
+        All lines are sent at once instead of waiting for the answer to each one before sending the next.
+        A writer thread streams the lines while this thread reads the answers, so neither side of the pipes can fill
+        up while the other one waits.
+        METEOR is killed if it does not answer within `timeout` seconds.
+        :param meteor_p: subprocess.Popen
+        :param lines: list of str
+        :param num_answers: int : number of lines METEOR answers with
+        :return: list of str : the answers
+        """
+        write_errors = []
+
+        def write():
+            try:
+                for line in lines:
+                    meteor_p.stdin.write(enc(line))
+                    meteor_p.stdin.write(enc('\n'))
+                meteor_p.stdin.flush()
+            except (IOError, OSError):
+                # e.g. a broken pipe, the reader sees the end of stdout.
+                pass
+            except Exception as e:
+                # METEOR is still waiting for the lines which were not sent, stop it so the reader sees the end of
+                # stdout.
+                write_errors.append(e)
+                if meteor_p.poll() is None:
+                    meteor_p.kill()
+
+        writer = threading.Thread(target=write)
+        writer.daemon = True
+        writer.start()
+
+        answers = []
+        done = threading.Event()
+        timed_out = []
+
+        def watch():
+            # Check for progress every `timeout` seconds.
+            last = 0
+            while not done.wait(self.timeout):
+                if len(answers) == last:
+                    timed_out.append(True)
+                    meteor_p.kill()
+                    return
+                last = len(answers)
+
+        if self.timeout is not None:
+            watchdog = threading.Thread(target=watch)
+            watchdog.daemon = True
+            watchdog.start()
+        try:
+            for _ in range(num_answers):
+                answer = meteor_p.stdout.readline()
+                if not answer:
+                    break
+                answers.append(dec(answer).strip())
+        finally:
+            done.set()
+            if len(answers) < num_answers and meteor_p.poll() is None:
+                # Stop the writer.
+                meteor_p.kill()
+            writer.join()
+            if self.timeout is not None:
+                watchdog.join()
+
+        if len(answers) < num_answers:
+            if write_errors:
+                # e.g. a line which cannot be encoded, replaying the request would fail again.
+                raise write_errors[0]
+            if timed_out:
+                reason = "did not answer within {} seconds".format(self.timeout)
+            else:
+                reason = "exited with code {}".format(meteor_p.wait())
+            raise MeteorException("METEOR {} after {} of {} answers.".format(reason, len(answers), num_answers),
+                                  self._stderr_tail(meteor_p))
+        return answers
 
     def method(self):
         return "METEOR"
 
-    def _stat(self, hypothesis_str, reference_list):
+    @staticmethod
+    def _score_line(hypothesis_str, reference_list):
         # SCORE ||| reference 1 words ||| reference n words ||| hypothesis words
         hypothesis_str = hypothesis_str.replace('|||', '')
         score_line = ' ||| '.join(('SCORE', ' ||| '.join(reference_list), hypothesis_str))
-        score_line = re.sub(r'\s+', ' ', score_line)
-        self.meteor_p.stdin.write(enc(score_line))
-        self.meteor_p.stdin.write(enc('\n'))
-        self.meteor_p.stdin.flush()
-        return dec(self.meteor_p.stdout.readline()).strip()
+        return re.sub(r'\s+', ' ', score_line)
 
     def _score(self, hypothesis_str, reference_list):
-        with self.lock:
-            # SCORE ||| reference 1 words ||| reference n words ||| hypothesis words
-            hypothesis_str = hypothesis_str.replace('|||', '').replace('  ', ' ')
-            score_line = ' ||| '.join(('SCORE', ' ||| '.join(reference_list), hypothesis_str))
-            self.meteor_p.stdin.write(enc('{}\n'.format(score_line)))
-            self.meteor_p.stdin.flush()
-            stats = dec(self.meteor_p.stdout.readline()).strip()
-            eval_line = 'EVAL ||| {}'.format(stats)
-            # EVAL ||| stats 
-            self.meteor_p.stdin.write(enc('{}\n'.format(eval_line)))
-            self.meteor_p.stdin.flush()
-            score = float(dec(self.meteor_p.stdout.readline()).strip())
-            # bug fix: there are two values returned by the jar file, one average, and one all, so do it twice
-            # thanks for Andrej for pointing this out
-            score = float(dec(self.meteor_p.stdout.readline()).strip())
+        # Scored like a corpus of one segment, with the cache, daemon, timeouts and restarts of `compute_score`.
+        stats = self.segment_stats([self._score_line(hypothesis_str, reference_list)])
+        score, _ = self.evaluate(stats)
         return score
 
     def __del__(self):
@@ -1,9 +1,171 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import errno
+import os
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
 import unittest
+from collections import deque
 
-from nlgeval.pycocoevalcap.meteor.meteor import Meteor
+from nlgeval.pycocoevalcap.meteor.cache import MeteorStatsCache
+from nlgeval.pycocoevalcap.meteor.daemon import MeteorDaemon
+from nlgeval.pycocoevalcap.meteor.meteor import Meteor, MeteorException
+
+
+class EchoProcess(object):
+    """
+    Stands in for a METEOR process: answers each line written to stdin with "stats" and the line on a real pipe.
+    """
+
+    def __init__(self, exit_after=None, write_error_after=None, answer=True, delay=0):
+        """
+        :param exit_after: int : exit with code 1 after answering this many lines, writing more is a broken pipe
+        :param write_error_after: int : writing raises RuntimeError after this many lines, as a bug of the writer would
+        :param answer: bool : False to never answer
+        :param delay: float : maximum seconds to wait before each answer
+        """
+        self.exit_after = exit_after
+        self.write_error_after = write_error_after
+        self.answer = answer
+        self.delay = delay
+        self.returncode = None
+        self.num_lines = 0
+        self.stdin = self
+        read_fd, self._write_fd = os.pipe()
+        self.stdout = os.fdopen(read_fd, 'rb')
+        self._buffer = b''
+        self._lock = threading.Lock()
+
+    def write(self, data):
+        if self.returncode is not None:
+            raise IOError(errno.EPIPE, "Broken pipe")
+        if self.write_error_after is not None and self.num_lines >= self.write_error_after:
+            raise RuntimeError("write failed")
+        self._buffer += data
+        while b'\n' in self._buffer:
+            line, self._buffer = self._buffer.split(b'\n', 1)
+            self.num_lines += 1
+            if self.delay:
+                time.sleep(random.uniform(0, self.delay))
+            with self._lock:
+                if self.answer and self.returncode is None:
+                    os.write(self._write_fd, b'stats ' + line + b'\n')
+            if self.num_lines == self.exit_after:
+                self._exit(1)
+
+    def flush(self):
+        pass
+
+    def _exit(self, code):
+        with self._lock:
+            if self.returncode is None:
+                self.returncode = code
+                os.close(self._write_fd)
+
+    def poll(self):
+        return self.returncode
+
+    def kill(self):
+        self._exit(-9)
+
+    def wait(self):
+        return self.returncode
+
+
+class EchoMeteor(Meteor):
+    """
+    Scores with `EchoProcess`es instead of METEOR.
+    """
+
+    def __init__(self, processes=1, timeout=600, restarts=0, cache=None, **kwargs):
+        self.process_kwargs = kwargs
+        self.processes = []
+        Meteor.__init__(self, processes=processes, daemon_address='', cache=cache, timeout=timeout, restarts=restarts)
+
+    def _start(self):
+        meteor_p = EchoProcess(**self.process_kwargs)
+        self._stderr[meteor_p] = (None, deque())
+        self.processes.append(meteor_p)
+        return meteor_p
+
+    def close(self):
+        Meteor.close(self)
+        for meteor_p in self.processes:
+            meteor_p.stdout.close()
+        self.processes = []
+
+
+class TestRequest(unittest.TestCase):
+    def setUp(self):
+        self.threads = set(threading.enumerate())
+        self.lines = ['SCORE ||| reference {} ||| hypothesis {}'.format(i, i) for i in range(20000)]
+        self.expected = ['stats ' + line for line in self.lines]
+
+    def assertThreadsStopped(self):
+        self.assertEqual(set(), set(threading.enumerate()) - self.threads)
+
+    def test_order(self):
+        # More answers than a pipe holds, so the lines and answers have to be streamed concurrently.
+        m = EchoMeteor()
+        self.assertEqual(self.expected, m._request(m.meteor_p, self.lines, len(self.lines)))
+        self.assertThreadsStopped()
+        m.close()
+
+        # The shards of the processes answer at different paces.
+        m = EchoMeteor(processes=3, delay=0.0001)
+        self.assertEqual(self.expected[:3000], m.segment_stats(self.lines[:3000]))
+        self.assertThreadsStopped()
+        m.close()
+
+    def test_exit(self):
+        m = EchoMeteor(exit_after=100)
+        with self.assertRaises(MeteorException) as cm:
+            m._request(m.meteor_p, self.lines, len(self.lines))
+        self.assertIn("exited with code 1 after 100 of 20000 answers", str(cm.exception))
+        self.assertThreadsStopped()
+        m.close()
+
+    def test_write_error(self):
+        m = EchoMeteor(write_error_after=100)
+        with self.assertRaises(RuntimeError):
+            m._request(m.meteor_p, self.lines, len(self.lines))
+        # The process was stopped instead of waiting for the rest of the lines.
+        self.assertEqual(-9, m.meteor_p.poll())
+        self.assertThreadsStopped()
+        m.close()
+
+    def test_cache_namespace(self):
+        path = tempfile.mkdtemp()
+        try:
+            db = os.path.join(path, 'meteor.db')
+            cache = MeteorStatsCache(db)
+            m = EchoMeteor(cache=cache)
+            self.assertEqual(self.expected[:10], m.segment_stats(self.lines[:10]))
+            m.close()
+            # The stats are namespaced by the METEOR version and options, not stored under the bare lines.
+            self.assertEqual([None] * 10, cache.get_many(self.lines[:10]))
+            cache.close()
+
+            # A cache given by path finds the stats of a cache given as an object.
+            m = EchoMeteor(cache=db, answer=False)
+            self.assertEqual(self.expected[:10], m.segment_stats(self.lines[:10]))
+            m.close()
+            self.assertThreadsStopped()
+        finally:
+            shutil.rmtree(path)
+
+    def test_timeout(self):
+        m = EchoMeteor(answer=False, timeout=0.1)
+        with self.assertRaises(MeteorException) as cm:
+            m._request(m.meteor_p, self.lines, len(self.lines))
+        self.assertIn("did not answer within 0.1 seconds", str(cm.exception))
+        self.assertThreadsStopped()
+        m.close()
 
 
 class TestMeteor(unittest.TestCase):
@@ -15,3 +177,73 @@ class TestMeteor(unittest.TestCase):
 
         s = m.compute_score({0: ["テスト"]}, {0: ["テスト"]})
         self.assertEqual(s, (1.0, [1.0]))
+
+    def test_score(self):
+        m = Meteor(daemon_address='')
+        gts = {0: ["this is a test", "this is another test"]}
+        res = {0: ["this  is the test"]}
+        self.assertEqual(m.compute_score(gts, res)[0], m._score(res[0][0], gts[0]))
+        m.close()
+
+    def test_processes(self):
+        gts = {0: ["this is a test", "this is another test"], 1: ["a cat sat on the mat"], 2: ["テスト"]}
+        res = {0: ["this is the test"], 1: ["the cat is on a mat"], 2: ["テスト"]}
+        m = Meteor()
+        expected = m.compute_score(gts, res)
+        m.close()
+
+        m = Meteor(processes=2)
+        self.assertEqual(expected, m.compute_score(gts, res))
+        m.close()
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), "Unix domain sockets are not supported.")
+    def test_daemon(self):
+        gts = {0: ["this is a test", "this is another test"], 1: ["a cat sat on the mat"], 2: ["テスト"]}
+        res = {0: ["this is the test"], 1: ["the cat is on a mat"], 2: ["テスト"]}
+        m = Meteor(daemon_address='')
+        expected = m.compute_score(gts, res)
+        m.close()
+
+        path = tempfile.mkdtemp()
+        daemon = MeteorDaemon(os.path.join(path, 'meteor.sock'))
+        thread = threading.Thread(target=daemon.serve_forever)
+        thread.start()
+        try:
+            clients = [Meteor(daemon_address=daemon.server_address) for _ in range(2)]
+            for m in clients:
+                self.assertEqual(expected, m.compute_score(gts, res))
+                self.assertEqual(expected[1][0], m._score(res[0][0], gts[0]))
+                m.close()
+        finally:
+            daemon.shutdown()
+            thread.join()
+            daemon.server_close()
+            shutil.rmtree(path)
+
+    def test_cache(self):
+        gts = {0: ["this is a test", "this is another test"], 1: ["a cat sat on the mat"], 2: ["a cat sat on the mat"]}
+        res = {0: ["this is the test"], 1: ["the cat is on a mat"], 2: ["the cat is on a mat"]}
+        m = Meteor()
+        expected = m.compute_score(gts, res)
+        m.close()
+
+        path = tempfile.mkdtemp()
+        try:
+            cache = MeteorStatsCache(os.path.join(path, 'meteor.db'))
+            for _ in range(2):
+                m = Meteor(cache=cache)
+                self.assertEqual(expected, m.compute_score(gts, res))
+                m.close()
+                # The duplicate segment is cached once.
+                self.assertEqual(2, len(cache))
+            cache.close()
+        finally:
+            shutil.rmtree(path)
+
+    def test_restart(self):
+        m = Meteor(daemon_address='')
+        expected = m.compute_score({0: ["test"]}, {0: ["test"]})
+        m.meteor_p.kill()
+        m.meteor_p.wait()
+        self.assertEqual(expected, m.compute_score({0: ["test"]}, {0: ["test"]}))
+        m.close()
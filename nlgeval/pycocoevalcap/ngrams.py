@@ -0,0 +1,626 @@
+#!/usr/bin/env python
+#
+# File Name : ngrams.py
+#
+# Description : Shared tokenization and n-gram counting for the overlap metrics.
+#
+# BLEU, CIDEr and ROUGE-L all split each sentence on whitespace and (for BLEU and CIDEr)
+# count its n-grams.  `cook_corpus` does that work once per corpus and attaches the result
+# to the sentences themselves so every scorer can reuse it.
+#
+# N-grams are interned by an `NgramIndex` and counted by integer id instead of by tuples of
+# strings, so each distinct n-gram is stored once per corpus.  The counts of a sentence are
+# packed in two arrays, `NgramCounts`, instead of a dict of boxed integers.
+
+import array
+import itertools
+from collections import defaultdict, namedtuple
+
+import numpy as np
+import six
+from six.moves import xrange as range
+
+
+def count_ngrams(words, n=4):
+    """
+    Count all n-grams of order 1 to n in a list of tokens.
+    :param words: list of str : tokens of a sentence
+    :param n: int : maximum n-gram order
+    :return: counts (dict) : mapping of n-gram tuple to number of occurrences
+    """
+    counts = defaultdict(int)
+    for k in range(1, n + 1):
+        for i in range(len(words) - k + 1):
+            ngram = tuple(words[i:i + k])
+            counts[ngram] += 1
+    return counts
+
+
+# The counts of the n-grams of a sentence: sorted distinct n-gram ids (int64) and their counts (int32).
+NgramCounts = namedtuple('NgramCounts', ['ngrams', 'counts'])
+
+
+def pack_counts(ngram_ids):
+    """
+    :param ngram_ids: list of int : n-gram ids, each repeated as often as it occurs
+    :return: NgramCounts
+    """
+    ngrams, counts = np.unique(np.asarray(ngram_ids, dtype=np.int64), return_counts=True)
+    return NgramCounts(ngrams, counts.astype(np.int32))
+
+
+def max_counts(counts_list):
+    """
+    :param counts_list: list of NgramCounts
+    :return: NgramCounts : the maximum count of every n-gram over the list
+    """
+    if len(counts_list) == 1:
+        return counts_list[0]
+    ngrams, inverse = np.unique(np.concatenate([c.ngrams for c in counts_list]), return_inverse=True)
+    counts = np.zeros(len(ngrams), dtype=np.int32)
+    np.maximum.at(counts, inverse, np.concatenate([c.counts for c in counts_list]))
+    return NgramCounts(ngrams, counts)
+
+
+def clipped_counts(counts, max_counts):
+    """
+    :param counts: NgramCounts : e.g. of a hypothesis
+    :param max_counts: NgramCounts : e.g. the maximum counts of its references
+    :return: (ngrams, counts) : the n-grams in both, with the minimum of their counts
+    """
+    ngrams, i, j = np.intersect1d(counts.ngrams, max_counts.ngrams, assume_unique=True, return_indices=True)
+    return ngrams, np.minimum(counts.counts[i], max_counts.counts[j])
+
+
+# Keys interned since the last merge are kept in a dict until there are more than this many of them
+# and more than an eighth of the keys already in the sorted arrays.
+_MIN_MERGE = 1 << 12
+
+
+def _extend_array(a, values):
+    """
+    Append a NumPy array to an `array.array` without converting its items to Python objects.
+    """
+    data = np.asarray(values, dtype=a.typecode).tobytes()
+    if six.PY2:
+        a.fromstring(data)
+    else:
+        a.frombytes(data)
+
+
+class _IdArray(object):
+    """
+    A value for each of consecutive ids: a read-only NumPy array, which may be memory-mapped and
+    shared by several indexes, followed by an `array.array` of the values appended since.
+    """
+
+    __slots__ = 'frozen', 'tail'
+
+    def __init__(self, typecode, frozen=None):
+        self.tail = array.array(typecode)
+        self.frozen = np.zeros(0, dtype=typecode) if frozen is None else frozen
+
+    def __len__(self):
+        return len(self.frozen) + len(self.tail)
+
+    def __getitem__(self, i):
+        if i < len(self.frozen):
+            return int(self.frozen[i])
+        return self.tail[i - len(self.frozen)]
+
+    def __array__(self, dtype=None, copy=None):
+        values = self.frozen
+        if len(self.tail) > 0:
+            values = np.concatenate([values, np.frombuffer(self.tail, dtype=self.tail.typecode)])
+        if dtype is not None and values.dtype != dtype:
+            values = values.astype(dtype)
+        return values.copy() if copy else values
+
+    def append(self, value):
+        self.tail.append(value)
+
+    def extend(self, values):
+        _extend_array(self.tail, values)
+
+    def freeze(self):
+        """
+        Move the values appended so far to the read-only array.
+        """
+        if len(self.tail) > 0:
+            self.frozen = np.asarray(self)
+            self.tail = array.array(self.tail.typecode)
+
+
+class NgramIndex(object):
+    """
+    Interns tokens and n-grams as consecutive integer ids.
+
+    An n-gram of order k is identified by the id of its (k-1)-gram prefix and the id of its
+    last token, packed into one 64 bit key: ((prefix id + 1) << 32) | token id.
+    The order, prefix and last token of every n-gram id are kept in flat arrays.
+    Keys are looked up in a sorted array of keys with the array of their ids.  Keys interned since
+    are kept in a dict until there are enough of them to merge into the arrays, so the index does
+    not hold a boxed key and id per n-gram.
+
+    The n-grams of a saved index are memory-mapped read-only arrays.  `overlay` makes an index which
+    shares them and interns more n-grams without changing them.
+    """
+
+    __slots__ = ('token_ids', 'tokens', 'orders', 'prefixes', 'last_tokens', 'base',
+                 '_frozen_keys', '_frozen_key_ids', '_keys', '_key_ids', '_new_keys')
+
+    def __init__(self):
+        self.token_ids = {}
+        self.tokens = []
+        self.orders = _IdArray('b')
+        self.prefixes = _IdArray('l')
+        self.last_tokens = _IdArray('l')
+        # the index this one is an overlay of
+        self.base = None
+        # the sorted keys and ids shared with overlays, then those interned since
+        self._frozen_keys = self._keys = np.zeros(0, dtype=np.int64)
+        self._frozen_key_ids = self._key_ids = np.zeros(0, dtype=np.int64)
+        self._new_keys = {}
+
+    def __len__(self):
+        return len(self.orders)
+
+    def to_arrays(self):
+        """
+        :return: (tokens, orders, prefixes, last_tokens) : the index as a list of str and NumPy arrays
+        """
+        return (self.tokens,
+                np.array(self.orders, dtype=np.int8),
+                np.array(self.prefixes, dtype=np.int64),
+                np.array(self.last_tokens, dtype=np.int64))
+
+    def sorted_keys(self):
+        """
+        :return: (keys, ids) : the keys of all n-grams as a sorted NumPy array, and the id of each one
+        """
+        self._freeze()
+        return self._frozen_keys, self._frozen_key_ids
+
+    @classmethod
+    def from_arrays(cls, tokens, orders, prefixes, last_tokens, keys=None, key_ids=None):
+        """
+        Rebuild an index saved with `to_arrays`, and optionally `sorted_keys`.
+        The arrays are used as they are, e.g. memory-mapped, and never written to.
+        """
+        index = cls()
+        index.tokens = list(tokens)
+        index.token_ids = dict(zip(index.tokens, range(len(index.tokens))))
+        index.orders.frozen = np.asarray(orders)
+        index.prefixes.frozen = np.asarray(prefixes)
+        index.last_tokens.frozen = np.asarray(last_tokens)
+        if keys is None:
+            keys = ((np.asarray(prefixes, dtype=np.int64) + 1) << 32) | np.asarray(last_tokens, dtype=np.int64)
+            key_ids = np.argsort(keys, kind='mergesort')
+            keys = keys[key_ids]
+        index._frozen_keys = np.asarray(keys)
+        index._frozen_key_ids = np.asarray(key_ids)
+        return index
+
+    def overlay(self):
+        """
+        :return: NgramIndex : a new index with the tokens and n-grams of this one, sharing its n-gram arrays,
+            which interns new ones without changing this one, e.g. those of hypotheses scored against compiled
+            references.  Nothing may be interned in this index while the overlay is used.
+        """
+        self._freeze()
+        index = NgramIndex()
+        index.base = self
+        # The tokens are few compared to the n-grams, they are copied.
+        index.tokens = list(self.tokens)
+        index.token_ids = dict(self.token_ids)
+        index.orders.frozen = self.orders.frozen
+        index.prefixes.frozen = self.prefixes.frozen
+        index.last_tokens.frozen = self.last_tokens.frozen
+        index._frozen_keys = self._frozen_keys
+        index._frozen_key_ids = self._frozen_key_ids
+        return index
+
+    def extends(self, other):
+        """
+        :return: bool : whether this index is `other` or an overlay of it, so the n-gram ids of `other` are valid in it
+        """
+        index = self
+        while index is not None:
+            if index is other:
+                return True
+            index = index.base
+        return False
+
+    def intern_tokens(self, words):
+        """
+        :param words: list of str : tokens of a sentence
+        :return: list of int : token ids
+        """
+        token_ids = self.token_ids
+        ids = []
+        for w in words:
+            t = token_ids.get(w)
+            if t is None:
+                t = token_ids[w] = len(self.tokens)
+                self.tokens.append(w)
+            ids.append(t)
+        return ids
+
+    def count(self, words, n=4):
+        """
+        Count all n-grams of order 1 to n in a list of tokens.
+        :param words: list of str : tokens of a sentence
+        :param n: int : maximum n-gram order
+        :return: NgramCounts
+        """
+        return self.count_ids(self.intern_tokens(words), n)
+
+    def count_ids(self, token_ids, n=4):
+        """
+        Count all n-grams of order 1 to n in a list of token ids.
+        :param token_ids: list of int : token ids of a sentence, see `intern_tokens`
+        :param n: int : maximum n-gram order
+        :return: NgramCounts
+        """
+        return self.count_many([token_ids], n)[0]
+
+    def count_many(self, sentences, n=4):
+        """
+        Count all n-grams of order 1 to n in each of a list of sentences at once.
+        :param sentences: list of list of int : token ids of each sentence, see `intern_tokens`
+        :param n: int : maximum n-gram order
+        :return: list of NgramCounts : the counts of each sentence
+        """
+        lengths = np.fromiter(map(len, sentences), dtype=np.int64, count=len(sentences))
+        tokens = np.fromiter(itertools.chain.from_iterable(sentences), dtype=np.int64, count=int(lengths.sum()))
+        sentence_of = np.repeat(np.arange(len(sentences), dtype=np.int64), lengths)
+        # number of tokens from each position to the end of its sentence
+        remaining = np.repeat(np.cumsum(lengths), lengths) - np.arange(len(tokens), dtype=np.int64)
+        # ids of the (k-1)-grams starting at each position, -1 before the unigrams
+        prefixes = np.full(len(tokens), -1, dtype=np.int64)
+        occurrences = [np.zeros(0, dtype=np.int64)]
+        owners = [np.zeros(0, dtype=np.int64)]
+        for k in range(1, n + 1):
+            starts = np.flatnonzero(remaining >= k)
+            if len(starts) == 0:
+                break
+            prefix = prefixes[starts]
+            last = tokens[starts + (k - 1)]
+            prefixes[starts] = ngrams = self._intern(((prefix + 1) << 32) | last, k, prefix, last)
+            occurrences.append(ngrams)
+            owners.append(sentence_of[starts])
+
+        occurrences = np.concatenate(occurrences)
+        if len(sentences) == 1:
+            return [pack_counts(occurrences)]
+
+        # The distinct n-grams of every sentence, sorted by sentence then id, with their counts.
+        owners = np.concatenate(owners)
+        order = np.lexsort((occurrences, owners))
+        occurrences = occurrences[order]
+        owners = owners[order]
+        first = np.ones(len(occurrences), dtype=bool)
+        first[1:] = (occurrences[1:] != occurrences[:-1]) | (owners[1:] != owners[:-1])
+        first = np.flatnonzero(first)
+        counts = np.diff(np.append(first, len(occurrences))).astype(np.int32)
+        ngrams = occurrences[first]
+        bounds = np.searchsorted(owners[first], np.arange(len(sentences) + 1)).tolist()
+        return [NgramCounts(ngrams[a:b], counts[a:b]) for a, b in zip(bounds[:-1], bounds[1:])]
+
+    def lookup(self, keys):
+        """
+        :param keys: array of int : n-gram keys, see the class description
+        :return: array of int64 : the id of each key, -1 for keys which are not interned
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        ids = np.full(len(keys), -1, dtype=np.int64)
+        for sorted_keys, key_ids in ((self._frozen_keys, self._frozen_key_ids), (self._keys, self._key_ids)):
+            if len(sorted_keys) > 0:
+                pos = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+                found = sorted_keys[pos] == keys
+                ids[found] = key_ids[pos[found]]
+        if self._new_keys:
+            missing = np.flatnonzero(ids < 0)
+            get = self._new_keys.get
+            ids[missing] = [get(key, -1) for key in keys[missing].tolist()]
+        return ids
+
+    def _intern(self, keys, order, prefixes, tokens):
+        """
+        :param keys: array of int64 : keys of n-grams of one order, made of prefixes and tokens
+        :return: array of int64 : the id of each n-gram, interning new ones
+        """
+        ids = self.lookup(keys)
+        missing = np.flatnonzero(ids < 0)
+        if len(missing) == 0:
+            return ids
+        # n-grams may repeat among the ones being counted
+        new_keys, first, inverse = np.unique(keys[missing], return_index=True, return_inverse=True)
+        new_ids = np.arange(len(self), len(self) + len(new_keys), dtype=np.int64)
+        ids[missing] = new_ids[inverse]
+        self.orders.extend(np.full(len(new_keys), order, dtype=np.int8))
+        self.prefixes.extend(prefixes[missing[first]])
+        self.last_tokens.extend(tokens[missing[first]])
+        if len(self._new_keys) + len(new_keys) > max(_MIN_MERGE, len(self._keys) >> 3):
+            self._merge(new_keys, new_ids)
+        else:
+            self._new_keys.update(zip(new_keys.tolist(), new_ids.tolist()))
+        return ids
+
+    def _merge(self, keys=None, ids=None):
+        """
+        Move the keys of the dict, and optionally more sorted keys with their ids, to the sorted arrays.
+        """
+        if not self._new_keys and keys is None:
+            return
+        new_keys = [np.fromiter(self._new_keys.keys(), dtype=np.int64, count=len(self._new_keys))]
+        new_ids = [np.fromiter(self._new_keys.values(), dtype=np.int64, count=len(self._new_keys))]
+        if keys is not None:
+            new_keys.append(keys)
+            new_ids.append(ids)
+        new_keys = np.concatenate(new_keys)
+        order = np.argsort(new_keys, kind='mergesort')
+        pos = np.searchsorted(self._keys, new_keys[order])
+        self._keys = np.insert(self._keys, pos, new_keys[order])
+        self._key_ids = np.insert(self._key_ids, pos, np.concatenate(new_ids)[order])
+        self._new_keys = {}
+
+    def _freeze(self):
+        """
+        Move all n-grams to the read-only arrays, which overlays share.
+        """
+        self._merge()
+        if len(self._keys) > 0:
+            if len(self._frozen_keys) > 0:
+                pos = np.searchsorted(self._frozen_keys, self._keys)
+                self._frozen_keys = np.insert(self._frozen_keys, pos, self._keys)
+                self._frozen_key_ids = np.insert(self._frozen_key_ids, pos, self._key_ids)
+            else:
+                self._frozen_keys, self._frozen_key_ids = self._keys, self._key_ids
+            self._keys = np.zeros(0, dtype=np.int64)
+            self._key_ids = np.zeros(0, dtype=np.int64)
+        for a in (self.orders, self.prefixes, self.last_tokens):
+            a.freeze()
+
+    def ngram(self, g):
+        """
+        :param g: int : n-gram id
+        :return: tuple of str : the n-gram
+        """
+        words = []
+        while g >= 0:
+            words.append(self.tokens[self.last_tokens[g]])
+            g = self.prefixes[g]
+        return tuple(reversed(words))
+
+    def ngram_id(self, words):
+        """
+        :param words: tuple of str : one n-gram
+        :return: int : its id, interning it if needed
+        """
+        g = np.full(1, -1, dtype=np.int64)
+        for k, t in enumerate(self.intern_tokens(words), 1):
+            t = np.full(1, t, dtype=np.int64)
+            g = self._intern(((g + 1) << 32) | t, k, g, t)
+        return int(g[0])
+
+    def translate(self, counts, other):
+        """
+        Re-key counts made with another index to the ids of this index.
+        :param counts: NgramCounts : counts of n-gram ids of `other`
+        :param other: NgramIndex : index the counts were made with
+        :return: NgramCounts : the same counts of the n-gram ids of this index
+        """
+        if other is self:
+            return counts
+        ngrams = np.array([self.ngram_id(other.ngram(g)) for g in counts.ngrams.tolist()], dtype=np.int64)
+        order = np.argsort(ngrams)
+        return NgramCounts(ngrams[order], counts.counts[order])
+
+    def filter_orders(self, counts, n):
+        """
+        :param counts: NgramCounts
+        :param n: int : maximum n-gram order to keep
+        :return: NgramCounts : the counts of the n-grams of order up to n
+        """
+        # The orders interned since the last call are moved to the frozen array once, so that all sentences
+        # are filtered with one lookup of their n-gram ids.
+        self.orders.freeze()
+        keep = self.orders.frozen[counts.ngrams] <= n
+        return NgramCounts(counts.ngrams[keep], counts.counts[keep])
+
+
+class CookedSentence(object):
+    """
+    A sentence which carries its whitespace tokens and n-gram counts.
+
+    It behaves exactly like the original string, so scorers which do not know about it
+    (METEOR, SPICE) are unaffected, while BLEU, CIDEr and ROUGE-L skip tokenizing and
+    counting it again.
+    Instances are of a subclass of the type of the original string, `str` or, on Python 2, `unicode`.
+    """
+
+    # The attributes are slots of the subclasses, `_COOKED_SLOTS`: a base of `str` cannot add slots of its own.
+    __slots__ = ()
+
+    def __new__(cls, s, n=4, index=None):
+        return cook_many([s], n, index)[0]
+
+    @classmethod
+    def restore(cls, s, counts, n, index):
+        """
+        Rebuild a cooked sentence from n-gram counts which were made with `index`.
+        It is only split into tokens if they are asked for.
+        """
+        self = _new_cooked(s)
+        self.index = index
+        self.counts = counts
+        self.n = n
+        return self
+
+    @property
+    def words(self):
+        """
+        list of str : the whitespace tokens
+        """
+        if self._words is None:
+            self._set_words(self.split())
+        return self._words
+
+    @property
+    def single_spaced(self):
+        """
+        bool : whether `s.split(" ")` gives the same tokens as `s.split()`, only for non-empty, single spaced sentences
+        """
+        if self._words is None:
+            self._set_words(self.split())
+        return self._single_spaced
+
+    def _set_words(self, words):
+        self._words = words
+        self._single_spaced = len(words) > 0 and ' '.join(words) == self
+
+    def _tokenize(self):
+        """
+        :return: list of int : the ids of the tokens in `index`
+        """
+        token_ids = self.index.intern_tokens(self.split())
+        # Keep the interned token strings, which are shared by all sentences of the corpus.
+        self._set_words([self.index.tokens[t] for t in token_ids])
+        return token_ids
+
+    def rebind(self, index):
+        """
+        :param index: NgramIndex : an index which extends the one of this sentence, e.g. an overlay of it
+        :return: CookedSentence : this sentence with the same tokens and counts, for index
+        """
+        other = _new_cooked(self)
+        other.index = index
+        other.counts = self.counts
+        other.n = self.n
+        # tokenizes a restored sentence once, for all the overlays it is used with
+        other._set_words(self.words)
+        return other
+
+    def plain(self):
+        """
+        :return: str : the sentence as a string of the original type, without the cached tokens and counts
+        """
+        return self._text_type(self)
+
+
+_COOKED_SLOTS = 'index', 'counts', 'n', '_words', '_single_spaced'
+
+
+class _CookedStr(CookedSentence, str):
+    # Python 2 `str` is variable-sized and does not support non-empty slots.
+    __slots__ = () if six.PY2 else _COOKED_SLOTS
+    _text_type = str
+
+
+if six.PY2:
+    class _CookedUnicode(CookedSentence, six.text_type):
+        __slots__ = _COOKED_SLOTS
+        _text_type = six.text_type
+
+
+def _new_cooked(s):
+    """
+    :return: CookedSentence : an instance of the cooked subclass of the type of s, with nothing cached yet
+    """
+    cooked_type = _CookedUnicode if six.PY2 and isinstance(s, six.text_type) else _CookedStr
+    self = cooked_type._text_type.__new__(cooked_type, s)
+    self._words = None
+    return self
+
+
+def cook_many(sentences, n=4, index=None):
+    """
+    Cook sentences, counting the n-grams of all of them at once.
+    :param sentences: list of str
+    :param n: int : maximum n-gram order
+    :param index: NgramIndex : index to count with, a new one if None
+    :return: list of CookedSentence
+    """
+    if index is None:
+        index = NgramIndex()
+    cooked = [_new_cooked(s) for s in sentences]
+    for s in cooked:
+        s.index = index
+        s.n = n
+    for s, counts in zip(cooked, index.count_many([s._tokenize() for s in cooked], n)):
+        s.counts = counts
+    return cooked
+
+
+def index_of(s):
+    """
+    :param s: str : sentence, optionally a `CookedSentence`
+    :return: NgramIndex : the index a cooked sentence was counted with, otherwise a new one
+    """
+    if isinstance(s, CookedSentence):
+        return s.index
+    return NgramIndex()
+
+
+def precook(s, n=4, index=None):
+    """
+    Tokenize a sentence and count its n-grams, reusing the work done by `cook_corpus`.
+    :param s: str : sentence, optionally a `CookedSentence`
+    :param n: int : maximum n-gram order
+    :param index: NgramIndex : index to count n-gram ids with, n-gram tuples are counted if None
+    :return: (words, counts) : list of tokens and `NgramCounts`, or a mapping of n-gram tuple to count if index is None
+    """
+    if index is None:
+        words = s.split()
+        return words, count_ngrams(words, n)
+    if isinstance(s, CookedSentence) and s.index is index and s.n >= n:
+        if s.n == n:
+            return s.words, s.counts
+        return s.words, index.filter_orders(s.counts, n)
+    words = s.split()
+    return words, index.count(words, n)
+
+
+def split_tokens(s):
+    """
+    Split a sentence on single spaces, as ROUGE-L does, reusing cached tokens when possible.
+    :param s: str : sentence, optionally a `CookedSentence`
+    :return: list of str
+    """
+    if isinstance(s, CookedSentence) and s.single_spaced:
+        return s.words
+    return s.split(" ")
+
+
+def cook_corpus(gts, res, n=4, index=None):
+    """
+    Tokenize and count n-grams of every reference and hypothesis once.
+    :param gts: dict : reference sentences with "image name" key and list of sentences as values
+    :param res: dict : hypothesis sentences with "image name" key and list of one sentence as values
+    :param n: int : maximum n-gram order needed by any scorer
+    :param index: NgramIndex : optional, index to count with, e.g. an overlay of the index of compiled references,
+        by default the one the references are already cooked with, if they are
+    :return: (gts, res) : copies of the inputs where sentences are `CookedSentence`s sharing one `NgramIndex`
+    """
+    if index is None:
+        index = index_of(next((refs[0] for refs in gts.values() if refs), None))
+
+    def is_cooked(s):
+        # cooked with index, or with an index it extends, whose n-gram ids are valid in index
+        return isinstance(s, CookedSentence) and s.n >= n and index.extends(s.index)
+
+    def needs_cooking(s):
+        return isinstance(s, six.string_types) and not is_cooked(s)
+
+    # All the sentences which are not cooked yet are counted at once.
+    todo = [s for sentences in itertools.chain(gts.values(), res.values()) for s in sentences if needs_cooking(s)]
+    cooked = iter(cook_many(todo, n, index))
+
+    def cook(sentences):
+        return [next(cooked) if needs_cooking(s) else s.rebind(index) if is_cooked(s) and s.index is not index else s
+                for s in sentences]
+
+    cooked_gts = {key: cook(refs) for key, refs in gts.items()}
+    cooked_res = {key: cook(hypo) for key, hypo in res.items()}
+    return cooked_gts, cooked_res
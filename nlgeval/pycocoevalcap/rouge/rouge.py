@@ -7,8 +7,16 @@
 # Creation Date : 2015-01-07 06:03
 # Author : Ramakrishna Vedantam <vrama91@vt.edu>
 
+import itertools
+from collections import Counter
+from multiprocessing import Pool
+
 import numpy as np
 import pdb
+import six
+from six.moves import xrange as range
+
+from ..ngrams import CookedSentence, split_tokens
 
 def my_lcs(string, sub):
     """
@@ -18,29 +26,169 @@ def my_lcs(string, sub):
     :returns: length (list of int): length of the longest common subsequence between the two strings
 
     Note: my_lcs only gives length of the longest common subsequence, not the actual LCS
+
+    The lengths are computed bit-parallel (Allison and Dix, 1986; Hyyro, 2004): bit i of an integer stands for
+    token i of the longer string, so a row of the dynamic programming table is updated with a few integer
+    operations per token of the shorter string, in linear memory.
     """
     if(len(string)< len(sub)):
         sub, string = string, sub
 
-    lengths = [[0 for i in range(0,len(sub)+1)] for j in range(0,len(string)+1)]
+    # matches[token]: bit i is set if string[i] == token
+    matches = {}
+    for i, token in enumerate(string):
+        matches[token] = matches.get(token, 0) | (1 << i)
+
+    # the unset bits of v mark where the LCS with the prefix of sub seen so far increases
+    mask = (1 << len(string)) - 1
+    v = mask
+    for token in sub:
+        u = v & matches.get(token, 0)
+        v = ((v + u) | (v - u)) & mask
+
+    return len(string) - bin(v).count('1')
+
+def batch_lcs(strings, sub):
+    """
+    Calculates the lengths of the longest common subsequences of several tokenized strings with one other,
+    all at once: the strings are laid out next to each other in one bit vector for the algorithm of `my_lcs`,
+    separated by a guard bit which stops carries from one string to the next.
+    :param strings : list of list of str : tokenized strings, e.g. the references of an image
+    :param sub : list of str : tokenized string, e.g. the candidate
+    :returns: lengths (list of int): length of the longest common subsequence of each string with sub
+    """
+    matches = {}
+    offsets = []
+    mask = 0
+    offset = 0
+    for string in strings:
+        offsets.append(offset)
+        for i, token in enumerate(string, offset):
+            matches[token] = matches.get(token, 0) | (1 << i)
+        mask |= ((1 << len(string)) - 1) << offset
+        offset += len(string) + 1
 
-    for j in range(1,len(sub)+1):
-        for i in range(1,len(string)+1):
-            if(string[i-1] == sub[j-1]):
-                lengths[i][j] = lengths[i-1][j-1] + 1
+    v = mask
+    for token in sub:
+        u = v & matches.get(token, 0)
+        v = ((v + u) | (v - u)) & mask
+
+    return [len(string) - bin((v >> offset) & ((1 << len(string)) - 1)).count('1')
+            for string, offset in zip(strings, offsets)]
+
+def my_wlcs(string, sub, weight):
+    """
+    Calculates the weighted longest common subsequence (Lin, 2004) of a pair of tokenized strings,
+    which rewards consecutive matches, and the plain longest common subsequence with the same table.
+    :param string : list of str : tokens from a string split using whitespace
+    :param sub : list of str : other string, also split using whitespace
+    :param weight : function : weight of k consecutive matches, e.g. k ** 1.2
+    :returns: (length, weighted length) (int, float)
+    """
+    lengths = [0] * (len(sub) + 1)
+    weighted = [0.0] * (len(sub) + 1)
+    # number of consecutive matches ending at each position
+    runs = [0] * (len(sub) + 1)
+    for token in string:
+        row_lengths = [0] * (len(sub) + 1)
+        row_weighted = [0.0] * (len(sub) + 1)
+        row_runs = [0] * (len(sub) + 1)
+        for j in range(1, len(sub) + 1):
+            if token == sub[j - 1]:
+                k = runs[j - 1]
+                row_lengths[j] = lengths[j - 1] + 1
+                row_weighted[j] = weighted[j - 1] + weight(k + 1) - weight(k)
+                row_runs[j] = k + 1
             else:
-                lengths[i][j] = max(lengths[i-1][j] , lengths[i][j-1])
+                row_lengths[j] = max(lengths[j], row_lengths[j - 1])
+                row_weighted[j] = max(weighted[j], row_weighted[j - 1])
+        lengths, weighted, runs = row_lengths, row_weighted, row_runs
+    return lengths[len(sub)], weighted[len(sub)]
 
-    return lengths[len(string)][len(sub)]
+def skip_bigrams(tokens, max_skip=4):
+    """
+    :param tokens : list of str : tokens of a sentence
+    :param max_skip : int : maximum number of tokens between the two tokens of a skip-bigram
+    :returns: counts (Counter) : skip-bigrams and unigrams, as used by ROUGE-SU
+    """
+    counts = Counter(tokens)
+    for i in range(len(tokens)):
+        counts.update(zip(itertools.repeat(tokens[i]), tokens[i + 1:i + 2 + max_skip]))
+    return counts
+
+def overlap(counts, other):
+    """
+    :param counts : dict : counts of n-grams of a sentence
+    :param other : dict : counts of n-grams of another sentence
+    :returns: int : number of n-grams the sentences have in common
+    """
+    if len(other) < len(counts):
+        counts, other = other, counts
+    return sum(min(count, other.get(ngram, 0)) for ngram, count in six.iteritems(counts))
 
 class Rouge():
     '''
     Class for computing ROUGE-L score for a set of candidate sentences for the MS COCO test set
 
+    It can also compute ROUGE-1, ROUGE-2, ROUGE-W (weighted LCS) and ROUGE-SU4 (skip-bigrams and unigrams)
+    in the same pass, see `metrics`.  As for ROUGE-L, their precision and recall are the best over the references.
     '''
-    def __init__(self):
+    all_metrics = ['ROUGE_1', 'ROUGE_2', 'ROUGE_L', 'ROUGE_W', 'ROUGE_SU4']
+
+    def __init__(self, metrics=None, processes=1):
+        """
+        :param metrics: list of str : metrics to compute, from `all_metrics`.
+            By default only ROUGE-L is computed and `compute_score` returns its score, otherwise it returns lists
+            with the scores of each metric.
+        :param processes: int : number of worker processes `compute_score` scores chunks of the images with
+        """
         # vrama91: updated the value below based on discussion with Hovey
         self.beta = 1.2
+        # ROUGE-W weighting function f(k) = k ** alpha, as the default of ROUGE-1.5.5
+        self.alpha = 1.2
+        if metrics is not None:
+            assert len(set(metrics) - set(self.all_metrics)) == 0, \
+                "Invalid ROUGE metrics: {}".format(set(metrics) - set(self.all_metrics))
+        self.metrics = metrics
+        self.processes = processes
+
+    def f_score(self, prec_max, rec_max):
+        if(prec_max!=0 and rec_max !=0):
+            score = ((1 + self.beta**2)*prec_max*rec_max)/float(rec_max + self.beta**2*prec_max)
+        else:
+            score = 0.0
+        return score
+
+    def best_lcs(self, token_c, tokens_r, bounds):
+        """
+        :param token_c: list of str : tokens of the candidate
+        :param tokens_r: list of list of str : tokens of each reference
+        :param bounds: list of int : number of tokens each reference shares with the candidate
+        :returns: (prec_max, rec_max) : best LCS precision and recall over the references
+        """
+        # Only the best precision and recall are used.  The number of tokens shared with the candidate
+        # bounds the LCS, so references which cannot improve either are skipped: first compute the LCS of
+        # the references with the highest bounds, then of the references which may still beat them.
+        best_prec = max(range(len(tokens_r)), key=lambda i: bounds[i])
+        best_rec = max(range(len(tokens_r)), key=lambda i: bounds[i] / float(len(tokens_r[i])))
+        lcs_max = 0
+        rec_max = 0.0
+
+        def update(selected):
+            # compute the longest common subsequences
+            for i, lcs in zip(selected, batch_lcs([tokens_r[i] for i in selected], token_c)):
+                yield lcs, lcs / float(len(tokens_r[i]))
+
+        first = sorted({best_prec, best_rec})
+        for lcs, rec in update(first):
+            lcs_max = max(lcs_max, lcs)
+            rec_max = max(rec_max, rec)
+        rest = [i for i in range(len(tokens_r))
+                if i not in first and (bounds[i] > lcs_max or bounds[i] / float(len(tokens_r[i])) > rec_max)]
+        for lcs, rec in update(rest):
+            lcs_max = max(lcs_max, lcs)
+            rec_max = max(rec_max, rec)
+        return lcs_max / float(len(token_c)), rec_max
 
     def calc_score(self, candidate, refs):
         """
@@ -51,28 +199,67 @@ class Rouge():
         """
         assert(len(candidate)==1)	
         assert(len(refs)>0)         
-        prec = []
-        rec = []
+        # split into tokens
+        token_c = split_tokens(candidate[0])
+        tokens_r = [split_tokens(reference) for reference in refs]
 
+        counts_c = Counter(token_c)
+        bounds = [overlap(counts_c, Counter(token_r)) for token_r in tokens_r]
+        prec_max, rec_max = self.best_lcs(token_c, tokens_r, bounds)
+        return self.f_score(prec_max, rec_max)
+
+    def calc_scores(self, candidate, refs):
+        """
+        Compute the scores of `metrics` given one candidate and references for an image
+        :param candidate: str : candidate sentence to be evaluated
+        :param refs: list of str : COCO reference sentences for the particular image to be evaluated
+        :returns scores: list of float : score of each metric
+        """
+        assert(len(candidate)==1)
+        assert(len(refs)>0)
         # split into tokens
-        token_c = candidate[0].split(" ")
-    	
-        for reference in refs:
-            # split into tokens
-            token_r = reference.split(" ")
-            # compute the longest common subsequence
-            lcs = my_lcs(token_r, token_c)
-            prec.append(lcs/float(len(token_c)))
-            rec.append(lcs/float(len(token_r)))
-
-        prec_max = max(prec)
-        rec_max = max(rec)
+        token_c = split_tokens(candidate[0])
+        tokens_r = [split_tokens(reference) for reference in refs]
 
-        if(prec_max!=0 and rec_max !=0):
-            score = ((1 + self.beta**2)*prec_max*rec_max)/float(rec_max + self.beta**2*prec_max)
-        else:
-            score = 0.0
-        return score
+        def best(overlaps, total_c, totals_r):
+            prec_max = max(overlaps) / float(total_c) if total_c > 0 else 0.0
+            rec_max = max(o / float(t) if t > 0 else 0.0 for o, t in zip(overlaps, totals_r))
+            return self.f_score(prec_max, rec_max)
+
+        scores = {}
+        # the unigram overlaps are ROUGE-1 and bound the LCS for ROUGE-L
+        counts_c = Counter(token_c)
+        unigrams = [overlap(counts_c, Counter(token_r)) for token_r in tokens_r]
+        if 'ROUGE_1' in self.metrics:
+            scores['ROUGE_1'] = best(unigrams, len(token_c), [len(token_r) for token_r in tokens_r])
+        if 'ROUGE_2' in self.metrics:
+            counts_c = Counter(zip(token_c, token_c[1:]))
+            scores['ROUGE_2'] = best([overlap(counts_c, Counter(zip(token_r, token_r[1:]))) for token_r in tokens_r],
+                                     len(token_c) - 1, [len(token_r) - 1 for token_r in tokens_r])
+        if 'ROUGE_SU4' in self.metrics:
+            counts_c = skip_bigrams(token_c)
+            counts_r = [skip_bigrams(token_r) for token_r in tokens_r]
+            scores['ROUGE_SU4'] = best([overlap(counts_c, c) for c in counts_r],
+                                       sum(counts_c.values()), [sum(c.values()) for c in counts_r])
+        if 'ROUGE_L' in self.metrics:
+            scores['ROUGE_L'] = self.f_score(*self.best_lcs(token_c, tokens_r, unigrams))
+        if 'ROUGE_W' in self.metrics:
+            # the weighted LCS takes a quadratic table per reference, ROUGE-W is opt-in for this reason
+            weight = lambda k: k ** self.alpha
+            wlcs = [my_wlcs(token_r, token_c, weight)[1] for token_r in tokens_r]
+            prec_max = max((w / weight(len(token_c))) ** (1 / self.alpha) for w in wlcs)
+            rec_max = max((w / weight(len(token_r))) ** (1 / self.alpha) for w, token_r in zip(wlcs, tokens_r))
+            scores['ROUGE_W'] = self.f_score(prec_max, rec_max)
+        return [scores[metric] for metric in self.metrics]
+
+    def score_images(self, images):
+        """
+        :param images: list of (candidate, refs) : as for `calc_score`
+        :returns: list : score (or list of scores of `metrics`) of each image
+        """
+        if self.metrics is None:
+            return [self.calc_score(hypo, ref) for hypo, ref in images]
+        return [self.calc_scores(hypo, ref) for hypo, ref in images]
 
     def compute_score(self, gts, res):
         """
@@ -81,25 +268,58 @@ class Rouge():
         :param hypo_for_image: dict : candidate / test sentences with "image name" key and "tokenized sentences" as values 
         :param ref_for_image: dict : reference MS-COCO sentences with "image name" key and "tokenized sentences" as values
         :returns: average_score: float (mean ROUGE-L score computed by averaging scores for all the images)
+            If `metrics` were given, lists with the average score and the scores of each metric are returned.
         """
         assert(gts.keys() == res.keys())
         imgIds = gts.keys()
 
-        score = []
+        images = []
         for id in imgIds:
             hypo = res[id]
             ref  = gts[id]
 
-            score.append(self.calc_score(hypo, ref))
-
             # Sanity check.
             assert(type(hypo) is list)
             assert(len(hypo) == 1)
             assert(type(ref) is list)
             assert(len(ref) > 0)
 
+            images.append((hypo, ref))
+
+        if self.processes > 1 and len(images) > 1:
+            # Send chunks of plain strings, the tokens cached by `ngrams.cook_corpus` would cost more to transfer
+            # than to compute again.  `Pool.map` keeps the order of the images.
+            plain = lambda s: s.plain() if isinstance(s, CookedSentence) else s
+            images = [(list(map(plain, hypo)), list(map(plain, ref))) for hypo, ref in images]
+            chunk_size = -(-len(images) // (4 * self.processes))
+            chunks = [images[start:start + chunk_size] for start in range(0, len(images), chunk_size)]
+            pool = Pool(self.processes, initializer=_init_worker, initargs=(self,))
+            try:
+                score = [s for chunk_score in pool.map(_score_chunk, chunks) for s in chunk_score]
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            score = self.score_images(images)
+
+        if self.metrics is not None:
+            score = [np.array(metric_score) for metric_score in zip(*score)] if score else [np.array([])] * len(self.metrics)
+            return [np.mean(metric_score) for metric_score in score], score
         average_score = np.mean(np.array(score))
         return average_score, np.array(score)
 
     def method(self):
         return "Rouge"
+
+
+# the `Rouge` scorer in worker processes of `Rouge.compute_score`
+_rouge = None
+
+
+def _init_worker(rouge):
+    global _rouge
+    _rouge = rouge
+
+
+def _score_chunk(images):
+    return _rouge.score_images(images)
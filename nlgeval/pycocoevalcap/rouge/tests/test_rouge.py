@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import random
+import unittest
+
+import numpy as np
+
+from nlgeval.pycocoevalcap.rouge.rouge import Rouge, batch_lcs, my_lcs, my_wlcs, skip_bigrams
+
+
+def dp_lcs(a, b):
+    lengths = [[0] * (len(b) + 1) for _ in range(len(a) + 1)]
+    for i in range(1, len(a) + 1):
+        for j in range(1, len(b) + 1):
+            if a[i - 1] == b[j - 1]:
+                lengths[i][j] = lengths[i - 1][j - 1] + 1
+            else:
+                lengths[i][j] = max(lengths[i - 1][j], lengths[i][j - 1])
+    return lengths[len(a)][len(b)]
+
+
+class TestRouge(unittest.TestCase):
+    def test_lcs(self):
+        self.assertEqual(0, my_lcs([], ["a"]))
+        self.assertEqual(3, my_lcs("a b c d".split(), "a c d".split()))
+        self.assertEqual(2, my_lcs("a b a".split(), "b a b".split()))
+        rng = random.Random(0)
+        for _ in range(500):
+            a = [rng.choice("abcde") for _ in range(rng.randint(0, 80))]
+            b = [rng.choice("abcde") for _ in range(rng.randint(0, 80))]
+            self.assertEqual(dp_lcs(a, b), my_lcs(a, b))
+
+    def test_compute_score(self):
+        score, scores = Rouge().compute_score({0: ["this is a test", "this is also a test"]},
+                                              {0: ["this is a good test"]})
+        self.assertAlmostEqual(0.9070631, score, places=5)
+
+    def test_batch_lcs(self):
+        rng = random.Random(1)
+        for _ in range(100):
+            sub = [rng.choice("abcde") for _ in range(rng.randint(0, 30))]
+            strings = [[rng.choice("abcde") for _ in range(rng.randint(0, 30))] for _ in range(rng.randint(1, 6))]
+            self.assertEqual([dp_lcs(s, sub) for s in strings], batch_lcs(strings, sub))
+
+    def test_pruning(self):
+        rng = random.Random(2)
+        rouge = Rouge()
+        for _ in range(100):
+            refs = [" ".join(rng.choice("abcdef") for _ in range(rng.randint(1, 15))) for _ in range(rng.randint(1, 10))]
+            hyp = " ".join(rng.choice("abcdef") for _ in range(rng.randint(1, 15)))
+            tokens = hyp.split(" ")
+            prec = max(dp_lcs(r.split(" "), tokens) / float(len(tokens)) for r in refs)
+            rec = max(dp_lcs(r.split(" "), tokens) / float(len(r.split(" "))) for r in refs)
+            expected = ((1 + rouge.beta ** 2) * prec * rec) / float(rec + rouge.beta ** 2 * prec) if prec and rec else 0.0
+            self.assertEqual(expected, rouge.calc_score([hyp], refs))
+
+    def test_wlcs(self):
+        weight = lambda k: k ** 2
+        # Consecutive matches weigh more.
+        self.assertEqual((3, 9), my_wlcs("a b c".split(), "a b c".split(), weight))
+        self.assertEqual((3, 5), my_wlcs("a b x c".split(), "a b c".split(), weight))
+        rng = random.Random(3)
+        for _ in range(100):
+            a = [rng.choice("abc") for _ in range(rng.randint(0, 20))]
+            b = [rng.choice("abc") for _ in range(rng.randint(0, 20))]
+            self.assertEqual(dp_lcs(a, b), my_wlcs(a, b, weight)[0])
+
+    def test_skip_bigrams(self):
+        counts = skip_bigrams("a b c d e f g".split(), max_skip=4)
+        self.assertEqual(1, counts[('a', 'f')])
+        self.assertEqual(0, counts[('a', 'g')])
+        self.assertEqual(1, counts['a'])
+        self.assertEqual(7 + 5 + 5 + 4 + 3 + 2 + 1, sum(counts.values()))
+
+    def test_metrics(self):
+        gts = {0: ["this is a test", "this is also a test"]}
+        res = {0: ["this is a good test"]}
+        rouge = Rouge(Rouge.all_metrics)
+        score, scores = rouge.compute_score(gts, res)
+        np.testing.assert_allclose([0.907063, 0.586538, 0.907063, 0.828918, 0.829932], score, rtol=1e-5)
+        self.assertEqual(Rouge().compute_score(gts, res)[0], score[2])
+        self.assertEqual(score[2], Rouge(['ROUGE_L']).compute_score(gts, res)[0][0])
+
+    def test_processes(self):
+        rng = random.Random(4)
+        gts = {i: [" ".join(rng.choice("abcdef") for _ in range(rng.randint(1, 15))) for _ in range(3)]
+               for i in range(30)}
+        res = {i: [" ".join(rng.choice("abcdef") for _ in range(rng.randint(1, 15)))] for i in range(30)}
+        for metrics in (None, Rouge.all_metrics):
+            score, scores = Rouge(metrics).compute_score(gts, res)
+            parallel_score, parallel_scores = Rouge(metrics, processes=3).compute_score(gts, res)
+            np.testing.assert_array_equal(score, parallel_score)
+            np.testing.assert_array_equal(scores, parallel_scores)
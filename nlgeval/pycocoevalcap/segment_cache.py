@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+# Persistent cache of per-segment results of the scorers which run in a JVM (METEOR, SPICE).
+#
+# The result for a segment depends only on the segment (and the version and options of the scorer),
+# so it is stored under a hash of the segment.  Re-scoring unchanged segments then skips the JVM.
+import hashlib
+import sqlite3
+import threading
+
+
+class SegmentCache(object):
+    """
+    str -> str, stored in an SQLite database which can be shared by processes.
+    """
+
+    # SQLite limits the number of parameters of a statement.
+    _batch_size = 500
+
+    def __init__(self, path, namespace=''):
+        """
+        :param path: str : path of the database file, created if needed
+        :param namespace: str : hashed with every key, e.g. the jar and options of the scorer
+        """
+        self.path = path
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS segments (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+    def key(self, segment, namespace=''):
+        """
+        :param segment: str
+        :param namespace: str : hashed with the key after the namespace of the cache
+        """
+        namespace = u'\n'.join(ns for ns in (self.namespace, namespace) if ns)
+        return hashlib.sha1(u'{}\n{}'.format(namespace, segment).encode('utf-8')).hexdigest()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM segments').fetchone()[0]
+
+    def get_many(self, segments, namespace=''):
+        """
+        :param segments: list of str
+        :param namespace: str : hashed with every key after the namespace of the cache
+        :return: list of str : the cached value of each segment, None if it is not cached
+        """
+        keys = [self.key(segment, namespace) for segment in segments]
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), self._batch_size):
+                batch = keys[start:start + self._batch_size]
+                found.update(self._conn.execute(
+                    'SELECT key, value FROM segments WHERE key IN ({})'.format(','.join('?' * len(batch))), batch))
+        return [found.get(key) for key in keys]
+
+    def put_many(self, segments, values, namespace=''):
+        """
+        :param segments: list of str
+        :param values: list of str : the value of each segment, empty values are not stored
+        :param namespace: str : hashed with every key after the namespace of the cache
+        """
+        rows = [(self.key(segment, namespace), value) for segment, value in zip(segments, values) if value]
+        with self._lock, self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO segments (key, value) VALUES (?, ?)', rows)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,46 @@
+import java.io.BufferedReader;
+import java.io.FileDescriptor;
+import java.io.FileOutputStream;
+import java.io.InputStreamReader;
+import java.io.PrintStream;
+
+import edu.anu.spice.SpiceArguments;
+import edu.anu.spice.SpiceScorer;
+
+/**
+ * Scores batches with SPICE in one long-running JVM, so the CoreNLP models are loaded once
+ * instead of once per batch.
+ *
+ * Each line read from stdin is one batch: the command line arguments of spice-1.0.jar separated by tabs.
+ * Each batch is answered on stdout with a line "OK" or "ERROR message".
+ * "READY" is written once the worker is running.
+ *
+ * Compiled once by `nlg-eval --setup` (see compile_worker in spice.py):
+ *   javac --release 8 -cp spice-1.0.jar -d . SpiceWorker.java
+ * and started by spice.py:
+ *   java -cp .:spice-1.0.jar:lib/* SpiceWorker
+ */
+public class SpiceWorker {
+
+    public static void main(String[] args) throws Exception {
+        PrintStream answers = new PrintStream(new FileOutputStream(FileDescriptor.out), true, "UTF-8");
+        // The output of SPICE goes to stderr, stdout only has the answers.
+        System.setOut(System.err);
+        BufferedReader requests = new BufferedReader(new InputStreamReader(System.in, "UTF-8"));
+
+        answers.println("READY");
+        String request;
+        while ((request = requests.readLine()) != null) {
+            if (request.isEmpty()) {
+                continue;
+            }
+            try {
+                new SpiceScorer().scoreBatch(new SpiceArguments(request.split("\t")));
+                answers.println("OK");
+            } catch (Exception e) {
+                e.printStackTrace();
+                answers.println("ERROR " + String.valueOf(e).replace('\n', ' '));
+            }
+        }
+    }
+}
@@ -1,4 +1,7 @@
 from __future__ import division
+import atexit
+import logging
+import multiprocessing
 import os
 import sys
 import subprocess
@@ -7,11 +10,22 @@ import json
 import numpy as np
 import ast
 import tempfile
+from collections import OrderedDict
 
+from ..segment_cache import SegmentCache
+
+# Directory of spice.py, where SPICE runs
+SPICE_DIR = os.path.dirname(os.path.abspath(__file__))
 # Assumes spice.jar is in the same directory as spice.py.  Change as needed.
 SPICE_JAR = 'spice-1.0.jar'
+# Class of the persistent worker, compiled from its source in SPICE_DIR by `compile_worker`
+SPICE_WORKER = 'SpiceWorker'
 TEMP_DIR = 'tmp'
 CACHE_DIR = 'cache'
+# Directory for SPICE to cache parses in by default, instead of CACHE_DIR in the package
+CACHE_DIR_ENV = 'NLGEVAL_SPICE_CACHE'
+# Subdirectory of the cache directory which the worker is compiled to, so the package is left as installed
+WORKER_DIR = 'worker'
 
 
 def enc(s):
@@ -22,12 +36,337 @@ def dec(s):
     return s.decode('utf-8')
 
 
+class SpiceException(Exception):
+    pass
+
+
+# Workers of several threads of `Spice._score` compile the worker once.
+_compile_lock = threading.Lock()
+
+
+def default_cache_dir():
+    """
+    :return: str : the NLGEVAL_SPICE_CACHE environment variable if it is set, otherwise a directory in this package
+    """
+    return os.environ.get(CACHE_DIR_ENV, os.path.join(SPICE_DIR, CACHE_DIR))
+
+
+def worker_dir(cache_dir=None):
+    """
+    :param cache_dir: str : cache directory of SPICE. Default: `default_cache_dir()`
+    :return: str : absolute path of the directory the persistent SPICE worker is compiled to
+    """
+    return os.path.abspath(os.path.join(cache_dir if cache_dir is not None else default_cache_dir(), WORKER_DIR))
+
+
+def compile_worker(cache_dir=None):
+    """
+    Compile the persistent SPICE worker to a class file in the `worker_dir` of a cache directory,
+    for Java 8 or higher.
+    `nlg-eval --setup` does it once for the default cache directory, otherwise the first persistent `Spice` does.
+    :param cache_dir: str : cache directory of SPICE. Default: `default_cache_dir()`
+    :return: bool : whether the worker was compiled
+    """
+    source = SPICE_WORKER + '.java'
+    classes = worker_dir(cache_dir)
+    if not os.path.exists(classes):
+        os.makedirs(classes)
+    # --release needs a JDK 9 or higher, the classes of a JDK 8 are for Java 8 anyway.
+    for release in (['--release', '8'], []):
+        try:
+            subprocess.check_call(['javac'] + release + ['-cp', SPICE_JAR, '-d', classes, source], cwd=SPICE_DIR)
+        except (OSError, subprocess.CalledProcessError) as e:
+            error = e
+        else:
+            return True
+    logging.warning("Could not compile %s: %s", os.path.join(SPICE_DIR, source), error)
+    return False
+
+
+def _write_json_array(f, items):
+    """
+    Write a JSON array one item at a time.
+    """
+    f.write('[\n')
+    for i, item in enumerate(items):
+        if i > 0:
+            f.write(',\n')
+        json.dump(item, f)
+    f.write('\n]\n')
+
+
+def _iter_json_array(f, chunk_size=1 << 20):
+    """
+    Parse the items of a JSON array one at a time, without reading the whole file.
+    :param f: file : text file holding a JSON array
+    """
+    decoder = json.JSONDecoder()
+    buf, pos, eof = '', 0, False
+    started = False
+    while True:
+        # Skip whitespace and separators, reading more when the buffer is exhausted.
+        while True:
+            while pos < len(buf) and (buf[pos].isspace() or buf[pos] == ','):
+                pos += 1
+            if pos < len(buf) or eof:
+                break
+            buf, pos = f.read(chunk_size), 0
+            eof = not buf
+        if pos == len(buf):
+            raise ValueError("Unexpected end of the JSON array in {}".format(getattr(f, 'name', f)))
+        if not started:
+            if buf[pos] != '[':
+                raise ValueError("Expected a JSON array in {}".format(getattr(f, 'name', f)))
+            started = True
+            pos += 1
+            continue
+        if buf[pos] == ']':
+            return
+        try:
+            item, end = decoder.raw_decode(buf, pos)
+        except ValueError:
+            if eof:
+                raise
+            end = None
+        if end is None or (not eof and (end == len(buf) or not (buf[end].isspace() or buf[end] in ',]'))):
+            # The item continues in the next chunk, or may: a number cut anywhere, e.g. before its fraction,
+            # is a shorter number.  An item is complete when a separator follows it.
+            more = f.read(chunk_size)
+            eof = not more
+            buf, pos = buf[pos:] + more, 0
+            continue
+        pos = end
+        yield item
+
 
 class Spice:
     """
     Main Class to compute the SPICE metric 
     """
 
+    def __init__(self, persistent=False, processes=1, mem='8G', cache_dir=None, result_cache=None, categories=None):
+        """
+        :param persistent: bool : keep the SPICE JVMs running between calls of `compute_score`, so the parser models
+            are only loaded once. Needs the worker compiled by `compile_worker`, otherwise JVMs are started for
+            every call.
+        :param processes: int : number of SPICE JVMs to parse and score shards of the segments with
+        :param mem: str : maximum heap size of each JVM, e.g. '8G'
+        :param cache_dir: str : directory where SPICE caches the parses of captions, can be shared by processes.
+            Default: the NLGEVAL_SPICE_CACHE environment variable if it is set, otherwise a directory in this package.
+        :param result_cache: str or SegmentCache : path of a cache of the scores of each segment, segments which are
+            in the cache are not sent to SPICE. Default: no cache.
+        :param categories: list of str : keep only the F-scores of these categories (e.g. ['All'] or ['Object',
+            'Relation']) and return them as an array with one row per segment instead of all the scores as dicts.
+        """
+        self.persistent = persistent
+        self.processes = processes
+        self.mem = mem
+        if cache_dir is None:
+            cache_dir = default_cache_dir()
+        self.cache_dir = cache_dir
+        self.categories = list(categories) if categories is not None else None
+        # The F-scores kept of each segment: All, for the corpus score, and the other categories.
+        self._kept_categories = None
+        if self.categories is not None:
+            self._kept_categories = ['All'] + [category for category in self.categories if category != 'All']
+        # Caches given by path are closed with this scorer.
+        self._owns_result_cache = result_cache is not None and not isinstance(result_cache, SegmentCache)
+        if self._owns_result_cache:
+            result_cache = SegmentCache(result_cache)
+        self.result_cache = result_cache
+        # Whether the cache was given by path or not, its scores are only valid for this SPICE version and options.
+        namespace = [SPICE_JAR, '-subset']
+        if self.categories is not None:
+            # The cache holds what is kept of the scores.
+            namespace.append('kept={}'.format(','.join(self._kept_categories)))
+        self._result_cache_namespace = ' '.join(namespace)
+        # Used to guarantee thread safety
+        self.lock = threading.Lock()
+        self.workers = [None] * processes
+        if persistent:
+            atexit.register(self.close)
+
+    def close(self):
+        with self.lock:
+            for i, worker in enumerate(self.workers):
+                if worker is not None:
+                    worker.kill()
+                    worker.wait()
+                    self.workers[i] = None
+            if self._owns_result_cache and self.result_cache is not None:
+                self.result_cache.close()
+                self.result_cache = None
+        # if the user calls close() manually, remove the
+        # reference from atexit so the object can be garbage-collected.
+        if atexit is not None and getattr(atexit, "unregister", None) is not None:
+            atexit.unregister(self.close)
+
+    def __del__(self):
+        self.close()
+
+    def _start_worker(self):
+        """
+        :return: subprocess.Popen : the worker, or None if it could not be started
+        """
+        classes = worker_dir(self.cache_dir)
+        with _compile_lock:
+            if not os.path.exists(os.path.join(classes, SPICE_WORKER + '.class')) and \
+                    not compile_worker(self.cache_dir):
+                return None
+        classpath = os.pathsep.join([classes, SPICE_JAR, os.path.join('lib', '*')])
+        try:
+            worker = subprocess.Popen(['java', '-Xmx{}'.format(self.mem), '-cp', classpath, SPICE_WORKER],
+                                      cwd=SPICE_DIR,
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE)
+        except OSError as e:
+            logging.warning("Could not start the persistent SPICE worker: %s", e)
+            return None
+        answer = dec(worker.stdout.readline()).strip()
+        if answer != 'READY':
+            worker.kill()
+            logging.warning("The persistent SPICE worker did not start, it exited with code %s: %s",
+                            worker.wait(), answer)
+            return None
+        return worker
+
+    def _run(self, spice_args, i=0):
+        """
+        Run SPICE with the command line arguments of spice-1.0.jar.
+        :param i: int : index of the worker to run with, if workers are persistent
+        """
+        if self.persistent and (self.workers[i] is None or self.workers[i].poll() is not None):
+            self.workers[i] = self._start_worker()
+            if self.workers[i] is None:
+                logging.warning("Falling back from the persistent SPICE worker to starting SPICE for every call.")
+                self.persistent = False
+        if not self.persistent:
+            subprocess.check_call(['java', '-jar', '-Xmx{}'.format(self.mem), SPICE_JAR] + spice_args, cwd=SPICE_DIR)
+            return
+
+        worker = self.workers[i]
+        worker.stdin.write(enc('\t'.join(spice_args) + '\n'))
+        worker.stdin.flush()
+        answer = dec(worker.stdout.readline()).strip()
+        if answer != 'OK':
+            raise SpiceException("SPICE failed: {}".format(answer or "the worker exited"))
+
+    def _keep(self, scores):
+        """
+        :param scores: dict : the scores of one segment in the output of SPICE
+        :return: what `compute_score` keeps of them: all the scores if `categories` is None,
+            otherwise the F-score of All followed by the F-scores of the other `categories`
+        """
+        if self.categories is None:
+            return scores
+        return [self.float_convert(scores.get(category, {}).get('f')) for category in self._kept_categories]
+
+    def _score_shard(self, segments, i=0):
+        """
+        :param segments: list of (image id, hypothesis, references) : the input of SPICE
+        :param i: int : index of the worker to run with
+        :return: list of (image id, kept scores) : the output of SPICE, see `_keep`
+        """
+        if os.access(SPICE_DIR, os.W_OK):
+          temp_dir=os.path.join(SPICE_DIR, TEMP_DIR)
+          if not os.path.exists(temp_dir):
+            os.makedirs(temp_dir)
+        else:
+          # e.g. the package is installed in a read-only location
+          temp_dir=None
+        in_file = tempfile.NamedTemporaryFile(delete=False, dir=temp_dir, mode = "w")
+        # The input items are only made while they are written.
+        _write_json_array(in_file, ({"image_id": image_id, "test": test, "refs": refs}
+                                    for image_id, test, refs in segments))
+        in_file.close()
+
+        # Start job
+        out_file = tempfile.NamedTemporaryFile(delete=False, dir=temp_dir)
+        out_file.close()
+        cache_dir=self.cache_dir
+        if not os.path.exists(cache_dir):
+          os.makedirs(cache_dir)
+        spice_args = [in_file.name,
+          '-cache', cache_dir,
+          '-out', out_file.name,
+          '-subset',
+          '-silent'
+        ]
+        if self.processes > 1:
+          # Share the cores between the JVMs, each one parses with all cores by default.
+          spice_args += ['-threads', str(max(1, multiprocessing.cpu_count() // self.processes))]
+        try:
+          self._run(spice_args, i)
+
+          # Read and process results
+          with open(out_file.name) as data_file:
+            return [(item['image_id'], self._keep(item['scores'])) for item in _iter_json_array(data_file)]
+        finally:
+          os.remove(in_file.name)
+          os.remove(out_file.name)
+
+    def _score(self, segments):
+        """
+        :param segments: list of (image id, hypothesis, references) : the input of SPICE
+        :return: list of (image id, kept scores) : the output of SPICE, see `_keep`
+        """
+        # Contiguous shards, one per JVM, so the results are merged in the same order as from a single JVM.
+        chunk_size = max(1, -(-len(segments) // self.processes))
+        shards = [segments[start:start + chunk_size] for start in range(0, len(segments), chunk_size)]
+        with self.lock:
+          if len(shards) <= 1:
+            results = self._score_shard(segments)
+          else:
+            shard_results = [None] * len(shards)
+            errors = []
+
+            def score_shard(i):
+              try:
+                shard_results[i] = self._score_shard(shards[i], i)
+              except Exception as e:
+                errors.append(e)
+
+            threads = [threading.Thread(target=score_shard, args=(i,)) for i in range(len(shards))]
+            for thread in threads:
+              thread.start()
+            for thread in threads:
+              thread.join()
+            if errors:
+              raise errors[0]
+            results = [item for shard_result in shard_results for item in shard_result]
+        return results
+
+    def _score_cached(self, segments):
+        """
+        Like `_score`, but only send the segments which are not in `result_cache` to SPICE.
+        """
+        keys = [json.dumps([test, refs]) for _, test, refs in segments]
+        cached = self.result_cache.get_many(keys, self._result_cache_namespace)
+        # Each distinct segment which is not in the cache is scored once.
+        misses = OrderedDict()
+        for key, segment, scores in zip(keys, segments, cached):
+          if scores is None and key not in misses:
+            misses[key] = segment
+        fresh = {}
+        if misses:
+          # SPICE may answer in any order, the results are matched to the segments by image id.
+          fresh_results = dict(self._score(list(misses.values())))
+          fresh = {key: fresh_results[segment[0]] for key, segment in misses.items()}
+          self.result_cache.put_many(list(fresh), [json.dumps(kept) for kept in fresh.values()],
+                                     self._result_cache_namespace)
+        return [(segment[0], json.loads(kept) if kept is not None else fresh[key])
+                for key, segment, kept in zip(keys, segments, cached)]
+
+    def warm(self, references):
+        """
+        Parse references ahead of time into the cache of SPICE, so that scoring against them later only parses
+        the hypotheses.
+        :param references: list of list of str : the references of each segment
+        """
+        segments = [(i, refs[0], refs) for i, refs in enumerate(references) if refs]
+        if segments:
+          self._score(segments)
+
     def float_convert(self, obj):
         try:
           return float(obj)
@@ -38,8 +377,8 @@ class Spice:
         assert(sorted(gts.keys()) == sorted(res.keys()))
         imgIds = sorted(gts.keys())
         
-        # Prepare temp input file for the SPICE scorer
-        input_data = []
+        # The segments to score, written to the input file of SPICE later
+        segments = []
         for id in imgIds:
             hypo = res[id]
             ref = gts[id]
@@ -50,46 +389,25 @@ class Spice:
             assert(type(ref) is list)
             assert(len(ref) >= 1)
 
-            input_data.append({
-              "image_id" : id,
-              "test" : hypo[0],
-              "refs" : ref
-            })
+            segments.append((id, hypo[0], ref))
 
-        cwd = os.path.dirname(os.path.abspath(__file__))
-        temp_dir=os.path.join(cwd, TEMP_DIR)
-        if not os.path.exists(temp_dir):
-          os.makedirs(temp_dir)
-        in_file = tempfile.NamedTemporaryFile(delete=False, dir=temp_dir, mode = "w")
-        json.dump(input_data, in_file, indent=2)
-        in_file.close()
-
-        # Start job
-        out_file = tempfile.NamedTemporaryFile(delete=False, dir=temp_dir)
-        out_file.close()
-        cache_dir=os.path.join(cwd, CACHE_DIR)
-        if not os.path.exists(cache_dir):
-          os.makedirs(cache_dir)
-        spice_cmd = ['java', '-jar', '-Xmx8G', SPICE_JAR, in_file.name,
-          '-cache', cache_dir,
-          '-out', out_file.name,
-          '-subset',
-          '-silent'
-        ]
-        subprocess.check_call(spice_cmd, 
-            cwd=os.path.dirname(os.path.abspath(__file__)))
+        if self.result_cache is None:
+          results = self._score(segments)
+        else:
+          results = self._score_cached(segments)
 
-        # Read and process results
-        with open(out_file.name) as data_file:    
-          results = json.load(data_file)
-        os.remove(in_file.name)
-        os.remove(out_file.name)
+        if self.categories is not None:
+          imgId_to_scores = dict(results)
+          values = np.array([imgId_to_scores[image_id] for image_id in imgIds], dtype=np.float64)
+          values = values.reshape(len(imgIds), len(self._kept_categories))
+          columns = [self._kept_categories.index(category) for category in self.categories]
+          return np.mean(values[:, 0]), values[:, columns]
 
         imgId_to_scores = {}
         spice_scores = []
-        for item in results:
-          imgId_to_scores[item['image_id']] = item['scores']
-          spice_scores.append(self.float_convert(item['scores']['All']['f']))
+        for image_id, item_scores in results:
+          imgId_to_scores[image_id] = item_scores
+          spice_scores.append(self.float_convert(item_scores['All']['f']))
         average_score = np.mean(np.array(spice_scores))
         scores = []
         for image_id in imgIds:
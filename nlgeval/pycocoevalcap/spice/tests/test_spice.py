@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import io
+import json
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+import six
+
+from nlgeval.pycocoevalcap.segment_cache import SegmentCache
+from nlgeval.pycocoevalcap.spice import spice
+from nlgeval.pycocoevalcap.spice.spice import Spice, _iter_json_array, _write_json_array
+
+# Stands in for java and javac: SPICE scores a caption by the share of its words in the references,
+# `SpiceWorker` answers the protocol of SpiceWorker.java and javac writes an empty class file.
+FAKE_JAVA = '''#!{python}
+import json, os, sys
+
+def log(event):
+    with open(os.path.join(os.environ['FAKE_SPICE_LOG']), 'a') as f:
+        f.write(event + '\\n')
+
+def score(args):
+    out = args[args.index('-out') + 1]
+    with open(args[0]) as f:
+        items = json.load(f)
+    results = []
+    for item in items:
+        test = set(item['test'].split())
+        refs = set(w for ref in item['refs'] for w in ref.split())
+        f_score = len(test & refs) / float(len(test | refs)) if test | refs else 0.0
+        results.append({{'image_id': item['image_id'],
+                         'scores': {{'All': {{'f': f_score, 'pr': f_score, 're': f_score}},
+                                    'Object': {{'f': 'NaN', 'pr': 'NaN', 're': 0.0}}}}}})
+    if os.environ.get('FAKE_SPICE_REVERSE'):
+        results.reverse()
+    log('score %d %s' % (len(items), args[args.index('-cache') + 1]))
+    with open(out, 'w') as f:
+        json.dump(results, f)
+
+name = os.path.basename(sys.argv[0])
+if name == 'javac':
+    if os.environ.get('FAKE_JAVAC_FAIL'):
+        sys.exit(1)
+    d = sys.argv[sys.argv.index('-d') + 1]
+    open(os.path.join(d, 'SpiceWorker.class'), 'w').close()
+    log('javac')
+elif sys.argv[-1] == 'SpiceWorker':
+    log('worker')
+    sys.stdout.write('READY\\n')
+    sys.stdout.flush()
+    for line in iter(sys.stdin.readline, ''):
+        score(line.rstrip('\\n').split('\\t'))
+        sys.stdout.write('OK\\n')
+        sys.stdout.flush()
+else:
+    log('jar')
+    score(sys.argv[sys.argv.index('{jar}') + 1:])
+'''
+
+
+class TestSpice(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        bin_dir = os.path.join(self.dir, 'bin')
+        os.makedirs(bin_dir)
+        for name in ('java', 'javac'):
+            path = os.path.join(bin_dir, name)
+            with io.open(path, 'w') as f:
+                f.write(FAKE_JAVA.format(python=sys.executable, jar=spice.SPICE_JAR))
+            os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+        self.log = os.path.join(self.dir, 'log.txt')
+        self.environ = dict(os.environ)
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+        os.environ['FAKE_SPICE_LOG'] = self.log
+        self.spice_dir = spice.SPICE_DIR
+        spice.SPICE_DIR = os.path.join(self.dir, 'spice')
+        os.makedirs(spice.SPICE_DIR)
+
+        self.gts = {0: ["a cat sat on the mat"], 1: ["a dog", "the dog runs"], 2: ["テスト"]}
+        self.res = {0: ["the cat is on a mat"], 1: ["a dog runs"], 2: ["テスト"]}
+
+    def tearDown(self):
+        spice.SPICE_DIR = self.spice_dir
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.dir)
+
+    def events(self):
+        if not os.path.exists(self.log):
+            return []
+        with open(self.log) as f:
+            return f.read().splitlines()
+
+    def scored(self):
+        # The number of segments of each run of SPICE
+        return [int(e.split()[1]) for e in self.events() if e.startswith('score')]
+
+    def spice(self, **kwargs):
+        return Spice(cache_dir=os.path.join(self.dir, 'cache'), **kwargs)
+
+    def assertScoresEqual(self, expected, actual):
+        self.assertEqual(expected[0], actual[0])
+        self.assertEqual([s['All'] for s in expected[1]], [s['All'] for s in actual[1]])
+
+    def test_compute_score(self):
+        score, scores = self.spice().compute_score(self.gts, self.res)
+        self.assertAlmostEqual(np.mean([5 / 7.0, 3 / 4.0, 1.0]), score)
+        self.assertEqual(3, len(scores))
+        self.assertAlmostEqual(1.0, scores[2]['All']['f'])
+        self.assertTrue(np.isnan(scores[2]['Object']['f']))
+
+    def test_json_array(self):
+        items = [{"image_id": 0, "test": "a, b]", "refs": ["c\\\" d", "テスト"]}, 123456789, -1.5e10, 0.25, True,
+                 None, "x", [], {}, [1, [2, 3]], 0]
+        f = six.StringIO()
+        _write_json_array(f, iter(items))
+        text = f.getvalue()
+        for chunk_size in (1, 2, 3, 7, len(text)):
+            f.seek(0)
+            self.assertEqual(items, list(_iter_json_array(f, chunk_size=chunk_size)))
+
+        for text in ('[]', ' [ ] ', '[\n]\n'):
+            self.assertEqual([], list(_iter_json_array(six.StringIO(text), chunk_size=1)))
+        for text in ('', '{}', '[1, 2', '[{"a": 1'):
+            with self.assertRaises(ValueError):
+                list(_iter_json_array(six.StringIO(text), chunk_size=2))
+
+    def test_keep(self):
+        scores = {'All': {'f': 0.5}, 'Object': {'f': 'NaN'}, 'Relation': {'f': 0.25}}
+        self.assertEqual(scores, self.spice()._keep(scores))
+        self.assertEqual([0.5], self.spice(categories=['All'])._keep(scores))
+        # All comes first and once.
+        kept = self.spice(categories=['Relation', 'All', 'Object'])._keep(scores)
+        self.assertEqual([0.5, 0.25], kept[:2])
+        self.assertTrue(np.isnan(kept[2]))
+
+        score, scores = self.spice(categories=['All']).compute_score(self.gts, self.res)
+        self.assertEqual((3, 1), scores.shape)
+        self.assertAlmostEqual(score, np.mean(scores[:, 0]))
+        score, scores = self.spice(categories=['Object', 'All']).compute_score(self.gts, self.res)
+        self.assertEqual((3, 2), scores.shape)
+        self.assertTrue(np.all(np.isnan(scores[:, 0])))
+        np.testing.assert_allclose([5 / 7.0, 3 / 4.0, 1.0], scores[:, 1])
+
+    def test_result_cache(self):
+        os.environ['FAKE_SPICE_REVERSE'] = '1'
+        gts = dict(self.gts)
+        res = dict(self.res)
+        # The same segment twice
+        gts[3], res[3] = gts[0], res[0]
+        expected = self.spice(categories=['All']).compute_score(gts, res)
+        os.remove(self.log)
+
+        path = os.path.join(self.dir, 'results.db')
+        for _ in range(2):
+            s = self.spice(categories=['All'], result_cache=path)
+            score, scores = s.compute_score(gts, res)
+            s.close()
+            self.assertEqual(expected[0], score)
+            np.testing.assert_array_equal(expected[1], scores)
+        # Each distinct segment was scored once.
+        self.assertEqual([3], self.scored())
+
+        # Only the new segment is scored, whatever the order of the answers of SPICE.
+        gts[4], res[4] = ["a bird"], ["a bird flies"]
+        s = self.spice(categories=['All'], result_cache=path)
+        score, scores = s.compute_score(gts, res)
+        s.close()
+        self.assertEqual([3, 1], self.scored())
+        np.testing.assert_allclose(np.append(expected[1][:, 0], 2 / 3.0), scores[:, 0])
+
+        # The full scores are cached apart from the kept F-scores.
+        s = self.spice(result_cache=path)
+        s.compute_score(gts, res)
+        s.close()
+        self.assertEqual([3, 1, 4], self.scored())
+
+        # A cache given as an object finds the scores cached by path, they are not stored under the bare segments.
+        cache = SegmentCache(path)
+        s = self.spice(categories=['All'], result_cache=cache)
+        self.assertEqual(score, s.compute_score(gts, res)[0])
+        s.close()
+        self.assertEqual([3, 1, 4], self.scored())
+        self.assertEqual([None], cache.get_many([json.dumps([res[0][0], gts[0]])]))
+        cache.close()
+
+    def test_cache_dir(self):
+        cache_dir = os.path.join(self.dir, 'env_cache')
+        os.environ[spice.CACHE_DIR_ENV] = cache_dir
+        s = Spice()
+        self.assertEqual(cache_dir, s.cache_dir)
+        s.compute_score(self.gts, self.res)
+        self.assertTrue(os.path.isdir(cache_dir))
+        self.assertEqual(['jar', 'score 3 ' + cache_dir], self.events())
+
+        # An explicit directory comes first.
+        self.assertEqual(os.path.join(self.dir, 'cache'), self.spice().cache_dir)
+        del os.environ[spice.CACHE_DIR_ENV]
+        self.assertEqual(os.path.join(spice.SPICE_DIR, spice.CACHE_DIR), Spice().cache_dir)
+
+    def test_warm(self):
+        s = self.spice(processes=2)
+        s.warm([["a cat", "the cat"], [], ["a dog"], ["a bird", "birds"]])
+        # Two shards for the three segments with references, parsed into the cache directory.
+        self.assertEqual(['jar', 'jar', 'score 1 ' + s.cache_dir, 'score 2 ' + s.cache_dir], sorted(self.events()))
+
+    def test_persistent(self):
+        expected = self.spice().compute_score(self.gts, self.res)
+        os.remove(self.log)
+
+        s = self.spice(persistent=True)
+        cache = s.cache_dir
+        for _ in range(2):
+            self.assertScoresEqual(expected, s.compute_score(self.gts, self.res))
+        worker = s.workers[0]
+        s.close()
+        self.assertIsNotNone(worker.poll())
+        # Compiled once, one JVM for both calls.
+        self.assertEqual(['javac', 'worker', 'score 3 ' + cache, 'score 3 ' + cache], self.events())
+        # The class file is written to the cache directory, not to the package.
+        self.assertTrue(os.path.exists(os.path.join(spice.worker_dir(cache), spice.SPICE_WORKER + '.class')))
+        self.assertEqual(os.path.join(os.path.abspath(cache), spice.WORKER_DIR), spice.worker_dir(cache))
+        self.assertFalse(os.path.exists(os.path.join(spice.SPICE_DIR, spice.SPICE_WORKER + '.class')))
+
+        # A dead worker is replaced.
+        s = self.spice(persistent=True)
+        s.compute_score(self.gts, self.res)
+        s.workers[0].kill()
+        s.workers[0].wait()
+        self.assertScoresEqual(expected, s.compute_score(self.gts, self.res))
+        s.close()
+        self.assertEqual(3, self.events().count('worker'))
+
+    @unittest.skipUnless(hasattr(unittest.TestCase, 'assertLogs'), "assertLogs is not available.")
+    def test_fallback(self):
+        os.environ['FAKE_JAVAC_FAIL'] = '1'
+        expected = self.spice().compute_score(self.gts, self.res)
+
+        s = self.spice(persistent=True)
+        with self.assertLogs(level='WARNING') as logs:
+            self.assertScoresEqual(expected, s.compute_score(self.gts, self.res))
+        self.assertFalse(s.persistent)
+        self.assertTrue(any('Falling back' in message for message in logs.output))
+        self.assertScoresEqual(expected, s.compute_score(self.gts, self.res))
+        s.close()
+        self.assertNotIn('worker', self.events())
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import gc
+import unittest
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import numpy as np
+
+from nlgeval.pycocoevalcap.bleu.bleu import Bleu
+from nlgeval.pycocoevalcap.cider.cider import Cider
+from nlgeval.pycocoevalcap.ngrams import (CookedSentence, NgramIndex, cook_corpus, count_ngrams, max_counts,
+                                          precook, split_tokens)
+from nlgeval.pycocoevalcap.rouge.rouge import Rouge
+
+
+def as_dict(counts, index):
+    return {index.ngram(g): count for g, count in zip(counts.ngrams.tolist(), counts.counts.tolist())}
+
+
+class TestNgrams(unittest.TestCase):
+    def test_precook(self):
+        s = CookedSentence("a b a", 4)
+        self.assertEqual("a b a", s)
+        words, counts = precook(s, 4, s.index)
+        self.assertEqual(['a', 'b', 'a'], words)
+        self.assertEqual({('a',): 2, ('b',): 1, ('a', 'b'): 1, ('b', 'a'): 1, ('a', 'b', 'a'): 1},
+                         as_dict(counts, s.index))
+        self.assertEqual(np.int64, counts.ngrams.dtype)
+        self.assertEqual(np.int32, counts.counts.dtype)
+        self.assertTrue(np.all(np.diff(counts.ngrams) > 0))
+        self.assertEqual(dict(precook("a b a", 4)[1]), as_dict(counts, s.index))
+        self.assertEqual(as_dict(precook("a b a", 2, s.index)[1], s.index), as_dict(precook(s, 2, s.index)[1], s.index))
+
+    def test_filter_orders(self):
+        index = NgramIndex()
+        CookedSentence("b c d e", 4, index)
+        index.overlay()
+        # the n-grams of the sentence are partly frozen, partly interned since
+        s = CookedSentence("a b c d e a", 4, index)
+        self.assertGreater(len(index.orders.tail), 0)
+        for n in (1, 2, 3):
+            words, counts = precook(s, n, index)
+            self.assertEqual(s.words, words)
+            expected = index.count(s.split(), n)
+            np.testing.assert_array_equal(expected.ngrams, counts.ngrams)
+            np.testing.assert_array_equal(expected.counts, counts.counts)
+
+    def test_index(self):
+        index = NgramIndex()
+        counts = index.count("a b c a b".split(), 3)
+        self.assertEqual(9, len(index))
+        g = index.ngram_id(('a', 'b'))
+        self.assertEqual(2, as_dict(counts, index)[('a', 'b')])
+        self.assertEqual(2, index.orders[g])
+        self.assertEqual(('a', 'b'), index.ngram(g))
+
+        other = NgramIndex()
+        other.count(["b", "d"], 2)
+        translated = other.translate(counts, index)
+        self.assertEqual(as_dict(counts, index), as_dict(translated, other))
+        self.assertTrue(np.all(np.diff(translated.ngrams) > 0))
+
+        maxed = max_counts([index.count("a b a".split(), 2), index.count("b b".split(), 2)])
+        self.assertEqual({('a',): 2, ('b',): 2, ('a', 'b'): 1, ('b', 'a'): 1, ('b', 'b'): 1}, as_dict(maxed, index))
+
+    def test_count_many(self):
+        rng = np.random.RandomState(0)
+        sentences = [["w%d" % w for w in rng.randint(0, 300, rng.randint(0, 20))] for _ in range(2000)]
+        index = NgramIndex()
+        counts = index.count_many([index.intern_tokens(s) for s in sentences], 3)
+        expected = [count_ngrams(s, 3) for s in sentences]
+        # more keys than are kept in a dict before they are merged into the sorted arrays
+        self.assertEqual(len(set().union(*expected)), len(index))
+        self.assertGreater(len(index), 1 << 12)
+        for s, c, e in zip(sentences, counts, expected):
+            self.assertEqual(dict(e), as_dict(c, index))
+        for s, e in zip(sentences[:100], expected):
+            self.assertEqual(dict(e), as_dict(index.count(s, 3), index))
+        self.assertEqual(len(set().union(*expected)), len(index))
+
+    def test_overlay(self):
+        index = NgramIndex()
+        ref = CookedSentence("a b c", 3, index)
+        size = len(index)
+        overlay = index.overlay()
+        self.assertTrue(overlay.extends(index))
+        self.assertFalse(index.extends(overlay))
+
+        cooked_refs, cooked_hyps = cook_corpus({0: [ref]}, {0: ["a b d"]}, 3, overlay)
+        self.assertEqual(size, len(index))
+        self.assertIs(overlay, cooked_refs[0][0].index)
+        self.assertIs(ref.counts, cooked_refs[0][0].counts)
+        self.assertEqual(dict(count_ngrams("a b d".split(), 3)), as_dict(cooked_hyps[0][0].counts, overlay))
+        self.assertEqual(size + 3, len(overlay))
+        self.assertEqual(('b', 'd'), overlay.ngram(overlay.ngram_id(('b', 'd'))))
+        self.assertEqual(size + 3, len(overlay))
+
+        restored = NgramIndex.from_arrays(*(index.to_arrays() + index.sorted_keys()))
+        self.assertEqual(as_dict(ref.counts, index), as_dict(restored.count("a b c".split(), 3), restored))
+        self.assertEqual(size, len(restored))
+
+    def test_split_tokens(self):
+        self.assertEqual(['a', 'b'], split_tokens(CookedSentence("a b")))
+        self.assertEqual(['a', '', 'b'], split_tokens(CookedSentence("a  b")))
+        self.assertEqual([''], split_tokens(CookedSentence("")))
+
+    @unittest.skipUnless(tracemalloc is not None, "tracemalloc is not available")
+    def test_memory(self):
+        # The packed counts of a corpus and the index they were counted with take less than half
+        # the memory of the dicts keyed by tuples of strings which were used before.
+        rng = np.random.RandomState(0)
+        words = ["w%d" % i for i in range(500)]
+        gts = {i: [" ".join(rng.choice(words, rng.randint(5, 20))) for _ in range(5)] for i in range(400)}
+
+        def retained(build):
+            gc.collect()
+            tracemalloc.start()
+            try:
+                held = build()
+                gc.collect()
+                return tracemalloc.get_traced_memory()[0], held
+            finally:
+                tracemalloc.stop()
+
+        def packed():
+            index = NgramIndex()
+            return index, {i: [index.count(s.split()) for s in refs] for i, refs in gts.items()}
+
+        dict_size, _ = retained(lambda: {i: [count_ngrams(s.split()) for s in refs] for i, refs in gts.items()})
+        packed_size, (index, _) = retained(packed)
+        self.assertGreater(len(index), 0)
+        self.assertLess(packed_size, dict_size / 2)
+
+    def test_cooked_scores_match(self):
+        gts = {0: ["this is a test", "this is also a test"],
+               1: ["another  reference here", "one more"]}
+        res = {0: ["this is a good test"],
+               1: ["another reference"]}
+        cooked_gts, cooked_res = cook_corpus(gts, res)
+        for scorer in [Bleu(4), Bleu(2), Cider(), Rouge()]:
+            score, scores = scorer.compute_score(gts, res)
+            cooked_score, cooked_scores = scorer.compute_score(cooked_gts, cooked_res)
+            np.testing.assert_array_equal(score, cooked_score)
+            np.testing.assert_array_equal(scores, cooked_scores)
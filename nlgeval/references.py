@@ -0,0 +1,277 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+"""
+Compiled references: everything nlg-eval computes from the references alone, stored on disk once
+so that scoring many hypothesis files against the same references only processes the hypotheses.
+
+A bundle is a directory with a `manifest.json` and NumPy arrays which are memory-mapped when loaded:
+
+* the tokens and n-grams of the references (`NgramIndex`, with its sorted n-gram keys) and their n-gram counts,
+  used by BLEU, CIDEr and ROUGE-L,
+* the CIDEr document frequencies,
+* the GloVe token ids, average and extrema embeddings of every reference,
+* the skip-thought vectors of every reference.
+"""
+import io
+import json
+import os
+
+import numpy as np
+import six
+
+from nlgeval.pycocoevalcap.cider.cider_scorer import CiderScorer
+from nlgeval.pycocoevalcap.ngrams import CookedSentence, NgramCounts, NgramIndex, cook_corpus
+
+FORMAT = 'nlgeval-compiled-references'
+VERSION = 2
+
+
+class InvalidCompiledReferencesException(Exception):
+    pass
+
+
+class _TokenEmbeddings(object):
+    """
+    The GloVe vectors of the tokens of each reference, looked up when needed.
+    """
+
+    def __init__(self, emb, offsets, ids):
+        self.emb = emb
+        self.offsets = offsets
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.emb.vecs(self.ids[self.offsets[i]:self.offsets[i + 1]])
+
+    def __iter__(self):
+        return (self[i] for i in six.moves.range(len(self)))
+
+
+class CompiledReferences(object):
+    """
+    The references of a corpus with the artifacts derived from them.
+
+    Artifacts are computed lazily by the accessors below and saved by `save` if they were computed.
+    """
+
+    def __init__(self, ref_list, n=4):
+        """
+        :param ref_list: list of list of str : one list per reference source, one reference per segment in each,
+            as for `NLGEval.compute_metrics`
+        :param n: int : maximum n-gram order to count
+        """
+        ref_list = [[r.strip() for r in refs] for refs in zip(*ref_list)]
+        self._init(ref_list, n)
+
+    def _init(self, segments, n):
+        # Segment major: `segments[i]` holds the references of the i-th hypothesis.
+        self.segments = segments
+        self.n = n
+        self._cooked = None
+        self._index = None
+        # (offsets, n-gram ids, counts) of the references in compressed sparse rows, when loaded
+        self._ref_counts = None
+        self._document_frequency = None
+        self._glove = None
+        self._skipthoughts = None
+
+    def __len__(self):
+        return len(self.segments)
+
+    @property
+    def num_references(self):
+        return len(self.segments[0]) if self.segments else 0
+
+    @property
+    def refs(self):
+        """
+        :return: dict : references with the segment index as key, as given to the scorers
+        """
+        return {idx: refs for idx, refs in enumerate(self.segments)}
+
+    def sources(self):
+        """
+        :return: list of list of str : the references of each source, for all segments
+        """
+        return [list(refs) for refs in zip(*self.segments)]
+
+    @property
+    def index(self):
+        """
+        :return: NgramIndex : the index the references are cooked with.  Cook hypotheses with an overlay of it,
+            see `NgramIndex.overlay`, so that scoring them does not add their n-grams to it.
+        """
+        if self._index is None:
+            self.cooked()
+        return self._index
+
+    def cooked(self):
+        """
+        :return: dict : references with their tokens and n-gram counts, see `ngrams.cook_corpus`
+        """
+        if self._cooked is None:
+            if self._ref_counts is not None:
+                # The counts of each reference are views of the memory-mapped arrays, tokens are split when needed.
+                offsets, ref_ngrams, ref_counts = self._ref_counts
+                R = self.num_references
+                self._cooked = {
+                    idx: [CookedSentence.restore(ref,
+                                                 NgramCounts(ref_ngrams[offsets[row]:offsets[row + 1]],
+                                                             ref_counts[offsets[row]:offsets[row + 1]]),
+                                                 self.n, self._index)
+                          for row, ref in enumerate(refs, idx * R)]
+                    for idx, refs in enumerate(self.segments)}
+            else:
+                self._index = NgramIndex()
+                self._cooked, _ = cook_corpus(self.refs, {}, self.n, self._index)
+        return self._cooked
+
+    def document_frequency(self):
+        """
+        :return: array of float : CIDEr document frequency of each n-gram id in `index`
+        """
+        if self._document_frequency is None:
+            cooked = self.cooked()
+            cider_scorer = CiderScorer(n=self.n, index=self._index)
+            for idx in range(len(self)):
+                cider_scorer.cook_append(None, cooked[idx])
+            frequencies = cider_scorer.document_frequency
+            self._document_frequency = np.zeros(len(self._index), dtype=np.float64)
+            if len(frequencies) > 0:
+                self._document_frequency[np.fromiter(frequencies.keys(), dtype=np.int64, count=len(frequencies))] = \
+                    np.fromiter(frequencies.values(), dtype=np.float64, count=len(frequencies))
+        return self._document_frequency
+
+    def glove(self, emb):
+        """
+        :param emb: Embedding
+        :return: list : for each source, the (token embeddings, average embeddings, extrema embeddings)
+            of its references, as expected by `eval_emb_metrics`
+        """
+        if self._glove is None:
+            from nltk.tokenize import word_tokenize
+            from nlgeval.word2vec.evaluate import pool_embeddings
+
+            self._glove = []
+            for refsource in self.sources():
+                ids = [[emb[word] for word in word_tokenize(ref)] for ref in refsource]
+                offsets = np.cumsum([0] + [len(i) for i in ids], dtype=np.int64)
+                ids = np.array([t for i in ids for t in i], dtype=np.int64)
+                pooled = [pool_embeddings(emb.vecs(ids[offsets[i]:offsets[i + 1]])) for i in range(len(refsource))]
+                avg_embs = np.array([p[0] for p in pooled], dtype=np.float32)
+                extreme_embs = np.array([p[1] for p in pooled], dtype=np.float32)
+                self._glove.append((offsets, ids, avg_embs, extreme_embs))
+        return [(_TokenEmbeddings(emb, offsets, ids), avg_embs, extreme_embs)
+                for offsets, ids, avg_embs, extreme_embs in self._glove]
+
+    def skipthoughts(self, encoder):
+        """
+        :param encoder: skipthoughts.Encoder
+        :return: list of array : for each source, the skip-thought vectors of its references
+        """
+        if self._skipthoughts is None:
+            self._skipthoughts = [encoder.encode(refsource, verbose=False) for refsource in self.sources()]
+        return self._skipthoughts
+
+    def save(self, path):
+        """
+        Write the references and the artifacts computed so far to the directory `path`.
+        The n-gram counts and CIDEr document frequencies are always written.
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        with io.open(os.path.join(path, 'references.jsonl'), 'w', encoding='utf-8') as f:
+            for refs in self.segments:
+                f.write(six.text_type(json.dumps(refs, ensure_ascii=False)))
+                f.write(u'\n')
+
+        cooked = self.cooked()
+        tokens, orders, prefixes, last_tokens = self._index.to_arrays()
+        with io.open(os.path.join(path, 'ngram_tokens.txt'), 'w', encoding='utf-8') as f:
+            f.write(u'\n'.join(tokens))
+        np.save(os.path.join(path, 'ngram_orders.npy'), orders)
+        np.save(os.path.join(path, 'ngram_prefixes.npy'), prefixes)
+        np.save(os.path.join(path, 'ngram_last_tokens.npy'), last_tokens)
+        keys, key_ids = self._index.sorted_keys()
+        np.save(os.path.join(path, 'ngram_keys.npy'), keys)
+        np.save(os.path.join(path, 'ngram_key_ids.npy'), key_ids)
+
+        # The counts of all references in compressed sparse rows, reference r of segment i is row i * R + r.
+        counts = [ref.counts for idx in range(len(self)) for ref in cooked[idx]]
+        np.save(os.path.join(path, 'ref_offsets.npy'),
+                np.cumsum([0] + [len(c.ngrams) for c in counts], dtype=np.int64))
+        np.save(os.path.join(path, 'ref_ngrams.npy'),
+                np.concatenate([c.ngrams for c in counts]) if counts else np.zeros(0, dtype=np.int64))
+        np.save(os.path.join(path, 'ref_counts.npy'),
+                np.concatenate([c.counts for c in counts]) if counts else np.zeros(0, dtype=np.int32))
+
+        np.save(os.path.join(path, 'cider_document_frequency.npy'), self.document_frequency())
+
+        artifacts = ['ngrams', 'cider']
+        if self._glove is not None:
+            for r, (offsets, ids, avg_embs, extreme_embs) in enumerate(self._glove):
+                np.save(os.path.join(path, 'glove_offsets_%d.npy' % r), offsets)
+                np.save(os.path.join(path, 'glove_ids_%d.npy' % r), ids)
+                np.save(os.path.join(path, 'glove_average_%d.npy' % r), avg_embs)
+                np.save(os.path.join(path, 'glove_extrema_%d.npy' % r), extreme_embs)
+            artifacts.append('glove')
+        if self._skipthoughts is not None:
+            for r, vectors in enumerate(self._skipthoughts):
+                np.save(os.path.join(path, 'skipthoughts_%d.npy' % r), np.asarray(vectors))
+            artifacts.append('skipthoughts')
+
+        manifest = dict(format=FORMAT, version=VERSION,
+                        num_segments=len(self), num_references=self.num_references,
+                        n=self.n, artifacts=artifacts)
+        with open(os.path.join(path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load references saved with `save`. Arrays are memory-mapped, and neither the n-grams nor the tokens of
+        the references are processed again.
+        """
+        try:
+            with open(os.path.join(path, 'manifest.json'), 'r') as f:
+                manifest = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            raise InvalidCompiledReferencesException("Could not read compiled references in {}: {}".format(path, e))
+        if manifest.get('format') != FORMAT or manifest.get('version') != VERSION:
+            raise InvalidCompiledReferencesException(
+                "Unsupported compiled references in {}: format {} version {}, expected {} version {}.".format(
+                    path, manifest.get('format'), manifest.get('version'), FORMAT, VERSION))
+
+        def load_array(name):
+            return np.load(os.path.join(path, name), mmap_mode='r')
+
+        with io.open(os.path.join(path, 'references.jsonl'), 'r', encoding='utf-8') as f:
+            segments = [json.loads(line) for line in f]
+        assert len(segments) == manifest['num_segments']
+
+        self = cls.__new__(cls)
+        n = manifest['n']
+        self._init(segments, n)
+
+        with io.open(os.path.join(path, 'ngram_tokens.txt'), 'r', encoding='utf-8') as f:
+            tokens = f.read()
+        tokens = tokens.split(u'\n') if tokens else []
+        self._index = NgramIndex.from_arrays(tokens, load_array('ngram_orders.npy'),
+                                             load_array('ngram_prefixes.npy'), load_array('ngram_last_tokens.npy'),
+                                             load_array('ngram_keys.npy'), load_array('ngram_key_ids.npy'))
+        self._ref_counts = (load_array('ref_offsets.npy').tolist(), load_array('ref_ngrams.npy'),
+                            load_array('ref_counts.npy'))
+        self._document_frequency = load_array('cider_document_frequency.npy')
+
+        R = self.num_references
+        if 'glove' in manifest['artifacts']:
+            self._glove = [(load_array('glove_offsets_%d.npy' % r), load_array('glove_ids_%d.npy' % r),
+                            load_array('glove_average_%d.npy' % r), load_array('glove_extrema_%d.npy' % r))
+                           for r in range(R)]
+        if 'skipthoughts' in manifest['artifacts']:
+            self._skipthoughts = [load_array('skipthoughts_%d.npy' % r) for r in range(R)]
+        return self
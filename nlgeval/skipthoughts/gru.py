@@ -0,0 +1,54 @@
+'''
+The GRU layers of the skip-thought encoders, in NumPy.
+'''
+import numpy
+from scipy.special import expit
+
+
+def _p(pp, name):
+    """
+    make prefix-appended name
+    """
+    return '%s_%s'%(pp, name)
+
+
+def fuse_gru_params(params, prefix='gru'):
+    """
+    Concatenate the parameters of a GRU layer so that each step needs one matrix multiply:
+    W and Wx project the input for the gates and the candidate state, U and Ux project the previous state
+    """
+    return dict(W=numpy.concatenate([params[_p(prefix, 'W')], params[_p(prefix, 'Wx')]], axis=1),
+                b=numpy.concatenate([params[_p(prefix, 'b')], params[_p(prefix, 'bx')]]),
+                U=numpy.concatenate([params[_p(prefix, 'U')], params[_p(prefix, 'Ux')]], axis=1))
+
+
+def gru_layer(layer, state_below, mask=None):
+    """
+    Forward pass through GRU layer
+    :param layer: dict : parameters from `fuse_gru_params`
+    :param state_below: array of float32 : (nsteps, n_samples, nin) inputs
+    :param mask: array of float32 : (nsteps, n_samples), 0 where the state should not change
+    :return: array of float32 : (n_samples, dim) the last hidden state
+    """
+    nsteps, n_samples = state_below.shape[:2]
+    dim = layer['U'].shape[0]
+    if mask is None:
+        mask = numpy.ones((nsteps, n_samples), dtype='float32')
+
+    # The input projections of all the steps in one matrix multiply
+    state_below_ = numpy.dot(state_below.reshape(nsteps * n_samples, -1), layer['W'])
+    state_below_ = state_below_.reshape(nsteps, n_samples, 3 * dim) + layer['b']
+
+    h = numpy.zeros((n_samples, dim), dtype='float32')
+    for m_, x_ in zip(mask[:, :, None], state_below_):
+        preact = numpy.dot(h, layer['U'])
+
+        ru = expit(preact[:, :2 * dim] + x_[:, :2 * dim])
+        r = ru[:, :dim]
+        u = ru[:, dim:]
+
+        hx = numpy.tanh(preact[:, 2 * dim:] * r + x_[:, 2 * dim:])
+
+        h_ = u * h + (1. - u) * hx
+        h = m_ * h_ + (1. - m_) * h
+    return h
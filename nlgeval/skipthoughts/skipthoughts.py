@@ -1,23 +1,19 @@
 '''
 Skip-thought vectors
 '''
-import copy
 import os
-from collections import OrderedDict, defaultdict
+from collections import OrderedDict
 
 import nltk
 import numpy
-import six
-import theano
-import theano.tensor as tensor
 from nltk.tokenize import word_tokenize
 from scipy.linalg import norm
 from six.moves import cPickle as pkl
+from nlgeval.skipthoughts import tables
+from nlgeval.skipthoughts.gru import _p, fuse_gru_params, gru_layer
 from nlgeval.utils import get_data_dir
 import logging
 
-profile = False
-
 #-----------------------------------------------------------------------------#
 # Specify model and table locations here
 #-----------------------------------------------------------------------------#
@@ -41,19 +37,12 @@ def load_model():
         boptions = pkl.load(f)
 
     # Load parameters
-    uparams = init_params(uoptions)
-    uparams = load_params(path_to_umodel, uparams)
-    utparams = init_tparams(uparams)
-    bparams = init_params_bi(boptions)
-    bparams = load_params(path_to_bmodel, bparams)
-    btparams = init_tparams(bparams)
+    uparams = load_params(path_to_umodel, ['encoder'])
+    bparams = load_params(path_to_bmodel, ['encoder', 'encoder_r'])
 
     # Extractor functions
-    # print 'Compiling encoders...'
-    embedding, x_mask, ctxw2v = build_encoder(utparams, uoptions)
-    f_w2v = theano.function([embedding, x_mask], ctxw2v, name='f_w2v')
-    embedding, x_mask, ctxw2v = build_encoder_bi(btparams, boptions)
-    f_w2v2 = theano.function([embedding, x_mask], ctxw2v, name='f_w2v2')
+    f_w2v = build_encoder(uparams, uoptions)
+    f_w2v2 = build_encoder_bi(bparams, boptions)
 
     # Tables
     # print 'Loading tables...'
@@ -74,18 +63,9 @@ def load_model():
 
 def load_tables():
     """
-    Load the tables
+    Load the tables, as memory-mapped `tables.WordTable`s
     """
-    words = []
-    utable = numpy.load(os.path.join(path_to_tables, 'utable.npy'), allow_pickle=True, encoding='bytes')
-    btable = numpy.load(os.path.join(path_to_tables, 'btable.npy'), allow_pickle=True,  encoding='bytes')
-    f = open(os.path.join(path_to_tables, 'dictionary.txt'), 'rb')
-    for line in f:
-        words.append(line.decode('utf-8').strip())
-    f.close()
-    utable = OrderedDict(zip(words, utable))
-    btable = OrderedDict(zip(words, btable))
-    return utable, btable
+    return tables.load_tables(path_to_tables)
 
 
 class Encoder(object):
@@ -96,77 +76,94 @@ class Encoder(object):
     def __init__(self, model):
       self._model = model
 
-    def encode(self, X, use_norm=True, verbose=True, batch_size=128, use_eos=False):
+    def encode(self, X, use_norm=True, verbose=True, batch_size=128, use_eos=False,
+               batch_tokens=4096, max_padding=0.2):
       """
       Encode sentences in the list X. Each entry will return a vector
       """
-      return encode(self._model, X, use_norm, verbose, batch_size, use_eos)
+      return encode(self._model, X, use_norm, verbose, batch_size, use_eos, batch_tokens, max_padding)
 
 
-def encode(model, X, use_norm=True, verbose=True, batch_size=128, use_eos=False):
+def encode(model, X, use_norm=True, verbose=True, batch_size=128, use_eos=False,
+           batch_tokens=4096, max_padding=0.2):
     """
     Encode sentences in the list X. Each entry will return a vector
+    :param batch_size: int : maximum number of sentences in a batch
+    :param batch_tokens: int : maximum number of steps times sentences in a batch, including padding
+    :param max_padding: float : maximum fraction of padding steps in a batch, 0 only batches sentences of equal length
     """
     # first, do preprocessing
     X = preprocess(X)
 
-    # word dictionary and init
-    d = defaultdict(lambda : 0)
-    for w in model['utable'].keys():
-        d[w] = 1
+    # word rows, both tables share the vocabulary
+    vocabulary = model['utable'].vocabulary
+    utable = model['utable'].vectors
+    btable = model['btable'].vectors
+    unk, eos = vocabulary.rows(['UNK', '<eos>'])
     ufeatures = numpy.zeros((len(X), model['uoptions']['dim']), dtype='float32')
     bfeatures = numpy.zeros((len(X), 2 * model['boptions']['dim']), dtype='float32')
 
-    # length dictionary
-    ds = defaultdict(list)
     captions = [s.split() for s in X]
-    for i,s in enumerate(captions):
-        ds[len(s)].append(i)
-
-    # Get features. This encodes by length, in order to avoid wasting computation
-    for k in ds.keys():
+    lengths = numpy.array([len(s) for s in captions], dtype=numpy.int64)
+    rows = vocabulary.rows([w for s in captions for w in s], default=unk)
+    rows = numpy.append(rows, unk)
+    starts = numpy.cumsum(numpy.append(0, lengths))[:-1]
+
+    # Get features. Sentences of similar lengths are batched together, the shorter ones padded and masked.
+    for caps in _length_batches(lengths + use_eos, batch_size, batch_tokens, max_padding):
+        caps_lengths = lengths[caps][:, None]
+        steps = numpy.arange(caps_lengths.max() + use_eos)
+        # (steps, len(caps)) rows of the words, gathered from the tables at once
+        caps_rows = numpy.where(steps < caps_lengths,
+                                rows[numpy.minimum(starts[caps][:, None] + steps, len(rows) - 1)], unk)
+        if use_eos:
+            caps_rows[steps == caps_lengths] = eos
+        caps_rows = caps_rows.T
+        mask = (steps < caps_lengths + use_eos).T.astype('float32')
         if verbose:
-            print(k)
-        numbatches = int(len(ds[k]) / batch_size + 1)
-        for minibatch in range(numbatches):
-            caps = ds[k][minibatch::numbatches]
-
-            if use_eos:
-                uembedding = numpy.zeros((k+1, len(caps), model['uoptions']['dim_word']), dtype='float32')
-                bembedding = numpy.zeros((k+1, len(caps), model['boptions']['dim_word']), dtype='float32')
-            else:
-                uembedding = numpy.zeros((k, len(caps), model['uoptions']['dim_word']), dtype='float32')
-                bembedding = numpy.zeros((k, len(caps), model['boptions']['dim_word']), dtype='float32')
-            for ind, c in enumerate(caps):
-                caption = captions[c]
-                for j in range(len(caption)):
-                    if d[caption[j]] > 0:
-                        uembedding[j,ind] = model['utable'][caption[j]]
-                        bembedding[j,ind] = model['btable'][caption[j]]
-                    else:
-                        uembedding[j,ind] = model['utable']['UNK']
-                        bembedding[j,ind] = model['btable']['UNK']
-                if use_eos:
-                    uembedding[-1,ind] = model['utable']['<eos>']
-                    bembedding[-1,ind] = model['btable']['<eos>']
-            if use_eos:
-                uff = model['f_w2v'](uembedding, numpy.ones((len(caption)+1,len(caps)), dtype='float32'))
-                bff = model['f_w2v2'](bembedding, numpy.ones((len(caption)+1,len(caps)), dtype='float32'))
-            else:
-                uff = model['f_w2v'](uembedding, numpy.ones((len(caption),len(caps)), dtype='float32'))
-                bff = model['f_w2v2'](bembedding, numpy.ones((len(caption),len(caps)), dtype='float32'))
-            if use_norm:
-                for j in range(len(uff)):
-                    uff[j] /= norm(uff[j])
-                    bff[j] /= norm(bff[j])
-            for ind, c in enumerate(caps):
-                ufeatures[c] = uff[ind]
-                bfeatures[c] = bff[ind]
-    
+            print(len(steps))
+        uembedding = numpy.asarray(utable[caps_rows.ravel()], dtype='float32').reshape(
+            caps_rows.shape + (model['uoptions']['dim_word'],))
+        bembedding = numpy.asarray(btable[caps_rows.ravel()], dtype='float32').reshape(
+            caps_rows.shape + (model['boptions']['dim_word'],))
+        uff = model['f_w2v'](uembedding, mask)
+        bff = model['f_w2v2'](bembedding, mask)
+        if use_norm:
+            uff /= numpy.linalg.norm(uff, axis=1, keepdims=True)
+            bff /= numpy.linalg.norm(bff, axis=1, keepdims=True)
+        ufeatures[caps] = uff
+        bfeatures[caps] = bff
+
     features = numpy.c_[ufeatures, bfeatures]
     return features
 
 
+def _length_batches(lengths, batch_size, batch_tokens, max_padding):
+    """
+    Split sentences into batches of similar lengths.
+    :param lengths: array of int : number of steps of each sentence
+    :return: list of array of int : the indices of the sentences of each batch
+    """
+    order = numpy.argsort(lengths, kind='mergesort')
+    batches = []
+    batch = []
+    batch_steps = 0
+    for i in order:
+        # Sorted by length, so adding a sentence pads the batch to its length.
+        padded = (len(batch) + 1) * lengths[i]
+        if batch and (len(batch) >= batch_size or
+                      (batch_tokens is not None and padded > batch_tokens) or
+                      padded - (batch_steps + lengths[i]) > max_padding * padded):
+            batches.append(numpy.array(batch))
+            batch = []
+            batch_steps = 0
+        batch.append(i)
+        batch_steps += lengths[i]
+    if batch:
+        batches.append(numpy.array(batch))
+    return batches
+
+
 def preprocess(text):
     """
     Preprocess text for encoder
@@ -205,11 +202,8 @@ def word_features(table):
     """
     Extract word features into a normalized matrix
     """
-    features = numpy.zeros((len(table), 620), dtype='float32')
-    keys = table.keys()
-    for i in range(len(table)):
-        f = table[keys[i]]
-        features[i] = f / norm(f)
+    features = numpy.array(table.vectors, dtype='float32')
+    features /= numpy.linalg.norm(features, axis=1, keepdims=True)
     return features
 
 
@@ -228,214 +222,41 @@ def nn_words(table, wordvecs, query, k=10):
         print(w)
 
 
-def _p(pp, name):
-    """
-    make prefix-appended name
-    """
-    return '%s_%s'%(pp, name)
-
-
-def init_tparams(params):
-    """
-    initialize Theano shared variables according to the initial parameters
-    """
-    tparams = OrderedDict()
-    for kk, pp in six.iteritems(params):
-        tparams[kk] = theano.shared(params[kk], name=kk)
-    return tparams
-
-
-def load_params(path, params):
-    """
-    load parameters
-    """
-    pp = numpy.load(path)
-    for kk, vv in six.iteritems(params):
-        if kk not in pp:
-            logging.warning('%s is not in the archive', kk)
-            continue
-        params[kk] = pp[kk]
-    return params
-
-
-# layers: 'name': ('parameter initializer', 'feedforward')
-layers = {'gru': ('param_init_gru', 'gru_layer')}
-
-def get_layer(name):
-    fns = layers[name]
-    return (eval(fns[0]), eval(fns[1]))
-
-
-def init_params(options):
-    """
-    initialize all parameters needed for the encoder
-    """
-    params = OrderedDict()
-
-    # embedding
-    params['Wemb'] = norm_weight(options['n_words_src'], options['dim_word'])
-
-    # encoder: GRU
-    params = get_layer(options['encoder'])[0](options, params, prefix='encoder',
-                                              nin=options['dim_word'], dim=options['dim'])
-    return params
-
-
-def init_params_bi(options):
+def load_params(path, prefixes):
     """
-    initialize all paramters needed for bidirectional encoder
+    load the parameters of the GRU layers named by prefixes
     """
     params = OrderedDict()
-
-    # embedding
-    params['Wemb'] = norm_weight(options['n_words_src'], options['dim_word'])
-
-    # encoder: GRU
-    params = get_layer(options['encoder'])[0](options, params, prefix='encoder',
-                                              nin=options['dim_word'], dim=options['dim'])
-    params = get_layer(options['encoder'])[0](options, params, prefix='encoder_r',
-                                              nin=options['dim_word'], dim=options['dim'])
+    with numpy.load(path) as pp:
+        for prefix in prefixes:
+            for kk in ('W', 'b', 'U', 'Wx', 'bx', 'Ux'):
+                params[_p(prefix, kk)] = pp[_p(prefix, kk)].astype('float32')
     return params
 
 
-def build_encoder(tparams, options):
+def build_encoder(params, options):
     """
     build an encoder, given pre-computed word embeddings
+    :return: function (embedding, x_mask) -> the last hidden state of each sample
     """
-    # word embedding (source)
-    embedding = tensor.tensor3('embedding', dtype='float32')
-    x_mask = tensor.matrix('x_mask', dtype='float32')
+    assert options['encoder'] == 'gru'
+    layer = fuse_gru_params(params, prefix='encoder')
 
-    # encoder
-    proj = get_layer(options['encoder'])[1](tparams, embedding, options,
-                                            prefix='encoder',
-                                            mask=x_mask)
-    ctx = proj[0][-1]
+    def f_w2v(embedding, x_mask):
+        return gru_layer(layer, embedding, mask=x_mask)
+    return f_w2v
 
-    return embedding, x_mask, ctx
 
-
-def build_encoder_bi(tparams, options):
+def build_encoder_bi(params, options):
     """
     build bidirectional encoder, given pre-computed word embeddings
+    :return: function (embedding, x_mask) -> the last hidden states of the forward and backward GRUs
     """
-    # word embedding (source)
-    embedding = tensor.tensor3('embedding', dtype='float32')
-    embeddingr = embedding[::-1]
-    x_mask = tensor.matrix('x_mask', dtype='float32')
-    xr_mask = x_mask[::-1]
-
-    # encoder
-    proj = get_layer(options['encoder'])[1](tparams, embedding, options,
-                                            prefix='encoder',
-                                            mask=x_mask)
-    projr = get_layer(options['encoder'])[1](tparams, embeddingr, options,
-                                             prefix='encoder_r',
-                                             mask=xr_mask)
-
-    ctx = tensor.concatenate([proj[0][-1], projr[0][-1]], axis=1)
-
-    return embedding, x_mask, ctx
-
-
-# some utilities
-def ortho_weight(ndim):
-    W = numpy.random.randn(ndim, ndim)
-    u, s, v = numpy.linalg.svd(W)
-    return u.astype('float32')
-
-
-def norm_weight(nin,nout=None, scale=0.1, ortho=True):
-    if nout == None:
-        nout = nin
-    if nout == nin and ortho:
-        W = ortho_weight(nin)
-    else:
-        W = numpy.random.uniform(low=-scale, high=scale, size=(nin, nout))
-    return W.astype('float32')
-
-
-def param_init_gru(options, params, prefix='gru', nin=None, dim=None):
-    """
-    parameter init for GRU
-    """
-    if nin == None:
-        nin = options['dim_proj']
-    if dim == None:
-        dim = options['dim_proj']
-    W = numpy.concatenate([norm_weight(nin,dim),
-                           norm_weight(nin,dim)], axis=1)
-    params[_p(prefix,'W')] = W
-    params[_p(prefix,'b')] = numpy.zeros((2 * dim,)).astype('float32')
-    U = numpy.concatenate([ortho_weight(dim),
-                           ortho_weight(dim)], axis=1)
-    params[_p(prefix,'U')] = U
-
-    Wx = norm_weight(nin, dim)
-    params[_p(prefix,'Wx')] = Wx
-    Ux = ortho_weight(dim)
-    params[_p(prefix,'Ux')] = Ux
-    params[_p(prefix,'bx')] = numpy.zeros((dim,)).astype('float32')
-
-    return params
-
-
-def gru_layer(tparams, state_below, options, prefix='gru', mask=None, **kwargs):
-    """
-    Forward pass through GRU layer
-    """
-    nsteps = state_below.shape[0]
-    if state_below.ndim == 3:
-        n_samples = state_below.shape[1]
-    else:
-        n_samples = 1
-
-    dim = tparams[_p(prefix,'Ux')].shape[1]
-
-    if mask == None:
-        mask = tensor.alloc(1., state_below.shape[0], 1)
-
-    def _slice(_x, n, dim):
-        if _x.ndim == 3:
-            return _x[:, :, n*dim:(n+1)*dim]
-        return _x[:, n*dim:(n+1)*dim]
-
-    state_below_ = tensor.dot(state_below, tparams[_p(prefix, 'W')]) + tparams[_p(prefix, 'b')]
-    state_belowx = tensor.dot(state_below, tparams[_p(prefix, 'Wx')]) + tparams[_p(prefix, 'bx')]
-    U = tparams[_p(prefix, 'U')]
-    Ux = tparams[_p(prefix, 'Ux')]
-
-    def _step_slice(m_, x_, xx_, h_, U, Ux):
-        preact = tensor.dot(h_, U)
-        preact += x_
-
-        r = tensor.nnet.sigmoid(_slice(preact, 0, dim))
-        u = tensor.nnet.sigmoid(_slice(preact, 1, dim))
-
-        preactx = tensor.dot(h_, Ux)
-        preactx = preactx * r
-        preactx = preactx + xx_
-
-        h = tensor.tanh(preactx)
-
-        h = u * h_ + (1. - u) * h
-        h = m_[:,None] * h + (1. - m_)[:,None] * h_
-
-        return h
-
-    seqs = [mask, state_below_, state_belowx]
-    _step = _step_slice
-
-    rval, updates = theano.scan(_step,
-                                sequences=seqs,
-                                outputs_info = [tensor.alloc(0., n_samples, dim)],
-                                non_sequences = [tparams[_p(prefix, 'U')],
-                                                 tparams[_p(prefix, 'Ux')]],
-                                name=_p(prefix, '_layers'),
-                                n_steps=nsteps,
-                                profile=profile,
-                                strict=True)
-    rval = [rval]
-    return rval
-
+    assert options['encoder'] == 'gru'
+    layer = fuse_gru_params(params, prefix='encoder')
+    layer_r = fuse_gru_params(params, prefix='encoder_r')
 
+    def f_w2v2(embedding, x_mask):
+        return numpy.concatenate([gru_layer(layer, embedding, mask=x_mask),
+                                  gru_layer(layer_r, embedding[::-1], mask=x_mask[::-1])], axis=1)
+    return f_w2v2
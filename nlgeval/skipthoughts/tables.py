@@ -0,0 +1,205 @@
+'''
+Skip-thought word tables as memory-mapped arrays.
+
+`utable.npy` and `btable.npy` hold one pickled vector per word of `dictionary.txt`.
+They are converted once to dense float32 matrices with one row per word, and the vocabulary
+to sorted 64 bit hashes of the words with the row of each word, all saved as `.npy` files
+which are memory-mapped when loaded: loading takes milliseconds and processes share the pages.
+'''
+import hashlib
+import io
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy
+import six
+
+TABLES = ('utable', 'btable')
+DICTIONARY = 'dictionary.txt'
+VOCAB_HASHES = 'vocab_hashes.npy'
+VOCAB_ROWS = 'vocab_rows.npy'
+
+# Atomic on POSIX and Windows, `os.rename` on Python 2.
+_replace = getattr(os, 'replace', os.rename)
+
+
+def _matrix_path(path, table):
+    return os.path.join(path, '%s.f32.npy' % table)
+
+
+def hash_words(words):
+    """
+    :param words: list of str
+    :return: array of uint64 : a hash of each word
+    """
+    digests = b''.join(hashlib.md5(w.encode('utf-8') if isinstance(w, six.text_type) else w).digest()[:8]
+                       for w in words)
+    return numpy.frombuffer(digests, dtype='<u8').astype(numpy.uint64)
+
+
+class Vocabulary(object):
+    """
+    Maps words to rows of the word tables.
+
+    Words are found by binary search of their hash, so the index is two flat arrays.
+    A word which is not in the vocabulary could only be mistaken for one which is if their 64 bit hashes collide.
+    """
+
+    def __init__(self, hashes, rows, path=None):
+        """
+        :param hashes: array of uint64 : sorted hashes of the words
+        :param rows: array of int : the row of each word
+        :param path: str : directory of `dictionary.txt`, to list the words
+        """
+        self.hashes = hashes
+        self.word_rows = rows
+        self.path = path
+        self._words = None
+
+    @classmethod
+    def from_words(cls, words, path=None):
+        hashes = hash_words(words)
+        order = numpy.argsort(hashes, kind='mergesort')
+        hashes = hashes[order]
+        # A word which appears twice maps to its last row, as when the tables were dicts.
+        last = numpy.append(hashes[1:] != hashes[:-1], True)
+        return cls(hashes[last], order[last].astype(numpy.int64), path)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __contains__(self, word):
+        return self.rows([word])[0] >= 0
+
+    def rows(self, words, default=-1):
+        """
+        :param words: list of str
+        :param default: int : row of the words which are not in the vocabulary
+        :return: array of int64 : the row of each word
+        """
+        if len(words) == 0:
+            return numpy.zeros(0, dtype=numpy.int64)
+        hashes = hash_words(words)
+        pos = numpy.searchsorted(self.hashes, hashes)
+        pos[pos == len(self.hashes)] = 0
+        found = self.hashes[pos] == hashes
+        return numpy.where(found, self.word_rows[pos], default).astype(numpy.int64)
+
+    @property
+    def words(self):
+        """
+        :return: list of str : the word of each row
+        """
+        if self._words is None:
+            self._words = read_dictionary(self.path)
+        return self._words
+
+    def keys(self):
+        return self.words
+
+
+class WordTable(object):
+    """
+    Word vectors, one row per word of a `Vocabulary`.
+    """
+
+    def __init__(self, vocabulary, vectors):
+        """
+        :param vocabulary: Vocabulary
+        :param vectors: array of float32 : one row per word
+        """
+        self.vocabulary = vocabulary
+        self.vectors = vectors
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def __contains__(self, word):
+        return word in self.vocabulary
+
+    def __getitem__(self, word):
+        row = self.vocabulary.rows([word])[0]
+        if row < 0:
+            raise KeyError(word)
+        return self.vectors[row]
+
+    def keys(self):
+        return self.vocabulary.words
+
+
+def read_dictionary(path):
+    with io.open(os.path.join(path, DICTIONARY), 'rb') as f:
+        return [line.decode('utf-8').strip() for line in f]
+
+
+def _load_pickled_table(path, table):
+    vectors = numpy.load(os.path.join(path, '%s.npy' % table), allow_pickle=True, encoding='bytes')
+    if vectors.dtype == object:
+        dim = numpy.asarray(vectors[0]).size
+        matrix = numpy.empty((len(vectors), dim), dtype=numpy.float32)
+        for i, v in enumerate(vectors):
+            matrix[i] = numpy.asarray(v, dtype=numpy.float32).reshape(dim)
+        return matrix
+    return numpy.asarray(vectors, dtype=numpy.float32).reshape(len(vectors), -1)
+
+
+def _save(path, target, array):
+    """
+    Save an array to the file `target` in the directory `path` through a temporary file of its own,
+    so that processes converting at once never write to, or move into place, a file another one is writing,
+    and a file which is memory-mapped is replaced rather than overwritten.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=path, suffix='.npy')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            numpy.save(f, array)
+        # Readable by whoever can read the tables, rather than only by the owner as made by `mkstemp`.
+        shutil.copymode(os.path.join(path, DICTIONARY), tmp_path)
+        _replace(tmp_path, target)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def convert_tables(path):
+    """
+    Convert the tables in the directory `path` to memory-mappable arrays, stored in the same directory.
+    :return: (vocabulary, {table name: matrix})
+    """
+    vocabulary = Vocabulary.from_words(read_dictionary(path), path)
+    matrices = {}
+    for table in TABLES:
+        matrices[table] = _load_pickled_table(path, table)
+        _save(path, _matrix_path(path, table), matrices[table])
+    # The vocabulary hashes are moved into place last: `load_tables` only loads the converted tables once they
+    # exist, so a partial conversion is never loaded.
+    _save(path, os.path.join(path, VOCAB_ROWS), vocabulary.word_rows)
+    _save(path, os.path.join(path, VOCAB_HASHES), vocabulary.hashes)
+    return vocabulary, matrices
+
+
+def load_tables(path):
+    """
+    Load the word tables, converting them first if needed.
+    :param path: str : directory of the tables and `dictionary.txt`
+    :return: (utable, btable) : WordTable
+    """
+    converted = [os.path.join(path, VOCAB_HASHES), os.path.join(path, VOCAB_ROWS)] + \
+                [_matrix_path(path, table) for table in TABLES]
+    if all(os.path.exists(p) for p in converted):
+        vocabulary = Vocabulary(numpy.load(os.path.join(path, VOCAB_HASHES), mmap_mode='r'),
+                                numpy.load(os.path.join(path, VOCAB_ROWS), mmap_mode='r'), path)
+        matrices = {table: numpy.load(_matrix_path(path, table), mmap_mode='r') for table in TABLES}
+    else:
+        logging.info("Converting the skip-thought tables in %s, this is only done once.", path)
+        try:
+            vocabulary, matrices = convert_tables(path)
+        except (IOError, OSError):
+            logging.warning("Could not save the converted skip-thought tables in %s, "
+                            "they will be converted again next time.", path, exc_info=True)
+            vocabulary = Vocabulary.from_words(read_dictionary(path), path)
+            matrices = {table: _load_pickled_table(path, table) for table in TABLES}
+    return tuple(WordTable(vocabulary, matrices[table]) for table in TABLES)
@@ -0,0 +1,70 @@
+import unittest
+
+import numpy
+
+from nlgeval.skipthoughts.gru import fuse_gru_params, gru_layer
+
+
+def reference_gru(params, prefix, state_below, mask):
+    """
+    One step at a time in float64 with the separate gate and candidate parameters, as the original Theano scan.
+    """
+    params = {k: v.astype('float64') for k, v in params.items()}
+    dim = params[prefix + '_Ux'].shape[1]
+    h = numpy.zeros((state_below.shape[1], dim))
+    for m, x in zip(mask, state_below.astype('float64')):
+        preact = numpy.dot(h, params[prefix + '_U']) + numpy.dot(x, params[prefix + '_W']) + params[prefix + '_b']
+        r = 1. / (1. + numpy.exp(-preact[:, :dim]))
+        u = 1. / (1. + numpy.exp(-preact[:, dim:]))
+        hx = numpy.tanh(numpy.dot(h, params[prefix + '_Ux']) * r
+                        + numpy.dot(x, params[prefix + '_Wx']) + params[prefix + '_bx'])
+        h_ = u * h + (1. - u) * hx
+        h = m[:, None] * h_ + (1. - m[:, None]) * h
+    return h
+
+
+class TestGru(unittest.TestCase):
+    def setUp(self):
+        rng = numpy.random.RandomState(0)
+        self.nin, self.dim = 12, 9
+        nin, dim = self.nin, self.dim
+        self.params = {
+            'encoder_W': rng.uniform(-.5, .5, (nin, 2 * dim)).astype('float32'),
+            'encoder_b': rng.uniform(-.5, .5, 2 * dim).astype('float32'),
+            'encoder_U': rng.uniform(-.5, .5, (dim, 2 * dim)).astype('float32'),
+            'encoder_Wx': rng.uniform(-.5, .5, (nin, dim)).astype('float32'),
+            'encoder_bx': rng.uniform(-.5, .5, dim).astype('float32'),
+            'encoder_Ux': rng.uniform(-.5, .5, (dim, dim)).astype('float32'),
+        }
+        self.layer = fuse_gru_params(self.params, 'encoder')
+        self.x = rng.rand(7, 5, nin).astype('float32')
+        # Samples 2 and 4 are padded after 5 and 3 steps.
+        self.mask = numpy.ones((7, 5), dtype='float32')
+        self.mask[5:, 2] = 0
+        self.mask[3:, 4] = 0
+
+    def test_fuse(self):
+        self.assertEqual((self.nin, 3 * self.dim), self.layer['W'].shape)
+        self.assertEqual((3 * self.dim,), self.layer['b'].shape)
+        self.assertEqual((self.dim, 3 * self.dim), self.layer['U'].shape)
+
+    def test_reference(self):
+        h = gru_layer(self.layer, self.x)
+        self.assertEqual(numpy.float32, h.dtype)
+        self.assertEqual((5, self.dim), h.shape)
+        numpy.testing.assert_allclose(
+            reference_gru(self.params, 'encoder', self.x, numpy.ones((7, 5))), h, rtol=1e-5, atol=1e-6)
+
+        h = gru_layer(self.layer, self.x, mask=self.mask)
+        numpy.testing.assert_allclose(
+            reference_gru(self.params, 'encoder', self.x, self.mask), h, rtol=1e-5, atol=1e-6)
+
+    def test_mask(self):
+        h = gru_layer(self.layer, self.x, mask=self.mask)
+        # The state of a padded sample stops changing at its last step.
+        numpy.testing.assert_allclose(gru_layer(self.layer, self.x[:5, 2:3])[0], h[2], rtol=1e-6, atol=1e-7)
+        numpy.testing.assert_allclose(gru_layer(self.layer, self.x[:3, 4:5])[0], h[4], rtol=1e-6, atol=1e-7)
+        # A fully masked sample keeps the initial state.
+        mask = self.mask.copy()
+        mask[:, 0] = 0
+        numpy.testing.assert_array_equal(numpy.zeros(self.dim), gru_layer(self.layer, self.x, mask=mask)[0])
@@ -0,0 +1,86 @@
+import unittest
+
+import numpy
+
+from nlgeval.skipthoughts import skipthoughts, tables
+
+
+def random_params(rng, prefixes, nin, dim):
+    params = {}
+    for prefix in prefixes:
+        for name, shape in (('W', (nin, 2 * dim)), ('b', (2 * dim,)), ('U', (dim, 2 * dim)),
+                            ('Wx', (nin, dim)), ('bx', (dim,)), ('Ux', (dim, dim))):
+            params['%s_%s' % (prefix, name)] = rng.uniform(-.5, .5, shape).astype('float32')
+    return params
+
+
+class TestBatches(unittest.TestCase):
+    def setUp(self):
+        rng = numpy.random.RandomState(0)
+        self.lengths = rng.randint(1, 30, size=300)
+
+    def check_partition(self, batches):
+        numpy.testing.assert_array_equal(numpy.arange(len(self.lengths)), numpy.sort(numpy.concatenate(batches)))
+
+    def test_bounds(self):
+        for batch_size, batch_tokens, max_padding in ((128, 4096, 0.2), (16, 100, 0.5), (300, None, 1.0),
+                                                      (7, 30, 0.0), (64, 1000, 0.1)):
+            batches = skipthoughts._length_batches(self.lengths, batch_size, batch_tokens, max_padding)
+            self.check_partition(batches)
+            for batch in batches:
+                lengths = self.lengths[batch]
+                padded = len(batch) * lengths.max()
+                self.assertLessEqual(len(batch), batch_size)
+                # A sentence longer than batch_tokens is a batch of its own.
+                if batch_tokens is not None and len(batch) > 1:
+                    self.assertLessEqual(padded, batch_tokens)
+                self.assertLessEqual(padded - lengths.sum(), max_padding * padded)
+
+    def test_equal_lengths(self):
+        batches = skipthoughts._length_batches(self.lengths, 8, None, 0)
+        self.check_partition(batches)
+        for batch in batches:
+            self.assertLessEqual(len(batch), 8)
+            self.assertEqual(1, len(set(self.lengths[batch])))
+        # Only the length and batch_size split batches.
+        for length in set(self.lengths):
+            self.assertEqual(-(-numpy.sum(self.lengths == length) // 8),
+                             sum(self.lengths[batch[0]] == length for batch in batches))
+
+
+class TestEncode(unittest.TestCase):
+    def setUp(self):
+        rng = numpy.random.RandomState(0)
+        words = ['UNK', '<eos>', 'a', 'cat', 'sat', 'on', 'the', 'mat', 'dog', 'runs', '.']
+        vocabulary = tables.Vocabulary.from_words(words)
+        dim_word, dim = 6, 5
+        options = dict(encoder='gru', dim_word=dim_word, dim=dim)
+        self.model = dict(
+            uoptions=options, boptions=options,
+            utable=tables.WordTable(vocabulary, rng.rand(len(words), dim_word).astype('float32')),
+            btable=tables.WordTable(vocabulary, rng.rand(len(words), dim_word).astype('float32')),
+            f_w2v=skipthoughts.build_encoder(random_params(rng, ['encoder'], dim_word, dim), options),
+            f_w2v2=skipthoughts.build_encoder_bi(random_params(rng, ['encoder', 'encoder_r'], dim_word, dim), options))
+        self.sentences = ["a cat sat on the mat .", "the dog runs .", "a dog", "the cat sat on a unicorn .",
+                          "cat", "a dog runs on the mat and the cat sat on the mat ."]
+
+    def test_padding(self):
+        for use_eos in (False, True):
+            # One sentence per batch, so nothing is padded.
+            unpadded = skipthoughts.encode(self.model, self.sentences, verbose=False, use_eos=use_eos,
+                                           batch_size=1)
+            self.assertEqual((len(self.sentences), 3 * 5), unpadded.shape)
+            padded = skipthoughts.encode(self.model, self.sentences, verbose=False, use_eos=use_eos,
+                                         batch_size=128, batch_tokens=None, max_padding=1.0)
+            numpy.testing.assert_allclose(unpadded, padded, rtol=1e-5, atol=1e-6)
+            for batch_tokens, max_padding in ((16, 0.5), (4096, 0)):
+                numpy.testing.assert_allclose(
+                    unpadded,
+                    skipthoughts.encode(self.model, self.sentences, verbose=False, use_eos=use_eos,
+                                        batch_tokens=batch_tokens, max_padding=max_padding),
+                    rtol=1e-5, atol=1e-6)
+
+        # The end of sentence token is encoded as one more step.
+        self.assertFalse(numpy.allclose(skipthoughts.encode(self.model, self.sentences, verbose=False),
+                                        skipthoughts.encode(self.model, self.sentences, verbose=False,
+                                                            use_eos=True)))
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import io
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import numpy
+
+from nlgeval.skipthoughts import tables
+
+
+class TestTables(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.words = ['UNK', '<eos>', 'the', 'cat', 'テスト', 'the']
+        rng = numpy.random.RandomState(0)
+        self.vectors = {}
+        for table in tables.TABLES:
+            self.vectors[table] = rng.rand(len(self.words), 4).astype('float32')
+            # Stored like the downloaded tables: one pickled vector per word.
+            pickled = numpy.empty(len(self.words), dtype=object)
+            for i, v in enumerate(self.vectors[table]):
+                pickled[i] = v
+            numpy.save(os.path.join(self.path, '%s.npy' % table), pickled)
+        with io.open(os.path.join(self.path, tables.DICTIONARY), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(self.words) + '\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_load_tables(self):
+        for _ in range(2):
+            # Converted on the first load, memory-mapped on the second.
+            utable, btable = tables.load_tables(self.path)
+            self.assertEqual(utable.vocabulary.keys(), self.words)
+            for table, loaded in zip(tables.TABLES, (utable, btable)):
+                # The last row of a repeated word is used, as with a dict.
+                numpy.testing.assert_array_equal(loaded['the'], self.vectors[table][5])
+                numpy.testing.assert_array_equal(loaded['テスト'], self.vectors[table][4])
+                self.assertNotIn('dog', loaded)
+                self.assertRaises(KeyError, loaded.__getitem__, 'dog')
+            rows = utable.vocabulary.rows(['cat', 'dog', 'the'], default=0)
+            numpy.testing.assert_array_equal(rows, [3, 0, 5])
+        self.assertIsInstance(utable.vectors, numpy.memmap)
+
+    def test_partial_conversion(self):
+        replace = tables._replace
+
+        def fail_on_hashes(src, dst):
+            if os.path.basename(dst) == tables.VOCAB_HASHES:
+                raise OSError("disk full")
+            replace(src, dst)
+
+        tables._replace = fail_on_hashes
+        try:
+            self.assertRaises(OSError, tables.convert_tables, self.path)
+        finally:
+            tables._replace = replace
+        # The temporary file was removed and the tables are not loaded until they are fully converted.
+        self.assertFalse(os.path.exists(os.path.join(self.path, tables.VOCAB_HASHES)))
+        self.assertFalse([name for name in os.listdir(self.path) if name.startswith('tmp')])
+        utable, _ = tables.load_tables(self.path)
+        self.assertNotIsInstance(utable.vectors, numpy.memmap)
+        numpy.testing.assert_array_equal(utable['cat'], self.vectors['utable'][3])
+
+    def test_concurrent_conversion(self):
+        threads = [threading.Thread(target=tables.convert_tables, args=(self.path,)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertFalse([name for name in os.listdir(self.path) if name.startswith('tmp')])
+        utable, btable = tables.load_tables(self.path)
+        self.assertIsInstance(btable.vectors, numpy.memmap)
+        numpy.testing.assert_array_equal(btable['the'], self.vectors['btable'][5])
@@ -2,16 +2,19 @@
 from __future__ import unicode_literals
 
 import os
+import shutil
+import tempfile
 import unittest
 
 import nlgeval
 from nlgeval import NLGEval
+from nlgeval.references import CompiledReferences
 
 
 class TestNlgEval(unittest.TestCase):
     def test_compute_metrics_oo(self):
         # Create the object in the test so that it can be garbage collected once the test is done.
-        n = NLGEval()
+        n = NLGEval(extra_metrics=NLGEval.optional_metrics)
 
         # Individual Metrics
         scores = n.compute_individual_metrics(ref=["this is a test",
@@ -23,13 +26,17 @@ class TestNlgEval(unittest.TestCase):
         self.assertAlmostEqual(0.0000903602, scores['Bleu_4'], places=5)
         self.assertAlmostEqual(0.44434387, scores['METEOR'], places=5)
         self.assertAlmostEqual(0.9070631, scores['ROUGE_L'], places=5)
+        self.assertAlmostEqual(0.907063, scores['ROUGE_1'], places=5)
+        self.assertAlmostEqual(0.586538, scores['ROUGE_2'], places=5)
+        self.assertAlmostEqual(0.828918, scores['ROUGE_W'], places=5)
+        self.assertAlmostEqual(0.829932, scores['ROUGE_SU4'], places=5)
         self.assertAlmostEqual(0.0, scores['CIDEr'], places=5)
         self.assertAlmostEqual(0.8375251, scores['SkipThoughtCS'], places=5)
         self.assertAlmostEqual(0.980075, scores['EmbeddingAverageCosineSimilarity'], places=5)
         self.assertEqual(scores['EmbeddingAverageCosineSimilarity'], scores['EmbeddingAverageCosineSimilairty'])
         self.assertAlmostEqual(0.94509, scores['VectorExtremaCosineSimilarity'], places=5)
         self.assertAlmostEqual(0.960771, scores['GreedyMatchingScore'], places=5)
-        self.assertEqual(12, len(scores))
+        self.assertEqual(16, len(scores))
 
         scores = n.compute_metrics(ref_list=[
             [
@@ -52,12 +59,16 @@ class TestNlgEval(unittest.TestCase):
         self.assertAlmostEqual(0.201143, scores['Bleu_4'], places=5)
         self.assertAlmostEqual(0.295797, scores['METEOR'], places=5)
         self.assertAlmostEqual(0.522104, scores['ROUGE_L'], places=5)
+        self.assertAlmostEqual(0.522104, scores['ROUGE_1'], places=5)
+        self.assertAlmostEqual(0.301277, scores['ROUGE_2'], places=5)
+        self.assertAlmostEqual(0.450549, scores['ROUGE_W'], places=5)
+        self.assertAlmostEqual(0.270483, scores['ROUGE_SU4'], places=5)
         self.assertAlmostEqual(1.242192, scores['CIDEr'], places=5)
         self.assertAlmostEqual(0.626149, scores['SkipThoughtCS'], places=5)
         self.assertAlmostEqual(0.88469, scores['EmbeddingAverageCosineSimilarity'], places=5)
         self.assertAlmostEqual(0.568696, scores['VectorExtremaCosineSimilarity'], places=5)
         self.assertAlmostEqual(0.784205, scores['GreedyMatchingScore'], places=5)
-        self.assertEqual(12, len(scores))
+        self.assertEqual(16, len(scores))
 
         # Non-ASCII tests.
         scores = n.compute_individual_metrics(ref=["Test en français.",
@@ -69,26 +80,33 @@ class TestNlgEval(unittest.TestCase):
         self.assertAlmostEqual(0, scores['Bleu_4'], places=5)
         self.assertAlmostEqual(0.48372379050300296, scores['METEOR'], places=5)
         self.assertAlmostEqual(0.9070631, scores['ROUGE_L'], places=5)
+        self.assertAlmostEqual(0.907063, scores['ROUGE_1'], places=5)
+        self.assertAlmostEqual(0.586538, scores['ROUGE_2'], places=5)
+        self.assertAlmostEqual(0.808101, scores['ROUGE_W'], places=5)
+        self.assertAlmostEqual(0.829932, scores['ROUGE_SU4'], places=5)
         self.assertAlmostEqual(0.0, scores['CIDEr'], places=5)
         self.assertAlmostEqual(0.9192341566085815, scores['SkipThoughtCS'], places=5)
         self.assertAlmostEqual(0.906562, scores['EmbeddingAverageCosineSimilarity'], places=5)
         self.assertEqual(scores['EmbeddingAverageCosineSimilarity'], scores['EmbeddingAverageCosineSimilairty'])
         self.assertAlmostEqual(0.815158, scores['VectorExtremaCosineSimilarity'], places=5)
         self.assertAlmostEqual(0.940959, scores['GreedyMatchingScore'], places=5)
-        self.assertEqual(12, len(scores))
+        self.assertEqual(16, len(scores))
 
         scores = n.compute_individual_metrics(ref=["テスト"],
                                               hyp="テスト")
         self.assertAlmostEqual(0.99999999, scores['Bleu_1'], places=5)
         self.assertAlmostEqual(1.0, scores['METEOR'], places=3)
         self.assertAlmostEqual(1.0, scores['ROUGE_L'], places=3)
+        self.assertAlmostEqual(1.0, scores['ROUGE_1'], places=3)
+        self.assertAlmostEqual(0.0, scores['ROUGE_2'], places=3)
         self.assertAlmostEqual(0.0, scores['CIDEr'], places=3)
         self.assertAlmostEqual(1.0, scores['SkipThoughtCS'], places=3)
         self.assertAlmostEqual(1.0, scores['GreedyMatchingScore'], places=3)
-        self.assertEqual(12, len(scores))
+        self.assertEqual(16, len(scores))
 
     def test_compute_metrics_omit(self):
-        n = NLGEval(metrics_to_omit=['Bleu_3', 'METEOR', 'EmbeddingAverageCosineSimilarity'])
+        n = NLGEval(metrics_to_omit=['Bleu_3', 'METEOR', 'EmbeddingAverageCosineSimilarity', 'ROUGE_W'],
+                    extra_metrics=['ROUGE_1', 'ROUGE_2', 'ROUGE_W'])
 
         # Individual Metrics
         scores = n.compute_individual_metrics(ref=["this is a test",
@@ -97,11 +115,15 @@ class TestNlgEval(unittest.TestCase):
         self.assertAlmostEqual(0.799999, scores['Bleu_1'], places=5)
         self.assertAlmostEqual(0.632455, scores['Bleu_2'], places=5)
         self.assertAlmostEqual(0.9070631, scores['ROUGE_L'], places=5)
+        self.assertAlmostEqual(0.907063, scores['ROUGE_1'], places=5)
+        self.assertAlmostEqual(0.586538, scores['ROUGE_2'], places=5)
         self.assertAlmostEqual(0.0, scores['CIDEr'], places=5)
         self.assertAlmostEqual(0.8375251, scores['SkipThoughtCS'], places=5)
         self.assertAlmostEqual(0.94509, scores['VectorExtremaCosineSimilarity'], places=5)
         self.assertAlmostEqual(0.960771, scores['GreedyMatchingScore'], places=5)
-        self.assertEqual(7, len(scores))
+        self.assertNotIn('ROUGE_W', scores)
+        self.assertNotIn('ROUGE_SU4', scores)
+        self.assertEqual(9, len(scores))
 
     def test_compute_metrics(self):
         # The example from the README.
@@ -115,6 +137,7 @@ class TestNlgEval(unittest.TestCase):
         self.assertAlmostEqual(0.201143, scores['Bleu_4'], places=5)
         self.assertAlmostEqual(0.295797, scores['METEOR'], places=5)
         self.assertAlmostEqual(0.522104, scores['ROUGE_L'], places=5)
+        self.assertNotIn('ROUGE_W', scores)
         self.assertAlmostEqual(1.242192, scores['CIDEr'], places=5)
         self.assertAlmostEqual(0.626149, scores['SkipThoughtCS'], places=5)
         self.assertAlmostEqual(0.88469, scores['EmbeddingAverageCosineSimilarity'], places=5)
@@ -122,3 +145,56 @@ class TestNlgEval(unittest.TestCase):
         self.assertAlmostEqual(0.568696, scores['VectorExtremaCosineSimilarity'], places=5)
         self.assertAlmostEqual(0.784205, scores['GreedyMatchingScore'], places=5)
         self.assertEqual(12, len(scores))
+
+    def test_compute_metrics_compiled(self):
+        n = NLGEval(no_skipthoughts=True, no_glove=True, metrics_to_omit=['METEOR', 'SPICE'])
+        ref_list = [["this is one reference sentence for sentence1",
+                     "this is a reference sentence for sentence2 which was generated by your model"],
+                    ["this is one more reference sentence for sentence1",
+                     "this is the second reference sentence for sentence2"]]
+        hyp_lists = [["this is the model generated sentence1 which seems good enough",
+                      "this is sentence2 which has been generated by your model"],
+                     ["a completely different first hypothesis", "and yet another second one"],
+                     ["more new words", "every checkpoint adds some"]]
+        path = tempfile.mkdtemp()
+        try:
+            n.compile_references(ref_list, path)
+            for references in [n.compile_references(ref_list), CompiledReferences.load(path)]:
+                size = len(references.index)
+                for hyp_list in hyp_lists:
+                    expected = n.compute_metrics(ref_list, hyp_list)
+                    scores = n.compute_metrics(references, hyp_list)
+                    self.assertEqual(sorted(expected), sorted(scores))
+                    for metric, score in expected.items():
+                        self.assertAlmostEqual(score, scores[metric], places=10)
+                    # the n-grams of the hypotheses are not added to the index of the references
+                    self.assertEqual(size, len(references.index))
+        finally:
+            shutil.rmtree(path)
+
+    def test_spice_persistent(self):
+        for persistent in [False, True]:
+            n = NLGEval(no_skipthoughts=True, no_glove=True, metrics_to_omit=['METEOR'], spice_persistent=persistent)
+            spice, = [scorer for scorer, method in n.scorers if method == 'SPICE']
+            self.assertEqual(persistent, spice.persistent)
+            n.close()
+
+    def test_overlap_scores_close(self):
+        class Scorer(object):
+            def __init__(self, fail):
+                self.fail = fail
+                self.closed = False
+
+            def compute_score(self, gts, res):
+                if self.fail:
+                    raise RuntimeError("scoring failed")
+                return 1.0, [1.0]
+
+            def close(self):
+                self.closed = True
+
+        scorers = [(Scorer(False), 'A'), (Scorer(True), 'B'), (Scorer(False), 'C')]
+        with self.assertRaises(RuntimeError):
+            nlgeval._overlap_scores(scorers, {0: ["a b"]}, {0: ["a b"]}, close=True)
+        # the scorers which did not get to run are closed too
+        self.assertTrue(all(scorer.closed for scorer, _ in scorers))
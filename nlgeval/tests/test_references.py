@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from nlgeval.pycocoevalcap.bleu.bleu import Bleu
+from nlgeval.pycocoevalcap.cider.cider import Cider
+from nlgeval.pycocoevalcap.ngrams import cook_corpus
+from nlgeval.pycocoevalcap.rouge.rouge import Rouge
+from nlgeval.references import CompiledReferences
+
+
+class TestCompiledReferences(unittest.TestCase):
+    ref_list = [
+        ["this is one reference sentence for sentence1",
+         "this is a reference sentence for sentence2 which was generated by your model"],
+        ["this is one more reference sentence for sentence1",
+         "this is the second reference sentence for sentence2"],
+    ]
+    hyp_list = ["this is the model generated sentence1 which seems good enough",
+                "this is sentence2 which has been generated by your model"]
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_save_load(self):
+        CompiledReferences(self.ref_list).save(self.path)
+        references = CompiledReferences.load(self.path)
+        self.assertEqual(2, len(references))
+        self.assertEqual(2, references.num_references)
+
+        # nothing is recomputed from the references, they are only split into tokens when scored
+        self.assertIsInstance(references.document_frequency(), np.memmap)
+        self.assertIsNone(references.cooked()[0][0]._words)
+
+        refs = {idx: list(r) for idx, r in enumerate(zip(*self.ref_list))}
+        hyps = {idx: [h] for idx, h in enumerate(self.hyp_list)}
+        size = len(references.index)
+        cooked_refs, cooked_hyps = cook_corpus(references.cooked(), hyps, index=references.index.overlay())
+        self.assertEqual(size, len(references.index))
+        for scorer in [Bleu(4), Rouge()]:
+            self.assertEqual(scorer.compute_score(refs, hyps)[0], scorer.compute_score(cooked_refs, cooked_hyps)[0])
+        self.assertAlmostEqual(Cider().compute_score(refs, hyps)[0],
+                               Cider().compute_score(cooked_refs, cooked_hyps,
+                                                     document_frequency=references.document_frequency())[0])
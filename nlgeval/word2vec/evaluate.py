@@ -41,11 +41,68 @@ class Embedding(object):
         except KeyError:
             return self.unk
 
+    @property
+    def vectors(self):
+        try:
+            return self.m.vectors
+        except AttributeError:
+            return self.m.syn0
+
+    def vecs(self, ids):
+        """
+        :param ids: array of int : indices from `__getitem__`, `len(self.vectors)` for unknown words
+        :return: array (len(ids), dim) : the word vectors
+        """
+        vectors = self.vectors
+        ids = np.asarray(ids)
+        known = ids < len(vectors)
+        result = np.empty((len(ids), vectors.shape[1]), dtype=vectors.dtype)
+        result[known] = vectors[ids[known]]
+        result[~known] = self.unk
+        return result
+
+
+def pool_embeddings(embs):
+    """
+    :param embs: word embeddings of a sentence
+    :return: (normalized average embedding, vector extrema)
+    """
+    avg_emb = np.sum(embs, axis=0) / np.linalg.norm(np.sum(embs, axis=0))
+    assert not np.any(np.isnan(avg_emb))
+
+    maxemb = np.max(embs, axis=0)
+    minemb = np.min(embs, axis=0)
+    extreme_emb = list(map(lambda x, y: x if ((x>y or x<-y) and y>0) or ((x<y or x>-y) and y<0) else y, maxemb, minemb))
+    return avg_emb, extreme_emb
+
+
+def embed_sentences(sentences, emb):
+    """
+    :param sentences: list of str
+    :param emb: Embedding
+    :return: (word embeddings, normalized average embeddings, vector extrema), each with one entry per sentence
+    """
+    from nltk.tokenize import word_tokenize
+
+    emb_sentences = []
+    avg_embs = []
+    extreme_embs = []
+    for sentence in sentences:
+        embs = [emb.vec(word) for word in word_tokenize(sentence)]
+        avg_emb, extreme_emb = pool_embeddings(embs)
 
-def eval_emb_metrics(hypothesis, references, emb=None, metrics_to_omit=None):
+        emb_sentences.append(embs)
+        avg_embs.append(avg_emb)
+        extreme_embs.append(extreme_emb)
+    return emb_sentences, avg_embs, extreme_embs
+
+
+def eval_emb_metrics(hypothesis, references, emb=None, metrics_to_omit=None, embedded_references=None):
+    """
+    :param embedded_references: Optional, `embed_sentences` of each list of references, e.g. from compiled references.
+        `references` is not used if this is given.
+    """
     from sklearn.metrics.pairwise import cosine_similarity
-    from nltk.tokenize import word_tokenize
-    import numpy as np
     if emb is None:
         emb = Embedding()
 
@@ -56,46 +113,13 @@ def eval_emb_metrics(hypothesis, references, emb=None, metrics_to_omit=None):
             metrics_to_omit.remove('EmbeddingAverageCosineSimilairty')
             metrics_to_omit.add('EmbeddingAverageCosineSimilarity')
 
-    emb_hyps = []
-    avg_emb_hyps = []
-    extreme_emb_hyps = []
-    for hyp in hypothesis:
-        embs = [emb.vec(word) for word in word_tokenize(hyp)]
-
-        avg_emb = np.sum(embs, axis=0) / np.linalg.norm(np.sum(embs, axis=0))
-        assert not np.any(np.isnan(avg_emb))
-
-        maxemb = np.max(embs, axis=0)
-        minemb = np.min(embs, axis=0)
-        extreme_emb = list(map(lambda x, y: x if ((x>y or x<-y) and y>0) or ((x<y or x>-y) and y<0) else y, maxemb, minemb))
-
-        emb_hyps.append(embs)
-        avg_emb_hyps.append(avg_emb)
-        extreme_emb_hyps.append(extreme_emb)
-
-    emb_refs = []
-    avg_emb_refs = []
-    extreme_emb_refs = []
-    for refsource in references:
-        emb_refsource = []
-        avg_emb_refsource = []
-        extreme_emb_refsource = []
-        for ref in refsource:
-            embs = [emb.vec(word) for word in word_tokenize(ref)]
-
-            avg_emb = np.sum(embs, axis=0) / np.linalg.norm(np.sum(embs, axis=0))
-            assert not np.any(np.isnan(avg_emb))
-
-            maxemb = np.max(embs, axis=0)
-            minemb = np.min(embs, axis=0)
-            extreme_emb = list(map(lambda x, y: x if ((x>y or x<-y) and y>0) or ((x<y or x>-y) and y<0) else y, maxemb, minemb))
-
-            emb_refsource.append(embs)
-            avg_emb_refsource.append(avg_emb)
-            extreme_emb_refsource.append(extreme_emb)
-        emb_refs.append(emb_refsource)
-        avg_emb_refs.append(avg_emb_refsource)
-        extreme_emb_refs.append(extreme_emb_refsource)
+    emb_hyps, avg_emb_hyps, extreme_emb_hyps = embed_sentences(hypothesis, emb)
+
+    if embedded_references is None:
+        embedded_references = [embed_sentences(refsource, emb) for refsource in references]
+    emb_refs = [e[0] for e in embedded_references]
+    avg_emb_refs = [e[1] for e in embedded_references]
+    extreme_emb_refs = [e[2] for e in embedded_references]
 
     rval = []
     if 'EmbeddingAverageCosineSimilarity' not in metrics_to_omit: